@@ -0,0 +1,50 @@
+"""
+Throughput of simple filter queries with and without batch execution.
+Run `PYTHONPATH=. python benchmarks/batch_throughput.py [nrows]` from the root of
+the repo.
+"""
+
+import os
+import random
+import sys
+import time
+from tempfile import gettempdir
+
+from spyql.query import Query
+
+QUERIES = [
+    "SELECT a, b * 2, d FROM csv('{path}') WHERE c > 50 TO {writer}('{out}')",
+    "SELECT * FROM csv('{path}') WHERE d == 'x3' TO {writer}('{out}')",
+    "SELECT a + c FROM csv('{path}') TO {writer}('{out}')",
+]
+
+
+def make_csv(nrows):
+    path = os.path.join(gettempdir(), "spyql_batch_benchmark.csv")
+    with open(path, "w") as f:
+        f.write("a,b,c,d\n")
+        for i in range(nrows):
+            f.write(f"{i},{random.random()},{random.randint(0, 100)},x{i % 7}\n")
+    return path
+
+
+def run(query, input_options):
+    start = time.perf_counter()
+    Query(query, input_options=input_options)()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    path = make_csv(nrows)
+    for writer in ["csv", "json"]:
+        for query in QUERIES:
+            query = query.format(path=path, writer=writer, out=os.devnull)
+            print(query)
+            for batch_size in [None, 256, 4096]:
+                elapsed = run(query, {"batch_size": batch_size} if batch_size else {})
+                print(
+                    f"\tbatch_size={str(batch_size):>5}:"
+                    f" {elapsed:6.2f}s {nrows / elapsed:10.0f} rows/s"
+                )
+    os.remove(path)
@@ -0,0 +1,58 @@
+"""
+Memory used by each row buffered by the handlers of ORDER BY, DISTINCT and GROUP BY
+queries, with and without sort keys (besides the values of the rows, which are shared
+by all handlers): the memory after handling all rows, and the peak memory until all rows
+are written (e.g. including conversions before sorting), measured with
+`tracemalloc`.
+Run `PYTHONPATH=. python benchmarks/buffer_memory.py [nrows]` from the root of the
+repo.
+"""
+
+import sys
+import tracemalloc
+
+from spyql.output_handler import (
+    DelayedOutSortAtEnd,
+    DistinctDelayedOutSortAtEnd,
+    GroupByDelayedOutSortAtEnd,
+)
+
+ORDERBY = [{"expr": 1, "rev": False, "rev_nulls": False}]
+
+
+def make_rows(nrows):
+    return [((i, str(i)), (-i,)) for i in range(nrows)]
+
+
+class NullWriter:
+    def writerow(self, row):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run(handler, rows):
+    handler.set_writer(NullWriter())
+    tracemalloc.start()
+    for result, sort_keys in rows:
+        handler.handle_result(result, sort_keys, result[0])
+    size = tracemalloc.get_traced_memory()[0]
+    handler.finish()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size / len(rows), peak / len(rows)
+
+
+if __name__ == "__main__":
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rows = make_rows(nrows)
+    for orderby in [ORDERBY, None]:
+        print("ORDER BY" if orderby else "no ORDER BY")
+        for handler in [
+            DelayedOutSortAtEnd,
+            DistinctDelayedOutSortAtEnd,
+            GroupByDelayedOutSortAtEnd,
+        ]:
+            size, peak = run(handler(orderby, None, None), rows)
+            print(f"{handler.__name__:28} {size:6.1f} bytes/row (peak {peak:6.1f})")
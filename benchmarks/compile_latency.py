@@ -0,0 +1,48 @@
+"""
+Latency of compiling queries over wide CSV files, as a function of the number of
+columns (the input has a single row, so the run time is dominated by compilation).
+Run `PYTHONPATH=. python benchmarks/compile_latency.py [max_ncols]` from the root of
+the repo.
+"""
+
+import os
+import sys
+import time
+from tempfile import gettempdir
+
+from spyql.query import Query
+
+QUERIES = [
+    # a few hundred expressions over the columns
+    "SELECT {exprs} FROM csv('{path}') WHERE c0 >= 0 TO csv('{out}')",
+    # all columns, via `*` and the row variable
+    "SELECT *, row.c1 FROM csv('{path}') TO csv('{out}')",
+]
+
+
+def make_csv(ncols):
+    path = os.path.join(gettempdir(), "spyql_compile_benchmark.csv")
+    with open(path, "w") as f:
+        f.write(",".join(f"c{i}" for i in range(ncols)) + "\n")
+        f.write(",".join(str(i) for i in range(ncols)) + "\n")
+    return path
+
+
+def run(query):
+    start = time.perf_counter()
+    Query(query)()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    max_ncols = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    for query in QUERIES:
+        print(query)
+        for ncols in [10, 100, 1000, 3000, 10000]:
+            if ncols > max_ncols:
+                break
+            path = make_csv(ncols)
+            exprs = ", ".join(f"c{i} * 2 + c{i // 2}" for i in range(0, ncols, 10))
+            elapsed = run(query.format(exprs=exprs, path=path, out=os.devnull))
+            print(f"\tncols={ncols:>5}: {elapsed:8.3f}s")
+            os.remove(path)
@@ -0,0 +1,46 @@
+"""
+Time of sorting the output rows of ORDER BY queries, as a function of the number of
+sort keys (alternating ASC and DESC, with ints, floats, strings and NULLs).
+Run `PYTHONPATH=. python benchmarks/sort_keys.py [nrows]` from the root of the repo.
+"""
+
+import random
+import sys
+import time
+
+from spyql.nulltype import Null
+from spyql.output_handler import DelayedOutSortAtEnd
+
+
+def make_rows(nrows):
+    return [
+        (
+            random.randint(0, 100),
+            random.choice(["a", "b", "c", "d", Null]),
+            random.random(),
+            random.randint(0, 10) if i % 10 else Null,
+            str(i),
+        )
+        for i in range(nrows)
+    ]
+
+
+def run(rows, nkeys):
+    orderby = [
+        {"expr": i + 1, "rev": i % 2 == 1, "rev_nulls": i % 2 == 1}
+        for i in range(nkeys)
+    ]
+    handler = DelayedOutSortAtEnd(orderby, None, None)
+    for row in rows:
+        handler.handle_result(row, row[:nkeys])
+    start = time.perf_counter()
+    handler.sorted_rows()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rows = make_rows(nrows)
+    for nkeys in range(1, 6):
+        elapsed = run(rows, nkeys)
+        print(f"nkeys={nkeys}: {elapsed:6.2f}s {nrows / elapsed:10.0f} rows/s")
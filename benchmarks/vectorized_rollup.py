@@ -0,0 +1,55 @@
+"""
+Throughput of queries over numeric CSV columns with and without vectorization.
+Run `PYTHONPATH=. python benchmarks/vectorized_rollup.py [nrows]` from the root of
+the repo.
+"""
+
+import os
+import random
+import sys
+import time
+from tempfile import gettempdir
+
+from spyql.query import Query
+
+QUERIES = [
+    "SELECT host, sum_agg(bytes), avg_agg(latency), max_agg(latency), count_agg(*)"
+    " FROM csv('{path}') GROUP BY 1 TO csv('{out}')",
+    "SELECT minute // 60 AS hour, sum_agg(bytes * 8) FROM csv('{path}')"
+    " WHERE latency > 0.5 GROUP BY 1 TO csv('{out}')",
+    "SELECT minute, bytes / 1024, latency * 1000 FROM csv('{path}')"
+    " WHERE status == 200 TO csv('{out}')",
+]
+
+
+def make_csv(nrows):
+    path = os.path.join(gettempdir(), "spyql_vectorized_benchmark.csv")
+    with open(path, "w") as f:
+        f.write("minute,host,status,bytes,latency\n")
+        for i in range(nrows):
+            f.write(
+                f"{i // 100},h{i % 13},{random.choice([200, 200, 404, 500])},"
+                f"{random.randint(0, 10**6)},{random.random()}\n"
+            )
+    return path
+
+
+def run(query, input_options):
+    start = time.perf_counter()
+    Query(query, input_options=input_options)()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    path = make_csv(nrows)
+    for query in QUERIES:
+        query = query.format(path=path, out=os.devnull)
+        print(query)
+        for vectorize in [False, True]:
+            elapsed = run(query, {"vectorize": vectorize})
+            print(
+                f"\tvectorize={str(vectorize):>5}:"
+                f" {elapsed:6.2f}s {nrows / elapsed:10.0f} rows/s"
+            )
+    os.remove(path)
@@ -1,24 +1,68 @@
 import operator
+from collections import UserString, deque
+from itertools import islice
 from spyql.nulltype import Null
 from spyql.qdict import qdict
 
 
-def _init_aggs():
-    """Initializes aggregates tracking mechanism"""
-    global _agg_idx
-    global _agg_key
+def _init_aggs(nslots=0, partials=False):
+    """
+    Initializes aggregates tracking mechanism.
+    `nslots` is the number of calls to aggregate functions in the query: each call
+    has a static slot, assigned by the parser (see `parser.number_agg_calls`), which
+    is passed to the aggregate function in the `_slot` argument.
+    Calls without a static slot (e.g. in comprehensions or lambdas, or from user
+    functions) take the slots after these, in the order they are called on each row
+    (see `_dynamic_slot`).
+    `partials` is True when the results of every row are written (`SELECT PARTIALS`),
+    and so they cannot share values that are updated in place.
+    """
+    global _agg_nslots
+    global _agg_next_slot
+    global _agg_accs
     global _aggs
-    _agg_idx = 0  # pointer to the current aggregate tracker, reset every new row
-    _agg_key = ()  # aggregation key of the current row (identifies the group)
-    _aggs = dict()  # cumulative of each aggregation function call
+    global _agg_ops
+    global _replay
+    global _partials
+    _agg_nslots = nslots
+    _agg_next_slot = nslots  # next slot of calls without a static slot
+    _agg_accs = []  # aggregates of the group of the current row (by slot)
+    _aggs = dict()  # aggregates of each group (lists indexed by slot)
+    _agg_ops = dict()  # operation of each aggregation function call (by slot)
+    _replay = False  # when True, aggregates are returned without being updated
+    _partials = partials
 
 
 def _start_new_agg_row(key):
-    """Resets the aggregates tracking mechanism for starting a new row"""
-    global _agg_idx
-    global _agg_key
-    _agg_idx = 0  # reset aggregate call tracker
-    _agg_key = key  # set the group
+    """Sets the group of a new row (identified by its aggregation key)"""
+    global _agg_accs
+    global _agg_next_slot
+    _agg_accs = _get_group_aggs(key)
+    _agg_next_slot = _agg_nslots
+
+
+def _get_group_aggs(key):
+    """Returns the aggregates of a group (NULL on slots without values yet)"""
+    global _aggs
+    accs = _aggs.get(key)
+    if accs is None:
+        accs = _aggs[key] = [Null] * _agg_nslots
+    return accs
+
+
+def _dynamic_slot():
+    """
+    Returns the slot of a call to an aggregate function without a static slot: the
+    next one in the order of calls on the current row.
+    This might fail if these calls are not made in the same order on every row (e.g.
+    in conditional expressions).
+    """
+    global _agg_next_slot
+    slot = _agg_next_slot
+    _agg_next_slot = slot + 1
+    if slot >= len(_agg_accs):
+        _agg_accs.extend([Null] * (slot + 1 - len(_agg_accs)))
+    return slot
 
 
 def _get_aggs():
@@ -26,147 +70,486 @@ def _get_aggs():
     return _aggs
 
 
-def _agg_op(op, val, default=Null):
+def _get_agg_ops():
+    global _agg_ops
+    return _agg_ops
+
+
+def _merge_aggs(aggs, ops):
+    """
+    Merges partial aggregates (e.g. calculated by another process over a later part
+    of the input) into the current aggregates.
+    `ops` are the operations of each aggregation function call (see `_get_agg_ops`).
+    Since the operations are associative, merging two partial aggregates is the same
+    as aggregating one with the other.
+    """
+    global _aggs
+    global _agg_ops
+    for key, accs in aggs.items():
+        prev_accs = _aggs.get(key)
+        if prev_accs is None:
+            _aggs[key] = accs
+            continue
+        if len(prev_accs) < len(accs):
+            prev_accs.extend([Null] * (len(accs) - len(prev_accs)))
+        for slot, val in enumerate(accs):
+            if val is Null:
+                continue
+            prev_val = prev_accs[slot]
+            prev_accs[slot] = val if prev_val is Null else ops[slot](prev_val, val)
+    _agg_ops.update(ops)
+
+
+def _drop_aggs(key):
+    """Drops the aggregates of a group (e.g. when they will not be used anymore)"""
+    global _aggs
+    _aggs.pop(key, None)
+
+
+def _set_replay(replay):
+    """
+    Turns on/off the replay mode, where aggregate functions return the current
+    aggregates without updating them (e.g. for calculating the results of a group
+    whose aggregates were calculated elsewhere)
+    """
+    global _replay
+    _replay = replay
+
+
+def _agg_collection(slot, op, new, *args):
+    """
+    Returns the aggregate of the current group in `slot` when it is a collection that
+    the aggregate function updates in place (e.g. a set), creating it with
+    `new(*args)` on the first row of the group.
+    `op` merges two partial aggregates (see `_agg_op`), updating the first one.
+    Aggregate functions should not update the collection in replay mode.
+    """
+    global _agg_accs
+    global _agg_ops
+    if slot is None:
+        slot = _dynamic_slot()
+    coll = _agg_accs[slot]
+    if coll is Null:
+        coll = _agg_accs[slot] = new(*args)
+        _agg_ops[slot] = op
+    return coll
+
+
+def _agg_op(slot, op, val):
     """
     Generic aggregation function.
+    `slot` identifies the call to the aggregate function in the query, and so the
+    aggregate of the current group that is updated (None if the call has no static
+    slot, see `_dynamic_slot`).
     `val` is the value for the current aggregation of the current row (ignores NULLs).
-    `op` should be `function(cumulative_from_prev_rows, value_for_cur_row)`.
-    Current mechanism is based on the order of aggregate function calls in the query.
-    This might fail if there are flow control statements, which is not checked by the
-    parser! (e.g. `SELECT max_agg(x) if x>0 else 0, count_agg(*)` produces unpredictable
-    results because in some rows the max function is executed and in others is not.
-    Therefore, in some rows the count_agg will have agg_idx 1 and on others agg_idx 0).
-    """
-    # TODO prevent/detect erroneous aggregation behavior due to flow control statements
-    global _agg_idx
-    global _agg_key
-    global _aggs
-    key = (_agg_key, _agg_idx)
-    _agg_idx += 1  # moves to the next aggregation (before any return)
-    prev_val = _aggs.get(key, default)
-    if val is Null:
+    `op` should be `function(cumulative_from_prev_rows, value_for_cur_row)`, and
+    should be associative and picklable, so that partial aggregates can be merged (see
+    `_merge_aggs`).
+    """
+    global _agg_accs
+    global _agg_ops
+    if slot is None:
+        slot = _dynamic_slot()
+    prev_val = _agg_accs[slot]
+    if val is Null or _replay:
         return prev_val
-    new_val = val if prev_val is Null else op(prev_val, val)
-    _aggs[key] = new_val
+    if prev_val is Null:
+        _agg_ops[slot] = op  # first value of the group
+        new_val = val
+    else:
+        new_val = op(prev_val, val)
+    _agg_accs[slot] = new_val
     return new_val
 
 
+# Aggregation operations (besides operators)
+
+
+def _update_dict(a_dict, another_dict):
+    return a_dict.updatef(another_dict)
+
+
+def _update_set(a_set, another_set):
+    a_set |= another_set
+    return a_set
+
+
+def _new_qdict():
+    return qdict({})
+
+
+def _first(prev, _):
+    return prev
+
+
+def _last(_, cur):
+    return cur
+
+
+def _extend(prev, cur):
+    # lists are extended in place (the first list of each group is always a new one)
+    prev.extend(cur)
+    return prev
+
+
+class _Strings(list):
+    """
+    Strings collected by `string_agg`, caching the result of their last join, which
+    is only joined again (with the strings added since then) when strings are added
+    """
+
+    __slots__ = ("sep", "joined", "size")
+
+    def __init__(self, strings=()):
+        super().__init__(strings)
+        self.sep = None
+        self.joined = None  # result of joining the first `size` strings with `sep`
+        self.size = 0
+
+    def join(self, sep):
+        """Joins the strings with `sep`"""
+        size = len(self)
+        if sep != self.sep or not self.size:
+            self.joined = sep.join(self)
+        elif self.size == size:
+            return self.joined
+        else:
+            self.joined = sep.join([self.joined, *islice(self, self.size, None)])
+        self.sep = sep
+        self.size = size
+        return self.joined
+
+
+class _JoinedStrings(UserString):
+    """
+    Result of `string_agg`: the strings of a group, which are only joined when the
+    result is used (e.g. when it is written), instead of on every row of the group.
+    Strings derived from it (e.g. by `upper` or slicing) hold their value.
+    Pickled as a `str`.
+    """
+
+    def __init__(self, strings, sep=None):
+        self.strings = strings
+        self.sep = sep
+
+    @property
+    def data(self):
+        return self.strings if self.sep is None else self.strings.join(self.sep)
+
+    def __reduce__(self):
+        return str, (self.data,)
+
+
+def _join_strings(row):
+    """Converts the results of `string_agg` in a row (tuple) into strings"""
+    return tuple(str(val) if isinstance(val, _JoinedStrings) else val for val in row)
+
+
+def _add_pairs(prev, cur):
+    # (sum, count) pairs of averages
+    return (prev[0] + cur[0], prev[1] + cur[1])
+
+
+class _Window:
+    """
+    Sliding window over the rows of a group: the last `size` rows or, when `by_time`,
+    the rows whose time is within `size` of the time of the last row (rows should be
+    sorted by time), excluding rows without time.
+    Keeps the (key, value) pairs needed to calculate the aggregate of the window, where
+    keys are row numbers (within the group) or times, so that each row is added and
+    evicted once.
+    """
+
+    __slots__ = ("size", "by_time", "last", "items")
+
+    def __init__(self, size, by_time):
+        self.size = size
+        self.by_time = by_time
+        self.last = Null if by_time else 0  # key of the last row
+        self.items = deque()
+
+    def push(self, val, time=Null):
+        """Adds a row to the window (NULL values are not kept)"""
+        if self.by_time:
+            if time is Null:
+                return
+            self.last = time
+        else:
+            self.last = self.last + 1
+        if val is not Null:
+            self.add(self.last, val)
+        self.evict()
+
+    def evict(self):
+        start = self.last - self.size
+        items = self.items
+        while items and items[0][0] <= start:
+            self.remove(items.popleft()[1])
+
+    def merge(self, other):
+        """Adds the rows of a window over the following rows of the group"""
+        offset = 0 if self.by_time else self.last
+        for key, val in other.items:
+            self.add(key + offset, val)
+        if not self.by_time:
+            self.last = self.last + other.last
+        elif other.last is not Null:
+            self.last = other.last
+        if self.last is not Null:
+            self.evict()
+        return self
+
+    def add(self, key, val):
+        self.items.append((key, val))
+
+    def remove(self, val):
+        pass
+
+
+class _SumWindow(_Window):
+    """Sum and count of the non-null values of a sliding window"""
+
+    __slots__ = ("total", "count")
+
+    def __init__(self, size, by_time):
+        super().__init__(size, by_time)
+        self.total = 0
+        self.count = 0
+
+    def add(self, key, val):
+        self.items.append((key, val))
+        self.total = self.total + val
+        self.count = self.count + 1
+
+    def remove(self, val):
+        self.count = self.count - 1
+        # starts over when empty, so that rounding errors do not pile up
+        self.total = self.total - val if self.count else 0
+
+
+class _ExtremeWindow(_Window):
+    """
+    Minimum (or maximum, when `reverse`) of the non-null values of a sliding window.
+    Only keeps the values that might become the extreme of the window (i.e. with no
+    smaller/larger value after them), which are sorted, the first one being the
+    extreme.
+    """
+
+    __slots__ = ("reverse",)
+
+    def __init__(self, size, by_time, reverse=False):
+        super().__init__(size, by_time)
+        self.reverse = reverse
+
+    def add(self, key, val):
+        items = self.items
+        if self.reverse:
+            while items and items[-1][1] <= val:
+                items.pop()
+        else:
+            while items and items[-1][1] >= val:
+                items.pop()
+        items.append((key, val))
+
+    def value(self):
+        return self.items[0][1] if self.items else Null
+
+
+def _merge_windows(prev, cur):
+    return prev.merge(cur)
+
+
+def _agg_window(slot, cls, val, size, time, *args):
+    """
+    Returns the sliding window of the current group in `slot`, after adding the
+    current row (see `_Window`)
+    """
+    window = _agg_collection(slot, _merge_windows, cls, size, time is not None, *args)
+    if not _replay:
+        window.push(val, Null if time is None else time)
+    return window
+
+
 # Aggregation functions
 
 
-def sum_agg(val):
+def sum_agg(val, *, _slot=None):
     """Sum of all non-null input values"""
-    return _agg_op(operator.add, val)
+    return _agg_op(_slot, operator.add, val)
 
 
-def prod_agg(val):
+def prod_agg(val, *, _slot=None):
     """Product across all non-null input values"""
-    return _agg_op(operator.mul, val)
+    return _agg_op(_slot, operator.mul, val)
 
 
-def count_agg(val):
+def count_agg(val, *, _slot=None):
     """Count all non-null input values"""
     """`count_agg(*)` counts the number of input rows"""
-    return sum_agg(0 if val is Null else 1)
+    return sum_agg(0 if val is Null else 1, _slot=_slot)
 
 
-def avg_agg(val):
+def avg_agg(val, *, _slot=None):
     """Average all non-null input values"""
-    return sum_agg(val) / count_agg(val)
+    res = _agg_op(_slot, _add_pairs, Null if val is Null else (val, 1))
+    return Null if res is Null else res[0] / res[1]
 
 
-def min_agg(val):
+def min_agg(val, *, _slot=None):
     """Minimum value across all non-null input values"""
-    return _agg_op(min, val)
+    return _agg_op(_slot, min, val)
 
 
-def max_agg(val):
+def max_agg(val, *, _slot=None):
     """Maximum value across all non-null input values"""
-    return _agg_op(max, val)
+    return _agg_op(_slot, max, val)
 
 
-def list_agg(val, respect_nulls=True):
+def list_agg(val, respect_nulls=True, *, _slot=None):
     """
     Collects all input values into a list.
     Filters out NULLs when `respect_nulls` is `False`.
     """
-    vals = sum_agg([val] if respect_nulls or val is not Null else Null)
-    return [] if vals is Null else vals  # guarantees that result is always an array
+    vals = _agg_collection(_slot, _extend, list)
+    if not _replay and (respect_nulls or val is not Null):
+        vals.append(val)
+    # values are added in place, so partial results need their own list
+    return list(vals) if _partials else vals
 
 
-def string_agg(val, sep, respect_nulls=False):
+def string_agg(val, sep, respect_nulls=False, *, _slot=None):
     """
     Concatenates all input values into a string.
     Uses `sep` to separate values in the string.
     Filters out NULLs when `respect_nulls` is `False` (default).
     """
-    return str(sep).join(
-        sum_agg([str(val)] if respect_nulls or val is not Null else Null)
-    )
+    strings = _agg_collection(_slot, _extend, _Strings)
+    if not _replay and (respect_nulls or val is not Null):
+        strings.append(str(val))
+    if _partials:
+        return strings.join(str(sep))
+    return _JoinedStrings(strings, str(sep))
 
 
-def set_agg(val, respect_nulls=True):
+def set_agg(val, respect_nulls=True, *, _slot=None):
     """
     Collects all distinct input values into a set.
     Filters out NULLs when `respect_nulls` is `False`.
     """
-    return _agg_op(operator.or_, {val} if respect_nulls or val is not Null else set())
+    vals = _agg_collection(_slot, _update_set, set)
+    if not _replay and (respect_nulls or val is not Null):
+        vals.add(val)
+    return set(vals) if _partials else vals
 
 
-def dict_agg(key, val):
+def dict_agg(key, val, *, _slot=None):
     """
     Collects key-value pairs into a dict.
     Key must be unique and not null (null keys are discarded).
     In case of duplicated keys, the value returned is the last seen.
     """
-    return _agg_op(
-        lambda a_dict, an_entry: a_dict.updatef(an_entry),
-        qdict({key: val} if key is not Null else {}),
-    )
+    vals = _agg_collection(_slot, _update_dict, _new_qdict)
+    if not _replay and key is not Null:
+        vals[key] = val
+    return qdict(vals) if _partials else vals
 
 
-def first_agg(val, respect_nulls=True):
+def first_agg(val, respect_nulls=True, *, _slot=None):
     """
     Returns the first value.
     Returns the first non-null value when `respect_nulls` is `False`.
     """
-    return _agg_op(
-        lambda prev, _: prev, [val] if respect_nulls or val is not Null else Null
-    )[0]
+    vals = _agg_op(_slot, _first, [val] if respect_nulls or val is not Null else Null)
+    return vals[0]
 
 
-def last_agg(val, respect_nulls=True):
+def last_agg(val, respect_nulls=True, *, _slot=None):
     """
     Returns the last value.
     Returns the last non-null value when `respect_nulls` is `False`.
     """
-    return _agg_op(
-        lambda _, cur: cur, [val] if respect_nulls or val is not Null else Null
-    )[0]
+    vals = _agg_op(_slot, _last, [val] if respect_nulls or val is not Null else Null)
+    return vals[0]
 
 
-def lag_agg(val, offset=1, default=Null):
+def lag_agg(val, offset=1, default=Null, *, _slot=None):
     """
     Returns the value at `offset` rows before the last row. Returns `default` if there
     is no such row.
     Especially useful with `SELECT PARTIAL` to return the value at `offset` rows before
     the current row.
     """
-    res = _agg_op(lambda prev, cur: (cur + prev)[: offset + 1], [val], default)
-    return res[-1] if len(res) > offset else Null
+    # the last `offset + 1` values (a deque keeps the last values when merged)
+    vals = _agg_collection(_slot, _extend, deque, (), offset + 1)
+    if not _replay:
+        vals.append(val)
+    return vals[0] if len(vals) > offset else default
 
 
-def count_distinct_agg(val):
+def count_distinct_agg(val, *, _slot=None):
     """Count the number of unique (non-null) input values."""
     """`count_distinct_agg(*)` counts the number of distinct rows."""
-    return len(_agg_op(operator.or_, Null if val is Null else {val}))
+    vals = _agg_collection(_slot, _update_set, set)
+    if not _replay and val is not Null:
+        vals.add(val)
+    return len(vals)
 
 
-def any_agg(val):
+def any_agg(val, *, _slot=None):
     """Returns True when there is at least one True value, ignoring NULLs"""
-    return _agg_op(operator.or_, Null if val is Null else bool(val))
+    return _agg_op(_slot, operator.or_, Null if val is Null else bool(val))
 
 
-def every_agg(val):
+def every_agg(val, *, _slot=None):
     """Returns True when all non-null values are True"""
-    return _agg_op(operator.and_, Null if val is Null else bool(val))
+    return _agg_op(_slot, operator.and_, Null if val is Null else bool(val))
+
+
+# Sliding-window aggregation functions
+
+
+def rolling_sum_agg(val, size, time=None, *, _slot=None):
+    """
+    Sum of the non-null values of the last `size` rows (including the current row).
+    When `time` is given, sums the values of the rows whose `time` is within `size`
+    of the time of the last row instead, e.g.
+    `rolling_sum_agg(bytes, timedelta(minutes=5), timestamp)`, assuming that rows are
+    sorted by time (rows with NULL time are ignored).
+    Especially useful with `SELECT PARTIALS` for moving sums.
+    """
+    window = _agg_window(_slot, _SumWindow, val, size, time)
+    return window.total if window.count else Null
+
+
+def rolling_count_agg(val, size, time=None, *, _slot=None):
+    """
+    Count the non-null values of the last `size` rows, or of the last `size` units of
+    `time` (see `rolling_sum_agg`)
+    """
+    return _agg_window(_slot, _SumWindow, val, size, time).count
+
+
+def rolling_avg_agg(val, size, time=None, *, _slot=None):
+    """
+    Average the non-null values of the last `size` rows, or of the last `size` units
+    of `time` (see `rolling_sum_agg`).
+    Especially useful with `SELECT PARTIALS` for moving averages.
+    """
+    window = _agg_window(_slot, _SumWindow, val, size, time)
+    return window.total / window.count if window.count else Null
+
+
+def rolling_min_agg(val, size, time=None, *, _slot=None):
+    """
+    Minimum value across the non-null values of the last `size` rows, or of the last
+    `size` units of `time` (see `rolling_sum_agg`)
+    """
+    return _agg_window(_slot, _ExtremeWindow, val, size, time).value()
+
+
+def rolling_max_agg(val, size, time=None, *, _slot=None):
+    """
+    Maximum value across the non-null values of the last `size` rows, or of the last
+    `size` units of `time` (see `rolling_sum_agg`)
+    """
+    return _agg_window(_slot, _ExtremeWindow, val, size, time, True).value()
@@ -55,6 +55,26 @@ def parse_options(ctx, param, options):
     is_flag=True,
     help="Force output to be unbuffered.",
 )
+@click.option(
+    "--workers",
+    "-w",
+    "workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help=(
+        "Number of processes that run the query in parallel. Only applies to queries"
+        " over JSON lines or text files where each row is processed independently"
+        " (e.g. filtering), otherwise the query runs in a single process."
+    ),
+)
+@click.option(
+    "--unordered",
+    is_flag=True,
+    help=(
+        "Write output rows of parallel queries as soon as they are available, instead"
+        " of in the order of the input."
+    ),
+)
 @click.option(
     "--verbose",
     "-v",
@@ -78,7 +98,15 @@ def parse_options(ctx, param, options):
 )
 @click.version_option(version=spyql.__version__)
 def main(
-    query, warning_flag, verbose, unbuffered, input_opt, output_opt, json_obj_files
+    query,
+    warning_flag,
+    verbose,
+    workers,
+    unordered,
+    unbuffered,
+    input_opt,
+    output_opt,
+    json_obj_files,
 ):
     """
     Tool to run a SpyQL QUERY over text data.
@@ -98,6 +126,11 @@ def main(
         [ TO csv | orjson | json | spy | sql | pretty | plot ]
     """
 
+    if workers:
+        input_opt["workers"] = workers
+    if unordered:
+        input_opt["ordered"] = False
+
     out = Query(
         query,
         input_opt,
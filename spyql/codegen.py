@@ -0,0 +1,860 @@
+"""
+Generation of the python code that runs a query.
+The whole query pipeline (explode, filter, group, project, sort keys) is compiled into
+a single python function that loops over the input rows, keeping the values of each
+row in local variables (instead of evaluating each clause separately).
+"""
+
+import ast
+import copy
+import datetime
+import math
+import re
+import types
+
+from spyql.nulltype import NullType
+
+QUERY_FUNC_NAME = "_spyql_query"
+QUERY_FILENAME = "<spyql query>"
+
+
+class CodeWriter:
+    """Helper for writing indented python source code line by line"""
+
+    def __init__(self):
+        self.lines = []
+        self.line_clauses = {}  # maps line numbers (1-based) to query clauses
+        self.level = 0
+
+    def write(self, code, clause=None):
+        self.lines.append("    " * self.level + code)
+        if clause:
+            self.line_clauses[len(self.lines)] = clause
+
+    def indent(self):
+        self.level = self.level + 1
+
+    def dedent(self):
+        self.level = self.level - 1
+
+    def source(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class QueryCode:
+    """
+    Source code of the function that runs a query (compiled once, so that the
+    function can be defined again with other variables), and the map of each line of
+    code to the clause it belongs to (for error reporting).
+    """
+
+    # arguments of the generated function, besides the input rows and the number of
+    # rows read before the first data row (e.g. header)
+    HELPERS = [
+        "_handle_result",
+        "_handle_results",
+        "_batches",
+        "_start_new_agg_row",
+        "_isiterable",
+        "_invalid_explode",
+        "_take_offset",
+    ]
+
+    def __init__(self, source, line_clauses):
+        self.source = source
+        self.line_clauses = line_clauses
+        self.code = compile(source, QUERY_FILENAME, "exec")
+
+    def clause_at(self, lineno):
+        """Returns the clause of the query that generated a given line of code"""
+        return self.line_clauses.get(lineno)
+
+    def make_function(self, vars):
+        """
+        Defines the query function using `vars` as its global scope
+        (i.e. imports, functions and user variables that queries can access)
+        """
+        exec(self.code, vars)
+        return vars.pop(QUERY_FUNC_NAME)
+
+
+def references(expr, name):
+    """Returns True if the python expression `expr` references the variable `name`"""
+    return expr is not None and re.search(rf"(?<![\w\.]){name}\b", expr) is not None
+
+
+def assigns_variables(expr):
+    """Returns True if the python expression `expr` assigns variables (`:=`)"""
+    if expr is None or ":=" not in expr:
+        return False
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        return True  # reported when compiling the query
+    return any(isinstance(node, ast.NamedExpr) for node in ast.walk(tree))
+
+
+class Source:
+    """
+    Source code of a python expression, for getting the code of the nodes of its
+    syntax tree (faster than `ast.get_source_segment` on long expressions)
+    """
+
+    def __init__(self, expr):
+        self.lines = expr.split("\n")
+        self.line_starts = [0]
+        for line in self.lines:
+            self.line_starts.append(self.line_starts[-1] + len(line) + 1)
+        self.expr = expr
+        self.isascii = expr.isascii()
+
+    def offset(self, lineno, col_offset):
+        """Position in the expression of a line and (UTF-8) column offset"""
+        if not self.isascii:
+            line = self.lines[lineno - 1]
+            col_offset = len(line.encode()[:col_offset].decode())
+        return self.line_starts[lineno - 1] + col_offset
+
+    def span(self, node):
+        """Start and end positions of a node in the expression"""
+        return (
+            self.offset(node.lineno, node.col_offset),
+            self.offset(node.end_lineno, node.end_col_offset),
+        )
+
+    def segment(self, node):
+        """Source code of a node (None if the node has no position, e.g. operators)"""
+        if getattr(node, "end_lineno", None) is None:
+            return None
+        start, end = self.span(node)
+        return self.expr[start:end]
+
+
+# variables of the query function that change from row to row
+ROW_VARS = {
+    "_values",
+    "row",
+    "_res",
+    "_group_res",
+    "_sort_res",
+    "row_number",
+    "input_row_number",
+    "explode_it",
+    "_explode_its",
+}
+
+# functions that always return the same result for the same arguments, without side
+# effects (and without warnings, i.e. they can be evaluated before running the query)
+# (constructors of mutable values are left out: see `is_immutable`)
+PURE_FUNCS = {
+    *(abs, all, any, ascii, bin, bool, bytes, chr, divmod, format, frozenset, hash),
+    *(hex, isinstance, len, max, min, oct, ord, pow, range, repr, round, sum, tuple),
+    *(re.compile, re.escape, re.match, re.fullmatch, re.search, re.findall, re.split),
+    *(re.sub, re.subn),
+    *(datetime.datetime, datetime.date, datetime.time, datetime.timedelta),
+    datetime.timezone,
+    *(f for f in vars(math).values() if callable(f)),
+}
+# types whose methods are pure (except the ones returning iterators)
+PURE_METHODS_TYPES = (
+    str,
+    bytes,
+    int,
+    float,
+    complex,
+    tuple,
+    frozenset,
+    re.Pattern,
+    datetime.date,
+    datetime.time,
+    datetime.timedelta,
+)
+NOT_PURE_METHODS = {"finditer", "scanner"}
+# pure methods of mutable containers
+PURE_CONTAINER_METHODS = {
+    *("get", "keys", "values", "items", "copy", "count", "index"),
+    *("union", "intersection", "difference", "issubset", "issuperset", "isdisjoint"),
+}
+PURE_CLASS_METHODS = {"fromisoformat", "strptime", "fromtimestamp", "combine"}
+# types of values that can be shared by all rows (read-only views of dicts included)
+IMMUTABLE_TYPES = (
+    *(str, bytes, int, float, complex, range, frozenset, re.Pattern, NullType),
+    *(datetime.date, datetime.time, datetime.timedelta, datetime.tzinfo),
+    *(type(None), type({}.keys()), type({}.values()), type({}.items())),
+)
+
+
+def is_pure(func):
+    """Returns True if `func` is a pure function (see `PURE_FUNCS`)"""
+    try:
+        if func in PURE_FUNCS:
+            return True
+    except TypeError:
+        return False  # unhashable
+    owner = getattr(func, "__self__", None)
+    name = getattr(func, "__name__", None)
+    if isinstance(owner, PURE_METHODS_TYPES):
+        return name not in NOT_PURE_METHODS
+    if isinstance(owner, (dict, list, set)):
+        return name in PURE_CONTAINER_METHODS
+    return owner in (datetime.datetime, datetime.date) and name in PURE_CLASS_METHODS
+
+
+def is_immutable(value):
+    """
+    Returns True if `value` cannot be changed by the rows using it (e.g. a string or a
+    compiled regex, but not a list), and so it can replace the expression that
+    evaluates it
+    """
+    if isinstance(value, tuple):
+        return all(is_immutable(item) for item in value)
+    if isinstance(value, IMMUTABLE_TYPES):
+        return True
+    if not callable(value):
+        return False
+    # methods are bound to their object (e.g. `list().append`)
+    owner = getattr(value, "__self__", None)
+    if owner is None or isinstance(owner, (types.ModuleType, type)):
+        return True
+    return is_immutable(owner)
+
+
+def hoist_invariants(expr, vars, consts, params=()):
+    """
+    Replaces the parts of the python expression `expr` that do not depend on the
+    row (e.g. `re.compile('^a')` or `len(lookup)`) by variables holding their values.
+    Only pure functions are called (see `PURE_FUNCS`), and parts that cannot be
+    evaluated (e.g. raise an error) or whose values are mutable (see `is_immutable`)
+    are kept, as well as parts that are not always evaluated (e.g. branches of
+    conditional expressions whose condition depends on the row).
+    `consts` maps the code of the parts that were already evaluated to their
+    variables, and new variables are added to `vars`.
+    `params` are variables whose values might change after the expression is
+    compiled (e.g. parameters of prepared queries), and so are not evaluated.
+    """
+    if not expr:
+        return expr
+    tree = ast.parse(expr, mode="eval")
+    # variables defined in the expression (e.g. in comprehensions and lambdas)
+    local_vars = {n.arg for n in ast.walk(tree) if isinstance(n, ast.arg)}
+    local_vars.update(
+        n.id
+        for n in ast.walk(tree)
+        if isinstance(n, ast.Name) and not isinstance(n.ctx, ast.Load)
+    )
+    values = {}  # values of the invariant parts of the expression
+
+    def evaluate_children(node):
+        """
+        Evaluates the children of `node` that are evaluated whenever `node` is,
+        returning True if all of them are evaluated (i.e. are invariant).
+        Branches of conditional expressions and operands of boolean operations are
+        only evaluated when they are always taken.
+        """
+        if isinstance(node, ast.IfExp):
+            if not evaluate(node.test):
+                return False
+            return evaluate(node.body if values[node.test] else node.orelse)
+        if isinstance(node, ast.BoolOp):
+            for operand in node.values:
+                if not evaluate(operand):
+                    return False
+                if bool(values[operand]) == isinstance(node.op, ast.Or):
+                    break  # short-circuits
+            return True
+        return all([evaluate(child) for child in ast.iter_child_nodes(node)])
+
+    def substitute(node, names):
+        """Replaces the evaluated children of `node` by names bound to their values"""
+        if isinstance(node, list):
+            return [substitute(child, names) for child in node]
+        if isinstance(node, ast.keyword):
+            return ast.keyword(arg=node.arg, value=substitute(node.value, names))
+        if node not in values:
+            return node
+        name = f"_value{len(names)}"
+        names[name] = values[node]
+        return ast.Name(id=name, ctx=ast.Load())
+
+    def evaluate(node):
+        """Evaluates `node` if it is invariant, returning True if so"""
+        if not evaluate_children(node):
+            return False
+        if not isinstance(node, ast.expr):
+            return True  # e.g. operators and keyword arguments
+        if isinstance(
+            node,
+            (ast.Lambda, ast.NamedExpr, ast.ListComp, ast.SetComp, ast.DictComp),
+        ) or isinstance(node, ast.GeneratorExp):
+            return False
+        try:
+            if isinstance(node, ast.Name):
+                if node.id in ROW_VARS or node.id in local_vars or node.id in params:
+                    return False
+            elif isinstance(node, ast.Call):
+                if not is_pure(values[node.func]):
+                    return False
+            elif isinstance(node, ast.Attribute):
+                obj = values[node.value]
+                # in dicts, attributes are keys, and a qdict warns about missing keys
+                if isinstance(obj, dict) and not hasattr(type(obj), node.attr):
+                    return False
+            elif isinstance(node, ast.Subscript):
+                obj, key = values[node.value], values[node.slice]
+                if isinstance(obj, dict) and key not in obj:
+                    return False
+            if isinstance(node, ast.Constant):
+                values[node] = node.value
+            elif isinstance(node, ast.IfExp):
+                branch = node.body if values[node.test] else node.orelse
+                values[node] = values[branch]
+            elif isinstance(node, ast.BoolOp):
+                # the value of the last operand that was evaluated
+                values[node] = values[[n for n in node.values if n in values][-1]]
+            else:
+                # evaluated over the values of its children (i.e. without evaluating
+                # them again)
+                names = {}
+                shallow = copy.copy(node)
+                for field, child in ast.iter_fields(node):
+                    setattr(shallow, field, substitute(child, names))
+                code = ast.fix_missing_locations(ast.Expression(shallow))
+                values[node] = eval(compile(code, "<invariant>", "eval"), vars, names)
+        except Exception:
+            return False
+        return True
+
+    evaluate(tree.body)
+
+    def does_work(node, types=(ast.Call, ast.Subscript, ast.Attribute)):
+        return any(isinstance(n, types) for n in ast.walk(node))
+
+    # replaces the largest invariant parts, besides accesses to variables
+    source = Source(expr)
+    parents = {
+        child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)
+    }
+    hoisted = {node for node, value in values.items() if is_immutable(value)}
+
+    def inside_hoisted(node):
+        node = parents.get(node)
+        while node in values:
+            if node in hoisted:
+                return True
+            node = parents.get(node)
+        return False
+
+    replacements = []
+    for node in sorted(hoisted, key=source.span):  # in order of the expression
+        if inside_hoisted(node):
+            continue
+        parent = parents.get(node)
+        if isinstance(parent, ast.Call) and parent.func is node:
+            # e.g. `re.compile('a').match(col1)`, but not `f(col1)` or `re.match(...)`
+            if not does_work(node, (ast.Call, ast.Subscript)):
+                continue
+        elif not does_work(node):
+            continue
+        code = source.segment(node)
+        if code not in consts:
+            consts[code] = f"_const{len(consts)}"
+            vars[consts[code]] = values[node]
+        replacements.append((*source.span(node), consts[code]))
+    for start, end, name in sorted(replacements, reverse=True):
+        expr = expr[:start] + name + expr[end:]
+    return expr
+
+
+def access_path(node):
+    """
+    Returns the variable and the sequence of keys (constant subscripts or attributes)
+    of an access like `_values[0]['a'].b`, or None if the expression is not an
+    access. Keys after a non-constant subscript (e.g. `x[i]`) are not included.
+    """
+    keys = []
+    while isinstance(node, (ast.Subscript, ast.Attribute)):
+        if isinstance(node, ast.Attribute):
+            keys.append(node.attr)
+        elif isinstance(node.slice, ast.Constant):
+            keys.append(node.slice.value)
+        else:
+            keys = []  # the path ends at the non-constant subscript
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    return (node.id, *reversed(keys))
+
+
+def accessed_paths(expr, aliases):
+    """
+    Returns the paths of all data accessed by the python expression `expr` (see
+    `access_path`). `aliases` maps variables to the paths they refer to.
+    """
+    tree = ast.parse(expr, mode="eval")
+    parents = {
+        child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)
+    }
+    paths = []
+    for node in ast.walk(tree):
+        parent = parents.get(node)
+        if isinstance(parent, (ast.Subscript, ast.Attribute)) and parent.value is node:
+            continue  # not the full access
+        path = access_path(node)
+        if not path:
+            continue
+        if isinstance(node, ast.Attribute) and isinstance(parent, ast.Call):
+            path = path[:-1]  # method call, e.g. `json.get('a')`
+        if path[0] in aliases:
+            path = aliases[path[0]] + path[1:]
+        paths.append(path)
+    return paths
+
+
+def row_aliases(row=None):
+    """
+    Returns the paths of the data that variables refer to (see `accessed_paths`),
+    given the expression that builds the `row` variable
+    """
+    if not row:
+        return {}
+    row_path = access_path(ast.parse(row, mode="eval").body)
+    # the row might be a new dict of all input columns: any access to it is handled
+    # as an access to all columns
+    return {"row": row_path if row_path else ("_values",)}
+
+
+def explode_conflicts(explode, aliases):
+    """
+    Returns a function that tells if a path (see `accessed_paths`) is affected by
+    exploding: the exploded path itself, its elements, or the objects containing it
+    """
+    explode_path = access_path(ast.parse(explode, mode="eval").body)
+    if not explode_path:
+        return lambda path: True
+    if explode_path[0] in aliases:
+        explode_path = aliases[explode_path[0]] + explode_path[1:]
+
+    def conflicts(path):
+        n = min(len(path), len(explode_path))
+        return path[:n] == explode_path[:n]
+
+    return conflicts
+
+
+def split_where(where, explode, row=None):
+    """
+    Splits the WHERE clause of a query with EXPLODE in two conditions: the first
+    one is evaluated once per input row, before exploding, while the second is
+    evaluated for each exploded row.
+    The first condition gets the leading conjuncts (`a and b and ...`) that do not
+    access the exploded path (neither its elements nor the objects containing it).
+    Conjuncts that assign variables (e.g. `(j := json)`) are evaluated for each
+    exploded row, since their variables might be used by other clauses.
+    """
+    aliases = row_aliases(row)
+    conflicts = explode_conflicts(explode, aliases)
+
+    tree = ast.parse(where, mode="eval").body
+    nodes = (
+        tree.values
+        if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And)
+        else [tree]
+    )
+    # segments lose the parentheses around them (e.g. of `(j := json)`)
+    source = Source(where)
+    conjuncts = [f"({source.segment(c)})" for c in nodes]
+    n_before = 0
+    for node, conjunct in zip(nodes, conjuncts):
+        if any(isinstance(n, ast.NamedExpr) for n in ast.walk(node)):
+            break
+        paths = accessed_paths(conjunct, aliases)
+        if any(p[0] in {"row_number", "explode_it"} or conflicts(p) for p in paths):
+            break
+        n_before += 1
+    before = " and ".join(conjuncts[:n_before])
+    after = " and ".join(conjuncts[n_before:])
+    return before or None, after or None
+
+
+def always_evaluated(node):
+    """
+    Yields the nodes of an expression's syntax tree that are evaluated whenever the
+    expression is evaluated (e.g. excludes the 2nd operand of `and`)
+    """
+    yield node
+    if isinstance(node, ast.BoolOp):
+        children = node.values[:1]
+    elif isinstance(node, ast.IfExp):
+        children = [node.test]
+    elif isinstance(node, ast.Compare):
+        # chained comparisons short-circuit after the 1st comparison
+        children = [node.left, node.comparators[0]]
+    elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        children = [node.generators[0].iter]
+    elif isinstance(node, ast.Lambda):
+        children = []
+    else:
+        children = ast.iter_child_nodes(node)
+    for child in children:
+        yield from always_evaluated(child)
+
+
+def data_accesses(expr, roots):
+    """
+    Yields the accesses to the data of a row in the python expression `expr`, i.e.
+    chains of constant subscripts and attributes over one of the `roots` variables
+    (e.g. `_values[0]['a'].b`). Each access is yielded as the list of the source
+    code of the chain and of its sub-chains, from the outermost to the innermost.
+    """
+    tree = ast.parse(expr, mode="eval")
+    source = Source(expr)
+    parents = {
+        child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)
+    }
+    for node in ast.walk(tree):
+        parent = parents.get(node)
+        if isinstance(parent, (ast.Subscript, ast.Attribute)) and parent.value is node:
+            continue  # not the full access
+        if isinstance(node, ast.Attribute) and isinstance(parent, ast.Call):
+            node = node.value  # method call, e.g. `json.get('a')`
+        chain = []
+        while isinstance(node, (ast.Subscript, ast.Attribute)):
+            if isinstance(node, ast.Subscript) and not isinstance(
+                node.slice, ast.Constant
+            ):
+                chain = []  # the access ends at the non-constant subscript
+            else:
+                chain.append(source.segment(node))
+            node = node.value
+        if isinstance(node, ast.Name) and node.id in roots:
+            if node.id == "_values":
+                chain = chain[:-1]  # accessing an input column is cheap
+            if chain:
+                yield chain
+
+
+def common_accesses(exprs, roots):
+    """
+    Returns the accesses to the data of a row (see `data_accesses`) that are
+    evaluated more than once by the given expressions.
+    Sub-chains are only included when they are evaluated more than once besides
+    being part of included chains (e.g. `json->a` is included in
+    `json->a->b, json->a->b, json->a->c`, but not in `json->a->b, json->a->b`).
+    """
+    # each occurrence of a chain is followed by the chains that contain it
+    occurrences = [
+        chain[i::-1]
+        for expr in exprs
+        if expr
+        for chain in data_accesses(expr, roots)
+        for i in range(len(chain))
+    ]
+    common = []
+    # longer chains first (i.e. chains before their sub-chains)
+    for ref in sorted({o[0] for o in occurrences}, key=len, reverse=True):
+        # a chain is evaluated once per included chain that contains it
+        evaluations = set()
+        for i, o in enumerate(occurrences):
+            if o[0] == ref:
+                evaluations.add(next((c for c in o[1:] if c in common), i))
+        if len(evaluations) > 1:
+            common.append(ref)
+    return common
+
+
+class RowCache:
+    """
+    Keeps the values of expressions that are referenced several times (e.g. casts
+    of input columns) in local variables, so that they are evaluated at most once
+    per row.
+    Expressions are evaluated right before the first clause that always evaluates
+    them, so that they are not evaluated for rows where they were not before.
+    """
+
+    def __init__(self, exprs, write, assignment="{name} = {expr}"):
+        self.names = {expr: f"_cached{i}" for i, expr in enumerate(exprs or [])}
+        self.write = write  # writes a line of code of a given clause
+        self.assignment = assignment
+        self.cached = set()
+
+    def replace(self, expr, refs):
+        """Replaces references to the expressions `refs` (a set) by their variables"""
+        if not refs:
+            return expr
+        source = Source(expr)
+        replacements = []
+        nodes = [ast.parse(expr, mode="eval").body]
+        while nodes:
+            node = nodes.pop()
+            code = source.segment(node)
+            if code in refs:
+                replacements.append((*source.span(node), self.names[code]))
+            else:
+                nodes.extend(ast.iter_child_nodes(node))
+        for start, end, name in sorted(replacements, reverse=True):
+            expr = expr[:start] + name + expr[end:]
+        return expr
+
+    def use(self, expr, clause):
+        """
+        Writes the code that evaluates the cached expressions that `expr` always
+        evaluates, and returns `expr` referencing cached values
+        """
+        if not expr or not self.names:
+            return expr
+        tree = ast.parse(expr, mode="eval")
+        source = Source(expr)
+        refs = {source.segment(node) for node in always_evaluated(tree)}
+        # shorter expressions first, since they can be part of longer ones
+        for ref in sorted(refs.intersection(self.names), key=len):
+            if ref not in self.cached:
+                self.write(
+                    self.assignment.format(
+                        name=self.names[ref], expr=self.replace(ref, self.cached)
+                    ),
+                    clause,
+                )
+                self.cached.add(ref)
+        return self.replace(expr, self.cached)
+
+    def invalidate(self, changed):
+        """
+        Discards the cached values of expressions that were `changed` (a function
+        that receives an expression)
+        """
+        self.cached = {ref for ref in self.cached if not changed(ref)}
+
+
+def make_function_header(code):
+    code.write(
+        f"def {QUERY_FUNC_NAME}(_rows, input_row_number, "
+        + ", ".join(QueryCode.HELPERS)
+        + "):"
+    )
+
+
+def make_query_code(
+    select,
+    where=None,
+    explode=None,
+    groupby=None,
+    orderby=None,
+    row=None,
+    cached=None,
+    skip_offset=False,
+):
+    """
+    Generates the query function, based on the (translated) python expressions of
+    each clause.
+    `row` is the expression that builds the `row` variable (only needed when the
+    query references it).
+    `cached` are expressions that should be evaluated at most once per row (e.g.
+    casts of input columns), see `RowCache`. Besides these, accesses to the data of
+    the row that are repeated across clauses are also evaluated once per row.
+    The generated function returns the number of input rows read (including the
+    ones read before calling it), stopping prematurely when the output handler
+    requests it (e.g. when the limit is reached).
+    If `skip_offset` is True, the function takes the OFFSET over from the output
+    handler, discarding the first eligible rows without evaluating the SELECT clause
+    (only for queries whose output rows are written as they come).
+    """
+    where_before_explode = None
+    if explode and where:
+        where_before_explode, where = split_where(where, explode, row)
+
+    code = CodeWriter()
+    make_function_header(code)
+    code.indent()
+    code.write("row_number = 0")
+    if skip_offset:
+        code.write("_offset = _take_offset()")
+    code.write("_res = ()")
+    code.write("_group_res = ()")
+    code.write("_sort_res = ()")
+    code.write("for _values in _rows:")
+    code.indent()
+    code.write("input_row_number += 1")
+    roots = ["_values", "row"] if row else ["_values"]
+    clauses = [row, explode, where_before_explode, where, groupby, select, orderby]
+    cache = RowCache((cached or []) + common_accesses(clauses, roots), code.write)
+    if row:
+        # only builds the row variable if there is a reference to it
+        code.write(f"row = {cache.use(row, 'row')}", "row")
+    if explode:
+        code.write(f"_explode_its = {cache.use(explode, 'explode')}", "explode")
+        code.write("if not _isiterable(_explode_its):")
+        code.indent()
+        code.write("_invalid_explode(_explode_its, _values, input_row_number)")
+        code.dedent()
+        if where_before_explode:
+            # filters input rows on conditions that do not depend on the exploded
+            # values, instead of testing them on every exploded row
+            where_before_explode = cache.use(where_before_explode, "where")
+            code.write(f"if not ({where_before_explode}):", "where")
+            code.indent()
+            code.write("continue")
+            code.dedent()
+        code.write("for explode_it in _explode_its:")
+        code.indent()
+        code.write(f"{explode} = explode_it", "explode")
+        # cached values of the exploded path (or of objects containing it) are
+        # outdated
+        aliases = row_aliases(row)
+        conflicts = explode_conflicts(explode, aliases)
+        cache.invalidate(
+            lambda expr: any(conflicts(p) for p in accessed_paths(expr, aliases))
+        )
+    if where:
+        # filter
+        code.write(f"if not ({cache.use(where, 'where')}):", "where")
+        code.indent()
+        code.write("continue")
+        code.dedent()
+    # input line is eligible
+    code.write("row_number += 1")
+    if skip_offset:
+        code.write("if row_number <= _offset:")
+        code.indent()
+        code.write("continue")
+        code.dedent()
+    if groupby:
+        # group by can ref output columns, but does not depend on the execution of
+        # the select clause: refs to output columns are replaced by the
+        # correspondent expression
+        code.write(f"_group_res = {cache.use(groupby, 'group by')}", "group by")
+        # we need to set the group key before running the select because aggregate
+        # functions need to know the group key beforehand
+        code.write("_start_new_agg_row(_group_res)")
+    # calculate outputs
+    code.write(f"_res = {cache.use(select, 'select')}", "select")
+    if orderby:
+        # in the order by clause, references to output columns use the outputs of
+        # the evaluation of the select expression
+        code.write(f"_sort_res = {cache.use(orderby, 'order by')}", "order by")
+    code.write("if _handle_result(_res, _sort_res, _group_res):")
+    code.indent()
+    # e.g. when reached limit
+    code.write("return input_row_number")
+    code.dedent()
+    code.dedent()
+    if explode:
+        code.dedent()
+    code.write("return input_row_number")
+
+    return QueryCode(code.source(), code.line_clauses)
+
+
+def can_run_in_batches(select, where=None, explode=None, groupby=None, orderby=None):
+    """
+    Returns True if the query can be evaluated over batches of rows with
+    `make_batch_query_code`: simple queries that filter and project rows, where each
+    output row only depends on its input row.
+    """
+    return (
+        not (explode or groupby or orderby)
+        and not references(select, "input_row_number")
+        and not references(where, "input_row_number")
+        # in the where clause, `row_number` is the number of previous eligible rows
+        and not references(where, "row_number")
+        # rows might be filtered before the SELECT clause is evaluated for any of them,
+        # and so it would not see the variables assigned by the WHERE clause of its row
+        and not assigns_variables(where)
+    )
+
+
+def make_batch_query_code(select, where=None, row=None, cached=None, skip_offset=False):
+    """
+    Alternative to `make_query_code` that evaluates the query over batches of rows,
+    using list comprehensions to filter and project all rows of a batch, and handing
+    the results of the whole batch to the output handler at once.
+    Should only be used when `can_run_in_batches` is True.
+    The number of input rows returned by the function includes all rows of the last
+    batch, even when the output handler requests to stop in the middle of it.
+    If `skip_offset` is True, the rows discarded by OFFSET are only filtered, as in
+    `make_query_code`.
+    """
+
+    # each part of the list comprehensions is written in a different line, so that
+    # errors are reported in the right clause
+    def write_comprehension(target, expr, clause, loop, where):
+        lines = [(loop, None)]
+        roots = ["_values", "row"] if row else ["_values"]
+        cache = RowCache(
+            (cached or []) + common_accesses([row, where, expr], roots),
+            lambda *line: lines.append(line),
+            "for {name} in ({expr},)",
+        )
+        if row:
+            lines.append((f"for row in ({cache.use(row, 'row')},)", "row"))
+        if where:
+            lines.append((f"if ({cache.use(where, 'where')})", "where"))
+        expr = cache.use(expr, clause)
+        code.write(f"{target} = [")
+        code.indent()
+        code.write(expr, clause)
+        for line in lines:
+            code.write(*line)
+        code.dedent()
+        code.write("]")
+
+    def write_filter(rows):
+        """Writes the filtering of `rows`, returning the name of the eligible rows"""
+        if not where:
+            return rows
+        write_comprehension(
+            "_eligible", "_values", None, f"for _values in {rows}", where
+        )
+        return "_eligible"
+
+    def write_projection(rows, where):
+        """Writes the evaluation of the SELECT clause over `rows`"""
+        if references(select, "row_number"):
+            if where:
+                # rows need to be filtered before being numbered
+                rows = write_filter(rows)
+            write_comprehension(
+                "_results",
+                f"({select})",
+                "select",
+                f"for row_number, _values in enumerate({rows}, row_number + 1)",
+                None,
+            )
+        else:
+            write_comprehension(
+                "_results", f"({select})", "select", f"for _values in {rows}", where
+            )
+
+    code = CodeWriter()
+    make_function_header(code)
+    code.indent()
+    code.write("row_number = 0")
+    if skip_offset:
+        code.write("_offset = _take_offset()")
+    code.write("for _batch in _batches(_rows):")
+    code.indent()
+    code.write("input_row_number += len(_batch)")
+    if skip_offset:
+        code.write("if row_number < _offset:")
+        code.indent()
+        eligible = write_filter("_batch")
+        code.write(f"_skipped = min(_offset - row_number, len({eligible}))")
+        code.write("row_number += _skipped")
+        code.write(f"_eligible = {eligible}[_skipped:]")
+        write_projection("_eligible", None)
+        code.dedent()
+        code.write("else:")
+        code.indent()
+        write_projection("_batch", where)
+        code.dedent()
+    else:
+        write_projection("_batch", where)
+    code.write("row_number += len(_results)")
+    code.write("if _handle_results(_results):")
+    code.indent()
+    # e.g. when reached limit
+    code.write("return input_row_number")
+    code.dedent()
+    code.dedent()
+    code.write("return input_row_number")
+
+    return QueryCode(code.source(), code.line_clauses)
@@ -1,28 +1,95 @@
+import heapq
+import math
+import pickle
+import sys
+import tempfile
+
+from spyql import agg, log
 from spyql.nulltype import Null
 
+# maximum number of sorted runs (temporary files) that are merged at once
+MAX_RUNS = 64
+# number of rows of sorted runs that are (de)serialized at once
+RUN_BLOCK_SIZE = 1024
+# approximate memory used by each row kept for sorting (besides its values): rows are
+# kept as `(sort_keys, result)` tuples, referenced by a list
+ROW_OVERHEAD = sys.getsizeof((None, None)) + 8
+# types of values that are negated for sorting in the opposite direction (see
+# `make_sort_key`), besides NULLs
+NUMERIC_TYPES = {int, float, bool, type(Null)}
+# number of partitions of distinct rows written to temporary files
+PARTITIONS = 64
+# approximate memory used by each entry of a set (besides its value)
+SET_OVERHEAD = 2 * sys.getsizeof(0)
+# the size of 1 in every `SIZE_SAMPLING` distinct rows is estimated
+SIZE_SAMPLING = 1000
+# memory used by the filter of approximate distinct rows (in MB), by default
+BLOOM_FILTER_SIZE = 16
+
+
+def _sizeof(values):
+    """Approximate memory used by a tuple of values (not following nested values)"""
+    return sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+
 
 class OutputHandler:
     """Mediates data processing with data writting"""
 
     @staticmethod
-    def make_handler(prs):
+    def make_handler(
+        prs, max_memory=None, ordered=True, distinct_error=None, sorted_groups=False
+    ):
         """
         Chooses the right handler depending on the kind of query
-        and eventual optimization opportunities
+        and eventual optimization opportunities.
+        `max_memory` is the memory budget (in MB) of rows being sorted or
+        deduplicated, if any. If `ordered` is False, distinct rows that exceed the
+        budget might be written out of order.
+        `distinct_error` is the false positive rate of approximate distinct rows,
+        when defined (see `ApproxLineInDistinctLineOut`).
+        If `sorted_groups` is True, the input is sorted by the group key, and so the
+        results of groups are handed out as soon as the group key changes.
         """
         if prs["group by"] and not prs["partials"]:
+            if sorted_groups:
+                if not prs["order by"]:
+                    handler = LineInLineOut(prs["limit"], prs["offset"])
+                elif prs["limit"] is not None:
+                    handler = TopNSortAtEnd(
+                        prs["order by"], prs["limit"], prs["offset"]
+                    )
+                else:
+                    handler = DelayedOutSortAtEnd(
+                        prs["order by"], prs["limit"], prs["offset"], max_memory
+                    )
+                return SortedGroupsOut(handler)
             return GroupByDelayedOutSortAtEnd(
                 prs["order by"], prs["limit"], prs["offset"]
             )
         if prs["order by"]:
-            # TODO optimization: use special handler that only keeps the top n elements
-            #   in memory when LIMIT is defined
+            if prs["limit"] is not None:
+                # only keeps the top rows in memory
+                if prs["distinct"]:
+                    return DistinctTopNSortAtEnd(
+                        prs["order by"], prs["limit"], prs["offset"]
+                    )
+                return TopNSortAtEnd(prs["order by"], prs["limit"], prs["offset"])
             if prs["distinct"]:
                 return DistinctDelayedOutSortAtEnd(
                     prs["order by"], prs["limit"], prs["offset"]
                 )
-            return DelayedOutSortAtEnd(prs["order by"], prs["limit"], prs["offset"])
+            return DelayedOutSortAtEnd(
+                prs["order by"], prs["limit"], prs["offset"], max_memory
+            )
         if prs["distinct"]:
+            if distinct_error:
+                return ApproxLineInDistinctLineOut(
+                    prs["limit"], prs["offset"], distinct_error, max_memory
+                )
+            if max_memory:
+                return BoundedLineInDistinctLineOut(
+                    prs["limit"], prs["offset"], max_memory, ordered
+                )
             return LineInDistinctLineOut(prs["limit"], prs["offset"])
         return LineInLineOut(prs["limit"], prs["offset"])
 
@@ -41,6 +108,24 @@ class OutputHandler:
         """
         return self.is_done()
 
+    def handle_results(self, results):
+        """
+        Handles a batch of new output rows (without sort keys or group keys).
+        Returns True if no more results are needed (e.g. reached the limit).
+        """
+        for result in results:
+            if self.handle_result(result, (), ()):
+                return True
+        return self.is_done()
+
+    def take_offset(self):
+        """
+        Hands the number of rows to skip over to the caller, which discards them
+        itself (before evaluating them)
+        """
+        offset, self.offset = self.offset, 0
+        return offset
+
     def is_done(self):
         # premature ending
         return self.limit is not None and self.rows_written >= self.limit
@@ -52,10 +137,44 @@ class OutputHandler:
             self.writer.writerow(row)
             self.rows_written = self.rows_written + 1
 
+    def writerows(self, rows):
+        if self.offset > 0:
+            skipped = min(self.offset, len(rows))
+            self.offset = self.offset - skipped
+            rows = rows[skipped:]
+        if self.limit is not None:
+            rows = rows[: max(self.limit - self.rows_written, 0)]
+        if rows:
+            self.writer.writerows(rows)
+            self.rows_written = self.rows_written + len(rows)
+
+    def stats(self):
+        """Statistics of the handler (besides the number of rows written)"""
+        return {}
+
     def finish(self):
         self.writer.flush()
 
 
+class JoinedStringsWriter:
+    """
+    Writer that converts the results of `string_agg` into strings before handing
+    rows to `writer` (see `agg._JoinedStrings`)
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def writerow(self, row):
+        self.writer.writerow(agg._join_strings(row))
+
+    def writerows(self, rows):
+        self.writer.writerows([agg._join_strings(row) for row in rows])
+
+
 class LineInLineOut(OutputHandler):
     """Simple handler that immediately writes every processed row"""
 
@@ -63,6 +182,10 @@ class LineInLineOut(OutputHandler):
         self.write(result)
         return self.is_done()
 
+    def handle_results(self, results):
+        self.writerows(results)
+        return self.is_done()
+
     def finish(self):
         super().finish()
 
@@ -87,49 +210,489 @@ class LineInDistinctLineOut(OutputHandler):
         super().finish()
 
 
+class BloomFilter:
+    """
+    Fixed-size probabilistic set: tells if a value might have been added (with a
+    false positive rate of `error` after adding `capacity` values), or if it was
+    definitely not added. Values must be hashable.
+    """
+
+    def __init__(self, size, error):
+        self.nbits = size * 8
+        self.error = error
+        # optimal capacity and number of hash functions for the error rate
+        self.capacity = int(-self.nbits * math.log(2) ** 2 / math.log(error))
+        self.nhashes = max(round(-math.log2(error)), 1)
+        self.bits = bytearray(size)
+        self.count = 0
+
+    def positions(self, value):
+        # k hashes of the value, from 2 halves of its (64-bit) hash, which is mixed
+        # first (e.g. the hash of an int is the int itself), as in splitmix64
+        h = hash(value) & 0xFFFFFFFFFFFFFFFF
+        h = (h ^ h >> 30) * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF
+        h = (h ^ h >> 27) * 0x94D049BB133111EB & 0xFFFFFFFFFFFFFFFF
+        h = h ^ h >> 31
+        h1, h2 = h & 0xFFFFFFFF, h >> 32 | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[p >> 3] & 1 << (p & 7) for p in self.positions(value))
+
+    def add(self, value):
+        bits = self.bits
+        for p in self.positions(value):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count = self.count + 1
+
+    def estimated_error(self):
+        """Estimate of the current false positive rate (given the values added)"""
+        return (1 - math.exp(-self.nhashes * self.count / self.nbits)) ** self.nhashes
+
+
+class ApproxLineInDistinctLineOut(LineInDistinctLineOut):
+    """
+    Alters `LineInDistinctLineOut` to use constant memory (`max_memory` MB), by
+    keeping distinct rows in a Bloom filter instead of a set: rows are dropped as
+    duplicates with a false positive rate of `error` (until the filter reaches its
+    capacity, beyond which the rate increases), and duplicates are never written
+    """
+
+    def __init__(self, limit, offset, error, max_memory=None):
+        super().__init__(limit, offset)
+        size = (max_memory or BLOOM_FILTER_SIZE) * 2**20
+        if not 0 < error < 1:
+            raise TypeError(f"distinct_error must be between 0 and 1, got {error}")
+        self.output_rows = BloomFilter(size, error)
+
+    def stats(self):
+        return {
+            "distinct_error": self.output_rows.error,
+            "distinct_capacity": self.output_rows.capacity,
+            "distinct_estimated_error": self.output_rows.estimated_error(),
+        }
+
+    def finish(self):
+        log.user_info("Approximate distinct rows", self.stats())
+        super().finish()
+
+
+class BoundedLineInDistinctLineOut(LineInDistinctLineOut):
+    """
+    Alters `LineInDistinctLineOut` to limit the memory used by distinct rows (in MB).
+    When distinct rows exceed the budget, they are written to partitions in temporary
+    files (by hash), as well as all following rows, which are deduplicated one
+    partition at a time at the end. Rows are written in the order of their first
+    occurrence, unless `ordered` is False (then, rows are written by partition).
+    """
+
+    def __init__(self, limit, offset, max_memory, ordered=True):
+        super().__init__(limit, offset)
+        self.max_memory = max_memory * 2**20
+        self.ordered = ordered
+        self.row_size = 0  # approximate memory used by a distinct row
+        self.partitions = []  # temporary files (after exceeding the budget)
+        self.blocks = []  # rows to write to each partition
+        self.rows_handled = 0
+
+    def handle_result(self, result, *_):
+        if self.partitions:
+            return self.partition(result)
+        if result in self.output_rows:
+            return False  # duplicate
+
+        self.output_rows.add(result)
+        self.write(result)
+        if self.exceeds_budget(result):
+            # distinct rows were already written, following rows are partitioned
+            self.partitions = [tempfile.TemporaryFile() for _ in range(PARTITIONS)]
+            self.blocks = [[] for _ in range(PARTITIONS)]
+            for result in self.output_rows:
+                self.blocks[hash(result) % PARTITIONS].append((None, result))
+            self.output_rows.clear()
+            self.write_blocks()
+        return self.is_done()
+
+    def exceeds_budget(self, result):
+        """True if the distinct rows in memory exceed the budget (after adding one)"""
+        nrows = len(self.output_rows)
+        if nrows % SIZE_SAMPLING == 1:
+            # the size of rows is estimated from a sample of rows
+            self.row_size = max(self.row_size, SET_OVERHEAD + _sizeof(result))
+        return nrows * self.row_size > self.max_memory
+
+    def partition(self, result):
+        """Adds a row to its partition, unless it is a duplicate of a recent row"""
+        if result in self.output_rows:
+            return False  # duplicate (within the rows kept in memory)
+        self.output_rows.add(result)
+        block = self.blocks[hash(result) % PARTITIONS]
+        block.append((self.rows_handled, result))
+        self.rows_handled = self.rows_handled + 1
+        if len(block) >= RUN_BLOCK_SIZE:
+            self.write_blocks()
+        if self.exceeds_budget(result):
+            # keeping recent rows in memory is just an optimization
+            self.output_rows.clear()
+        return False
+
+    def write_blocks(self):
+        for partition, block in zip(self.partitions, self.blocks):
+            if block:
+                pickle.dump(block, partition, pickle.HIGHEST_PROTOCOL)
+                block.clear()
+
+    def distinct_partitions(self):
+        """
+        Deduplicates each partition in turn, returning the `(idx, result)` tuples of
+        the rows that were not written (in order of arrival within each partition)
+        """
+        self.write_blocks()
+        self.output_rows.clear()
+        for partition in self.partitions:
+            partition.seek(0)
+            results = set()
+            rows = []
+            for idx, result in read_run(partition):
+                if result not in results:
+                    results.add(result)
+                    if idx is not None:
+                        rows.append((idx, result))
+            partition.close()  # temporary files are deleted on close
+            yield rows
+
+    def finish(self):
+        if self.partitions and not self.is_done():
+            if self.ordered:
+                # merges the distinct rows of all partitions by order of arrival
+                runs = []
+                try:
+                    for rows in self.distinct_partitions():
+                        runs.append(tempfile.TemporaryFile())
+                        write_run(runs[-1], rows)
+                    for _, result in heapq.merge(*[read_run(run) for run in runs]):
+                        if self.is_done():
+                            break
+                        self.write(result)
+                finally:
+                    for run in runs:
+                        run.close()
+            else:
+                for rows in self.distinct_partitions():
+                    if self.is_done():
+                        break
+                    self.writerows([result for _, result in rows])
+        for partition in self.partitions:
+            partition.close()
+        super().finish()
+
+
 class DelayedOutSortAtEnd(OutputHandler):
     """
     Only writes after collecting and sorting all data.
-    Temporary implementation that reads every processed row into memory.
+    When a memory budget is defined (`max_memory`, in MB), rows are sorted and
+    written to temporary files (sorted runs) whenever they exceed the budget, and the
+    runs are merged while writing the output.
+    Rows are kept as `(sort_keys, result)` tuples, which is also how they are written
+    to the runs (without an ORDER BY clause, only the results are kept).
     """
 
-    def __init__(self, orderby, limit, offset):
+    def __init__(self, orderby, limit, offset, max_memory=None):
         super().__init__(limit, offset)
         self.orderby = orderby
+        self.sort_key = make_sort_key(orderby) if orderby else None
         self.output_rows = []
+        self.max_memory = max_memory * 2**20 if max_memory else None
+        self.memory = 0  # approximate memory used by `output_rows`
+        self.runs = []  # temporary files with sorted rows
 
     def handle_result(self, result, sort_keys, *_):
-        self.output_rows.append({"data": result, "sort_keys": sort_keys})
-        # TODO use temporary files to write `output_rows` whenever it gets too large
-        # TODO sort intermediate results before writing to a temporary file
+        self.output_rows.append((sort_keys, result) if self.orderby else result)
+        if self.max_memory is not None:
+            self.memory = (
+                self.memory + ROW_OVERHEAD + _sizeof(result) + _sizeof(sort_keys)
+            )
+            if self.memory > self.max_memory:
+                self.spill()
         return False  # no premature endings here
 
-    def finish(self):
-        # TODO read and merge previously sorted temporary files (look into heapq.merge)
-        # 1. sorts everything
-        if self.orderby:
-            for i in reversed(range(len(self.orderby))):
-                # taking advantage of list.sort being stable to sort elements from minor
-                # to major criteria (not be the most efficient way but straightforward)
-                self.output_rows.sort(
-                    key=lambda row: (
-                        # handle of NULLs based on NULLS FIRST/LAST specification
-                        (row["sort_keys"][i] is Null) != self.orderby[i]["rev_nulls"],
-                        row["sort_keys"][i],
-                    ),
-                    reverse=self.orderby[i]["rev"],  # handles ASC/DESC order
+    def sort_rows(self):
+        """Sorts the output rows (in place) according to the ORDER BY clause"""
+        rows = self.output_rows
+        # sort keys that only have numbers (or NULLs) can be sorted in any direction
+        numeric = [
+            all(type(row[0][i]) in NUMERIC_TYPES for row in rows)
+            for i in range(len(self.orderby))
+        ]
+        # usually a single sort (unless there are other keys in both directions),
+        # taking advantage of list.sort being stable to sort from minor to major keys
+        for start, end, reverse in reversed(sort_passes(self.orderby, numeric)):
+            sort_key = make_sort_key(
+                self.orderby[start:end], "row[0]", reverse, numeric, start
+            )
+            rows.sort(key=sort_key, reverse=reverse)
+
+    def spill(self):
+        """Writes the sorted output rows to a temporary file, emptying memory"""
+        self.sort_rows()
+        run = tempfile.TemporaryFile()
+        write_run(run, self.output_rows)
+        self.runs.append(run)
+        self.output_rows = []
+        self.memory = 0
+        if len(self.runs) >= MAX_RUNS:
+            # merges all runs into one, to limit the number of open files
+            run = tempfile.TemporaryFile()
+            write_run(run, self.merge(self.runs))
+            self.close_runs()
+            self.runs = [run]
+
+    def merge(self, runs, rows=()):
+        """
+        Merges sorted runs (and sorted rows), returning `(sort_keys, data)` tuples.
+        The merge is stable: on ties, rows come from the runs that were written first.
+        """
+        return heapq.merge(
+            *[read_run(run) for run in runs],
+            rows,
+            key=make_sort_key(self.orderby, "row[0]"),
+        )
+
+    def sorted_rows(self):
+        """Returns the output rows, sorted according to the ORDER BY clause"""
+        if not self.orderby:
+            return self.output_rows
+        if self.runs:
+            self.sort_rows()
+            return (result for _, result in self.merge(self.runs, self.output_rows))
+        if self.limit is not None:
+            # only the top rows are sorted
+            return [
+                result
+                for _, result in heapq.nsmallest(
+                    self.limit + self.offset,
+                    self.output_rows,
+                    key=make_sort_key(self.orderby, "row[0]"),
                 )
-        # 2. writes sorted rows to output
-        for row in self.output_rows:
-            # it would be more efficient to slice `output_rows` based on limit/offset
-            # however, this is more generic with less repeated logic and this is a
-            # temporary implementation
-            if self.is_done():
-                break
-            self.write(row["data"])
+            ]
+        self.sort_rows()
+        return [result for _, result in self.output_rows]
+
+    def close_runs(self):
+        for run in self.runs:
+            run.close()  # temporary files are deleted on close
+        self.runs = []
+
+    def finish(self):
+        try:
+            for row in self.sorted_rows():
+                # it would be more efficient to slice the sorted rows based on
+                # limit/offset, however, this is more generic with less repeated logic
+                if self.is_done():
+                    break
+                self.write(row)
+        finally:
+            self.close_runs()
         super().finish()
 
 
+def write_run(run, rows):
+    """Writes sorted rows to a temporary file, in blocks of pickled rows"""
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) >= RUN_BLOCK_SIZE:
+            pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+            block = []
+    if block:
+        pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+
+
+def read_run(run):
+    """Reads the sorted rows of a temporary file (see `write_run`)"""
+    while True:
+        try:
+            yield from pickle.load(run)
+        except EOFError:
+            return
+
+
+class Descending:
+    """Wraps a value to invert its order (e.g. for sorting in descending order)"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        # NULLs are only equal to themselves (comparing them returns NULL)
+        return self.value is other.value or self.value == other.value
+
+
+def descending(value):
+    """Inverts the order of a (non-NULL) value, negating numbers"""
+    return -value if type(value) in NUMERIC_TYPES else Descending(value)
+
+
+def make_sort_key(orderby, keys="row", reverse=False, numeric=None, start=0):
+    """
+    Makes a function that returns the key of a row for sorting it according to the
+    ORDER BY clause, given the expression of its sort `keys` (in terms of `row`).
+    The key is a tuple with a flag and a value per sort key: the flag puts NULLs
+    first or last, and values are inverted (see `descending`) when sorting them in the
+    opposite direction of the sort (`reverse` is True when sorting in descending
+    order). When sort keys are known to be `numeric`, they are simply negated.
+    `orderby` might be a part of the clause, starting at the sort key `start`.
+    The function is compiled once per sort, avoiding loops and branches per row.
+    """
+    parts = []
+    for i, crit in enumerate(orderby, start):
+        value = f"{keys}[{i}]"
+        rev = crit["rev"] != reverse
+        # NULLs go last, unless NULLS FIRST (the reverse on descending order)
+        op = "==" if rev else "!="
+        parts.append(f"({value} is Null) {op} {crit['rev_nulls']}")
+        if not rev:
+            parts.append(value)
+        elif numeric and numeric[i]:
+            parts.append(f"-{value}")
+        else:
+            parts.append(f"Null if {value} is Null else descending({value})")
+    return eval(
+        f"lambda row: ({', '.join(parts)},)",
+        {"Null": Null, "descending": descending},
+    )
+
+
+def sort_passes(orderby, numeric):
+    """
+    Splits the ORDER BY clause into the minimum number of sorts of consecutive sort
+    keys, so that no values need to be wrapped in `Descending` (which is much slower
+    to compare). Keys that are not `numeric` are sorted in their own direction.
+    Returns a list of `(start, end, reverse)` tuples.
+    """
+    passes = []
+    start = 0
+    reverse = None  # direction of the current sort (None while any works)
+    for i, crit in enumerate(orderby):
+        if numeric[i]:
+            continue
+        if reverse is not None and reverse != crit["rev"]:
+            passes.append((start, i, reverse))
+            start = i
+        reverse = crit["rev"]
+    if reverse is None:
+        reverse = orderby[0]["rev"]
+    passes.append((start, len(orderby), reverse))
+    return passes
+
+
+class TopNSortAtEnd(DelayedOutSortAtEnd):
+    """
+    Alternative to `DelayedOutSortAtEnd` when there is a LIMIT: only keeps the rows
+    that might be written (the top `limit + offset` rows) in memory, using a heap
+    whose first row is the last (in sorted order)
+    """
+
+    def __init__(self, orderby, limit, offset):
+        super().__init__(orderby, limit, offset)
+        self.size = limit + self.offset
+        self.rows_handled = 0
+
+    def handle_result(self, result, sort_keys, *_):
+        self.push(result, sort_keys)
+        return False  # no premature endings here
+
+    def push(self, result, sort_keys):
+        """
+        Adds a row to the top rows, returning the result of the row that is discarded
+        (the last of the top rows or the new row), if any
+        """
+        # the order of arrival breaks ties (keeping the sort stable)
+        key = Descending((self.sort_key(sort_keys), self.rows_handled))
+        self.rows_handled = self.rows_handled + 1
+        if len(self.output_rows) < self.size:
+            heapq.heappush(self.output_rows, (key, result))
+            return None
+        if self.output_rows and self.output_rows[0][0] < key:
+            # the row is before the last of the top rows, which is discarded
+            return heapq.heapreplace(self.output_rows, (key, result))[1]
+        return result
+
+    def sorted_rows(self):
+        # keys are unique (because of the order of arrival), so reversing the sort
+        # order of reversed keys results in the sorted order
+        return [result for _, result in sorted(self.output_rows, reverse=True)]
+
+
+class DistinctTopNSortAtEnd(TopNSortAtEnd):
+    """
+    Alters `TopNSortAtEnd` to only consider distinct results (the sort keys of a
+    result are the ones of its first occurrence).
+    Only the results of the top rows are kept, and so a result that is discarded
+    from the top rows is ranked again if it shows up again. This only makes a
+    difference when its sort keys change (i.e. do not depend on the result alone):
+    otherwise, it is discarded again.
+    """
+
+    def __init__(self, orderby, limit, offset):
+        super().__init__(orderby, limit, offset)
+        self.results = set()  # results of the top rows
+
+    def handle_result(self, result, sort_keys, *_):
+        if result not in self.results:
+            self.results.add(result)
+            discarded = self.push(result, sort_keys)
+            if discarded is not None:
+                self.results.discard(discarded)
+        return False  # no premature endings here
+
+
+class SortedGroupsOut(OutputHandler):
+    """
+    Handler of GROUP BY queries over input that is sorted (or clustered) by the group
+    key: the result of each group is handed to `output_handler` as soon as the group
+    key changes, dropping the aggregates of the group. If the input is not sorted,
+    groups whose rows are not together are handed out more than once.
+    """
+
+    def __init__(self, output_handler):
+        super().__init__(None, None)
+        self.output_handler = output_handler
+        self.group = None  # group key, result and sort keys of the current group
+
+    def set_writer(self, writer):
+        super().set_writer(writer)
+        self.output_handler.set_writer(writer)
+
+    def is_done(self):
+        return self.output_handler.is_done()
+
+    def handle_result(self, result, sort_keys, group_key):
+        group = self.group
+        self.group = (group_key, result, sort_keys)
+        if group is not None and group[0] != group_key:
+            # the previous group is complete
+            agg._drop_aggs(group[0])
+            return self.output_handler.handle_result(group[1], group[2], group[0])
+        return False
+
+    def finish(self):
+        if self.group is not None and not self.is_done():
+            self.output_handler.handle_result(*self.group[1:], self.group[0])
+        self.output_handler.finish()
+        self.rows_written = self.output_handler.rows_written
+
+    def stats(self):
+        return self.output_handler.stats()
+
+
 class GroupByDelayedOutSortAtEnd(DelayedOutSortAtEnd):
     """
     Extends `DelayedOutSortAtEnd` to only store intermediate group by results instead of
@@ -142,11 +705,18 @@ class GroupByDelayedOutSortAtEnd(DelayedOutSortAtEnd):
 
     def handle_result(self, result, sort_keys, group_key):
         # uses a dict to store intermidiate group by results instead of storing all rows
-        self.output_rows[group_key] = {"data": result, "sort_keys": sort_keys}
+        self.output_rows[group_key] = (sort_keys, result) if self.orderby else result
         return False  # no premature endings here
 
+    def sort_groups(self, group_keys):
+        """
+        Sorts the results of groups by the order of `group_keys` (e.g. when results
+        were not handled in the order of arrival of the groups)
+        """
+        self.output_rows = {key: self.output_rows[key] for key in group_keys}
+
     def finish(self):
-        #  converts output_rows dict to list so that it can be sorted and written
+        # the rows are sorted (and written) as a list
         self.output_rows = list(self.output_rows.values())
         super().finish()
 
@@ -168,8 +738,10 @@ class DistinctDelayedOutSortAtEnd(DelayedOutSortAtEnd):
         return False  # no premature endings here
 
     def finish(self):
-        # converts output_rows dict to list so that it can be sorted and written
-        self.output_rows = [
-            {"data": k, "sort_keys": v} for k, v in self.output_rows.items()
-        ]
+        # the rows are sorted (and written) as a list of `(sort_keys, result)` tuples
+        rows = self.output_rows
+        if self.orderby:
+            self.output_rows = [(keys, result) for result, keys in rows.items()]
+        else:
+            self.output_rows = list(rows)
         super().finish()
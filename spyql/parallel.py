@@ -0,0 +1,254 @@
+"""
+Parallel execution of queries over line-based input files (e.g. JSON lines).
+The input file is split into chunks of whole lines that are processed by a pool of
+worker processes, and the output rows of each chunk are written by the main process,
+in the order of the input (ordered merge) or as soon as each chunk is processed
+(unordered merge).
+On queries with aggregations, workers return the partial aggregates of each group
+(and its last row) instead of output rows. The main process merges them (in the order
+of the input) and calculates the results of each group by running the query over
+its last row, without updating the aggregates (see `agg._merge_aggs`).
+Only queries where each input row is processed independently (besides aggregations)
+can run in parallel (see `Processor.can_run_in_parallel`). Errors are reported by the
+worker where they happen, with row numbers relative to the start of the chunk.
+"""
+
+import locale
+import multiprocessing
+import os
+import sys
+
+from spyql import agg, log
+from spyql.output_handler import LineInLineOut, OutputHandler
+from spyql.processor import Processor, PreparedQuery
+from spyql.utils import RowTracker
+from spyql.writer import Writer
+
+# maximum size of a chunk of the input file, in bytes
+CHUNK_SIZE = 16 * 2**20
+# minimum number of chunks per worker (for balancing the load of the workers)
+CHUNKS_PER_WORKER = 4
+
+
+def split_file(path, nchunks, max_chunk_size=CHUNK_SIZE):
+    """
+    Splits a file into (at least `nchunks`) byte ranges aligned to line boundaries.
+    Returns a list of `(start, end)` offsets.
+    """
+    size = os.path.getsize(path)
+    chunk_size = max(min(max_chunk_size, size // nchunks), 1)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for pos in range(chunk_size, size, chunk_size):
+            if pos <= bounds[-1]:
+                continue  # a line longer than a chunk
+            # the chunk ends at the end of the line that includes its last byte
+            f.seek(pos - 1)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class FileChunk:
+    """Lines of a file between two byte offsets (aligned to line boundaries)"""
+
+    def __init__(self, path, start, end):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.start = start
+        self.end = end
+        # same encoding of files opened in text mode
+        self.encoding = locale.getpreferredencoding(False)
+
+    def __iter__(self):
+        pos = self.start
+        for line in self.file:
+            if pos >= self.end:
+                break
+            pos = pos + len(line)
+            yield line.decode(self.encoding)
+
+    def close(self):
+        self.file.close()
+
+
+class RowsWriter(Writer):
+    """Keeps the output rows of a chunk, to send them to the main process"""
+
+    def __init__(self):
+        super().__init__()
+        self.header = None
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+
+
+class GroupsCollector(OutputHandler):
+    """
+    Keeps the last row of each group (and its position), in order of arrival of the
+    groups, instead of their results
+    """
+
+    def __init__(self, tracker):
+        super().__init__(None, None)
+        self.tracker = tracker
+        self.groups = dict()
+
+    def handle_result(self, result, sort_keys, group_key):
+        self.groups[group_key] = (self.tracker.position, self.tracker.row)
+        return False
+
+
+# state of worker processes
+_worker = dict()
+
+
+def _init_worker(prs, strings, input_options, batch_size, user_query_vars, error):
+    log.error_on_warning = error
+    _worker.update(
+        prs=prs,
+        strings=strings,
+        input_options=input_options,
+        batch_size=batch_size,
+        user_query_vars=user_query_vars,
+        # the query is compiled once by each worker
+        prepared=PreparedQuery(),
+    )
+
+
+def _run_chunk(chunk):
+    """
+    Runs the query over a chunk of the input file.
+    Returns the output header (None if the chunk has no data rows), the output rows
+    and the number of input rows. On queries with aggregations, returns the first row,
+    the last row of each group, the partial aggregates (and their operations) and the
+    number of input rows.
+    """
+    path, start, end = chunk
+    processor = Processor.make_processor(
+        _worker["prs"], _worker["strings"], _worker["input_options"]
+    )
+    processor.set_engine_options(batch_size=_worker["batch_size"])
+    processor.set_prepared(_worker["prepared"], _worker["user_query_vars"].keys())
+    processor.close()
+    processor.input_file = FileChunk(path, start, end)
+    try:
+        processor.init_query_vars(_worker["user_query_vars"])
+        if processor.prs["group by"]:
+            rows = RowTracker(processor.get_input_iterator())
+            output_handler = GroupsCollector(rows)
+            output_handler.set_writer(RowsWriter())
+            nrows_in = processor.run_query(rows, output_handler)
+            return (
+                rows.first,
+                output_handler.groups,
+                agg._get_aggs(),
+                agg._get_agg_ops(),
+                nrows_in,
+            )
+        output_handler = LineInLineOut(None, None)
+        writer = RowsWriter()
+        output_handler.set_writer(writer)
+        nrows_in = processor.run_query(processor.get_input_iterator(), output_handler)
+        return writer.header, writer.rows, nrows_in
+    finally:
+        processor.input_file.close()
+
+
+def _write_rows(output_handler, results):
+    """Writes the output rows of each chunk, returning the number of input rows"""
+    nrows_in = 0
+    header = None
+    for chunk_header, rows, chunk_nrows_in in results:
+        nrows_in = nrows_in + chunk_nrows_in
+        if header is None and chunk_header is not None:
+            header = chunk_header
+            output_handler.writer.writeheader(header)
+        output_handler.handle_results(rows)
+    return nrows_in
+
+
+def _merge_groups(processor, output_handler, user_query_vars, results):
+    """
+    Merges the partial aggregates of each chunk (in the order of the input), and
+    hands the results of each group to the output handler.
+    Returns the number of input rows.
+    """
+    processor.init_query_vars(user_query_vars)
+    nrows_in = 0
+    first_row = None
+    groups = dict()  # the last row of each group (and its position)
+    for idx, (chunk_first_row, chunk_groups, aggs, ops, chunk_nrows_in) in enumerate(
+        results
+    ):
+        nrows_in = nrows_in + chunk_nrows_in
+        if first_row is None:
+            first_row = chunk_first_row
+        agg._merge_aggs(aggs, ops)
+        for key, (pos, row) in chunk_groups.items():
+            groups[key] = ((idx, pos), row)
+    if first_row is None:
+        return nrows_in  # empty input
+
+    # the query runs over the last row of each group (in the order of the input),
+    # after the first row of the input (to handle it like the query over all rows)
+    rows = dict(groups.values())
+    rows = [first_row] + [rows[pos] for pos in sorted(rows)]
+    agg._set_replay(True)
+    try:
+        processor.run_query(rows, output_handler)
+    finally:
+        agg._set_replay(False)
+    output_handler.sort_groups(groups.keys())
+    return nrows_in
+
+
+def run(processor, output_handler, user_query_vars):
+    """
+    Runs the query of `processor` over its input file with a pool of worker
+    processes, writing the results to `output_handler`.
+    Returns the number of input rows.
+    """
+    workers = processor.workers
+    # reports compile errors once (instead of once per worker)
+    for clause in ["select", "where", "explode", "group by", "order by"]:
+        processor.compile_clause(clause)
+    chunks = [
+        (processor.path, start, end)
+        for start, end in split_file(processor.path, workers * CHUNKS_PER_WORKER)
+    ]
+    log.user_debug(f"Running query on {len(chunks)} chunks with {workers} workers")
+    # forked workers inherit the variables of the query instead of unpickling them
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with context.Pool(
+        workers,
+        _init_worker,
+        (
+            processor.prs,
+            processor.strings,
+            processor.input_options,
+            processor.batch_size,
+            user_query_vars,
+            log.error_on_warning,
+        ),
+    ) as pool:
+        try:
+            if processor.prs["group by"]:
+                # aggregates are merged in the order of the input (e.g. `list_agg`)
+                results = pool.imap(_run_chunk, chunks)
+                return _merge_groups(
+                    processor, output_handler, user_query_vars, results
+                )
+            imap = pool.imap if processor.ordered else pool.imap_unordered
+            return _write_rows(output_handler, imap(_run_chunk, chunks))
+        except Exception as e:
+            # the error was already reported by the worker
+            sys.tracebacklimit = 0
+            raise e from None
@@ -1,7 +1,8 @@
 from spyql.quotes_handler import QuotesHandler
-from spyql import agg, log, utils
+from spyql import agg, codegen, log, utils
 from spyql.processor import Processor
 from spyql.writer import Writer
+import ast
 import re
 import inspect
 from typing import Dict, List, Optional
@@ -35,6 +36,11 @@ def get_agg_funcs():
 
 
 agg_funcs = get_agg_funcs()
+# calls to aggregate functions (excluding the helpers of the `agg` module)
+agg_call_re = re.compile(
+    r"(?<![\w\.])(?:%s)\s*\("
+    % "|".join(sorted(f for f in agg_funcs if not f.startswith("_")))
+)
 
 
 def extract_funcs(expr):
@@ -55,6 +61,112 @@ def throw_error_if_has_agg_func(expr, clause_name):
         )
 
 
+def closing_bracket(s, pos):
+    """
+    Returns the position of the bracket that closes the one at position `pos` (None
+    if it is not closed)
+    """
+    depth = 0
+    for i in range(pos, len(s)):
+        if s[i] in "([{":
+            depth = depth + 1
+        elif s[i] in ")]}":
+            depth = depth - 1
+            if depth == 0:
+                return i
+    return None
+
+
+def repeated_calls(expr):
+    """
+    Returns the positions of the calls in the python expression `expr` that might
+    run more than once per row: in lambdas and comprehensions (except in the iterable
+    of their first loop, which runs once)
+    """
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        return set()  # reported when compiling the query
+    source = codegen.Source(expr)
+    positions = set()
+
+    def visit(node, repeated):
+        if repeated and isinstance(node, ast.Call):
+            positions.add(source.span(node)[0])
+        if isinstance(node, ast.Lambda):
+            visit(node.args, repeated)  # default values
+            visit(node.body, True)
+        elif isinstance(
+            node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+        ):
+            first_iter = node.generators[0].iter
+            for child in ast.iter_child_nodes(node):
+                parts = [child]
+                if isinstance(child, ast.comprehension):
+                    parts = ast.iter_child_nodes(child)
+                for part in parts:
+                    visit(part, repeated if part is first_iter else True)
+        else:
+            for child in ast.iter_child_nodes(node):
+                visit(child, repeated)
+
+    visit(tree.body, False)
+    return positions
+
+
+def generator_arg_calls(expr):
+    """
+    Returns the positions of the calls in the python expression `expr` whose only
+    argument is a generator expression (e.g. `sum(x for x in y)`), which needs to be
+    parenthesized if other arguments are added
+    """
+    try:
+        tree = ast.parse(expr, mode="eval")
+    except SyntaxError:
+        return set()  # reported when compiling the query
+    source = codegen.Source(expr)
+    return {
+        source.span(node)[0]
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Call)
+        and len(node.args) == 1
+        and not node.keywords
+        and isinstance(node.args[0], ast.GeneratorExp)
+    }
+
+
+def number_agg_calls(expr, slot=0):
+    """
+    Assigns a static slot to each call to an aggregate function, in order of
+    appearance starting at `slot`, which is passed in the `_slot` argument (e.g.
+    `sum_agg(x)` becomes `sum_agg(x, _slot=0)`). Each call keeps its aggregates in its
+    slot, even if it is not called on every row (e.g. in conditional expressions).
+    Calls that might run more than once per row (e.g. `[sum_agg(x) for x in col1]`)
+    get their slots in the order they are called instead (see `agg._dynamic_slot`).
+    Returns the new expression and the next slot.
+    """
+    inserts = []
+    repeated = repeated_calls(expr)
+    generator_arg = generator_arg_calls(expr)
+    for m in agg_call_re.finditer(expr):
+        if m.start() in repeated:
+            continue
+        end = closing_bracket(expr, m.end() - 1)
+        if end is None:
+            continue  # invalid expression (reported when compiling the query)
+        args = expr[m.end() : end].strip()
+        sep = "" if not args or args.endswith(",") else ", "
+        if m.start() in generator_arg:
+            # e.g. `sum_agg(x for x in y)` becomes `sum_agg((x for x in y), _slot=0)`
+            inserts.append((m.end(), "("))
+            sep = "), "
+        inserts.append((end, f"{sep}_slot={slot}"))
+        slot = slot + 1
+    for pos, arg in sorted(inserts, reverse=True):
+        expr = expr[:pos] + arg + expr[pos:]
+    return expr, slot
+
+
 def has_reference2row(expr):
     return re.search(r"\brow\b", make_expr_ready(expr)) is not None
 
@@ -366,6 +478,15 @@ def parse(query, default_to_clause="MEMORY"):
         if prs[clause]:
             prs[clause] = parse_orderby(prs[clause], strings)
 
+    # each call to an aggregate function keeps its aggregates in its own slot (the
+    # expression without slots is kept for error messages)
+    slot = 0
+    for col in prs["select"] + (prs["order by"] or []):
+        if isinstance(col["expr"], str):
+            col["text"] = col["expr"]
+            col["expr"], slot = number_agg_calls(col["expr"], slot)
+    prs["agg_slots"] = slot
+
     for clause in {"limit", "offset"}:
         if prs[clause]:
             try:
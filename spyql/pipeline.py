@@ -0,0 +1,182 @@
+"""
+Pipelined execution of queries: reading (and decoding) the input, evaluating the
+query and writing (encoding) the output run in three threads, which exchange batches
+of rows through bounded queues. When a stage is slower than the others, the stages
+before it wait for room in the queue (backpressure) and the stages after it wait for
+new rows, instead of the whole query waiting for each stage in turn (e.g. parsing the
+input while the output pipe is full).
+The time each stage is busy (not waiting for other stages) is reported at the end.
+"""
+
+import queue
+import threading
+import time
+
+from spyql import log
+from spyql.utils import batches
+
+# number of rows exchanged between stages at once (when `batch_size` is not defined)
+BATCH_SIZE = 1000
+# maximum number of batches in each queue
+QUEUE_SIZE = 8
+# marks the end of the items of a queue
+_END = object()
+
+
+class ReaderStage(threading.Thread):
+    """
+    Reads the input rows in a thread, making them available (in batches) to the
+    evaluation stage, which iterates over this object
+    """
+
+    def __init__(self, get_rows, batch_size):
+        super().__init__(name="spyql-reader", daemon=True)
+        self.get_rows = get_rows
+        self.batch_size = batch_size
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.busy_time = 0
+        self.wait_time = 0  # time the evaluation stage waits for rows
+
+    def run(self):
+        try:
+            start = time.perf_counter()
+            for batch in batches(self.get_rows(), self.batch_size):
+                self.busy_time = self.busy_time + time.perf_counter() - start
+                if not self.put(batch):
+                    return
+                start = time.perf_counter()
+            self.busy_time = self.busy_time + time.perf_counter() - start
+            self.put(_END)
+        except BaseException as e:
+            # errors are raised by the evaluation stage
+            self.put(e)
+
+    def put(self, item):
+        """Puts an item in the queue, unless the stage is stopped while waiting"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop(self):
+        # does not wait for the thread, which might be blocked reading the input
+        self.stopped.set()
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_time = self.wait_time + time.perf_counter() - start
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield from item
+
+
+class WriterStage(threading.Thread):
+    """
+    Writes the output rows in a thread. Has the interface of a `Writer` for the
+    evaluation stage, forwarding the rows (in batches) to the actual writer.
+    """
+
+    def __init__(self, writer, batch_size):
+        super().__init__(name="spyql-writer", daemon=True)
+        self.writer = writer
+        self.batch_size = batch_size
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.rows = []
+        self.error = None
+        self.busy_time = 0
+        self.wait_time = 0  # time the evaluation stage waits for room in the queue
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if self.error:
+                continue  # keeps emptying the queue, so that the evaluation can end
+            method, args = item
+            start = time.perf_counter()
+            try:
+                method(*args)
+            except BaseException as e:
+                # errors are raised by the evaluation stage
+                self.error = e
+            self.busy_time = self.busy_time + time.perf_counter() - start
+
+    def put(self, method, *args):
+        if self.error:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put((method, args))
+        self.wait_time = self.wait_time + time.perf_counter() - start
+
+    def put_rows(self):
+        self.put(self.writer.writerows, self.rows)
+        self.rows = []
+
+    def writeheader(self, header):
+        self.put(self.writer.writeheader, header)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.put_rows()
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.put_rows()
+
+    def close(self):
+        """Writes the remaining rows and waits for the thread to finish"""
+        if self.rows and not self.error:
+            self.put_rows()
+        self.queue.put(_END)
+        self.join()
+        if self.error:
+            raise self.error
+
+
+def run(processor, output_handler, user_query_vars, tracker=None):
+    """
+    Runs the query of `processor` in a pipeline of threads, writing the results to
+    `output_handler` (results that are only written when the output handler finishes
+    are written by the calling thread).
+    `tracker` is a `RowTracker` (without rows) that keeps track of the input rows
+    being evaluated, if needed (e.g. for spilling groups, see `spill.run`).
+    Returns the number of input rows and the time each stage was busy (in seconds).
+    """
+    batch_size = processor.batch_size or BATCH_SIZE
+    writer = output_handler.writer
+    processor.init_query_vars(user_query_vars)
+    reader_stage = ReaderStage(processor.get_input_iterator, batch_size)
+    writer_stage = WriterStage(writer, batch_size)
+    output_handler.set_writer(writer_stage)
+    reader_stage.start()
+    writer_stage.start()
+    rows = reader_stage
+    if tracker is not None:
+        tracker.rows = reader_stage
+        rows = tracker
+    start = time.perf_counter()
+    try:
+        nrows_in = processor.run_query(rows, output_handler)
+        eval_time = time.perf_counter() - start
+    finally:
+        reader_stage.stop()
+        output_handler.set_writer(writer)
+        writer_stage.close()
+    busy_times = {
+        "read": reader_stage.busy_time,
+        "evaluate": eval_time - reader_stage.wait_time - writer_stage.wait_time,
+        "write": writer_stage.busy_time,
+    }
+    log.user_info("Busy time of each stage (s)", busy_times)
+    return nrows_in, busy_times
@@ -9,17 +9,46 @@ from io import StringIO
 import copy
 from typing import Tuple, Dict, Optional
 
-from spyql import agg, log, sqlfuncs
-from spyql.output_handler import OutputHandler
+from spyql import agg, codegen, log, sqlfuncs
+from spyql.output_handler import JoinedStringsWriter, OutputHandler
 from spyql.query_result import QueryResult
 from spyql.qdict import qdict
-from spyql.utils import make_str_valid_varname, isiterable, is_row_collapsable
+from spyql.utils import (
+    make_str_valid_varname,
+    isiterable,
+    is_row_collapsable,
+    batches,
+)
 from spyql.writer import Writer
 from spyql.quotes_handler import QuotesHandler
 
+# names of columns, functions, etc that might be translated in the query (quoted
+# names are keys of `->` accesses, e.g. `json['a']`, since strings are replaced by
+# placeholders)
+IDENTIFIER_RE = re.compile(r"(?<![\w\.'])\w+")
+
+# input options that are handled by the query engine (instead of the input processor)
+ENGINE_OPTIONS = (
+    "batch_size",
+    "workers",
+    "ordered",
+    "pipeline",
+    "max_memory",
+    "distinct_error",
+    "sorted_groups",
+)
+
+
+def init_vars(user_query_vars={}, base_vars=None):
+    """
+    Initializes dict of variables for user queries.
+    `base_vars` are variables initialized before (without user vars) to start from.
+    """
+    if base_vars is not None:
+        vars = dict(base_vars)
+        update_user_vars(vars, user_query_vars)
+        return vars
 
-def init_vars(user_query_vars={}):
-    """Initializes dict of variables for user queries"""
     vars = dict()
     # imports for user queries (TODO move to init.py when mature)
     exec(
@@ -48,15 +77,33 @@ def init_vars(user_query_vars={}):
     except Exception as e:
         log.user_warning(f"Could not load {init_fname}", e)
 
+    update_user_vars(vars, user_query_vars)
+    return vars
+
+
+def update_user_vars(vars, user_query_vars):
     # update the accessible vars with user defined vars, if overlap, warn the user
     for x in set(vars.keys()) & set(user_query_vars.keys()):
         log.user_warning(f"Overloading builtin name '{x}', somethings may not work!")
     vars.update(user_query_vars)
 
-    return vars
+
+class PreparedQuery:
+    """
+    State reused across runs of a prepared query: the compiled query for each input
+    schema, and the variables initialized on the first run (e.g. imports)
+    """
+
+    def __init__(self):
+        self.plans = dict()
+        self.base_vars = None
 
 
 class Processor:
+    # True if the input is a file where each line is a row (and so it can be split
+    # into chunks of lines)
+    line_based = False
+
     @staticmethod
     def input_processors():
         return {
@@ -75,21 +122,32 @@ class Processor:
         Factory for making an input processor based on the parsed query
         """
         try:
-            if not input_options:
-                input_options = {}
+            input_options = dict(input_options) if input_options else {}
             from_clause = prs["from"]
+            if isinstance(from_clause, dict):
+                input_options.update(from_clause["kwargs"])
+            # options of the query engine (common to all input processors)
+            engine_options = {
+                opt: input_options.pop(opt)
+                for opt in ENGINE_OPTIONS
+                if opt in input_options
+            }
             processor_name = ""
             if not from_clause:  # no from close, single select eval
                 processor_name = "default"
-                return Processor(prs, strings, **input_options)
+                processor = Processor(prs, strings, **input_options)
             elif isinstance(from_clause, dict):  # there's an input data processor
                 processor_name = from_clause["name"]
                 processor = Processor.input_processors()[processor_name.upper()]
-                input_options.update(from_clause["kwargs"])
-                return processor(prs, strings, *from_clause["args"], **input_options)
+                processor = processor(
+                    prs, strings, *from_clause["args"], **input_options
+                )
             else:  # python expression
                 processor_name = "python"
-                return PythonExprProcessor(prs, strings, **input_options)
+                processor = PythonExprProcessor(prs, strings, **input_options)
+            processor.set_engine_options(**engine_options)
+            processor.input_options = input_options
+            return processor
         except TypeError as e:
             log.user_error(f"Could not create '{processor_name}' processor", e)
 
@@ -110,11 +168,76 @@ class Processor:
         self.translations = copy.deepcopy(
             sqlfuncs.NULL_SAFE_FUNCS
         )  # map for alias, functions to be renamed...
+        # translations of names that are not identifiers (e.g. with spaces)
+        self.other_translations = {}
         self.has_header = False
         self.casts = dict()
         self.col_values_exprs = []
         self.writer = None
         self.query_has_reference2row = prs["hints"]["has_reference2row"]
+        self.input_options = {}
+        self.batch_size = None
+        self.workers = None
+        self.ordered = True
+        self.pipeline = False
+        self.max_memory = None
+        self.distinct_error = None
+        self.sorted_groups = False
+        self.prepared = None
+        self.params = ()
+
+    def set_engine_options(
+        self,
+        batch_size=None,
+        workers=None,
+        ordered=True,
+        pipeline=False,
+        max_memory=None,
+        distinct_error=None,
+        sorted_groups=False,
+    ):
+        """
+        Sets options of the query engine.
+        `batch_size` is the number of rows that are processed at once (in a single
+        loop) on simple queries, when defined.
+        `workers` is the number of processes that run the query in parallel, on
+        queries where rows are processed independently (see `can_run_in_parallel`).
+        If `ordered` is False, the output rows of parallel queries are written as soon
+        as they are available, instead of in the order of the input (as well as
+        distinct rows that exceed the memory budget).
+        If `pipeline` is True, reading the input, evaluating the query and writing the
+        output run in separate threads (see `spyql.pipeline`).
+        `max_memory` is the memory budget (in MB) of rows being sorted and of groups,
+        beyond which they are written to temporary files, when defined (see
+        `DelayedOutSortAtEnd` and `spyql.spill`).
+        `distinct_error` is the false positive rate of DISTINCT queries that
+        deduplicate rows approximately (in constant memory), when defined.
+        If `sorted_groups` is True, the input is sorted (or clustered) by the group
+        key, and so the results of each group are written as soon as the group key
+        changes, instead of keeping all groups in memory.
+        """
+        for name, value in [
+            ("batch_size", batch_size),
+            ("workers", workers),
+            ("max_memory", max_memory),
+        ]:
+            if value is not None and (type(value) is not int or value < 1):
+                raise TypeError(f"{name} must be a positive integer, got {value}")
+        self.batch_size = batch_size
+        self.workers = workers
+        self.ordered = ordered
+        self.pipeline = pipeline
+        self.max_memory = max_memory
+        self.distinct_error = distinct_error
+        self.sorted_groups = sorted_groups
+
+    def set_prepared(self, prepared, params=()):
+        """
+        Reuses the state of previous runs of the query (see `PreparedQuery`).
+        `params` are the names of variables whose values might change between runs.
+        """
+        self.prepared = prepared
+        self.params = frozenset(params)
 
     def close(self):
         if self.path:
@@ -153,6 +276,12 @@ class Processor:
                 dict(zip(self.input_col_names, self.col_values_exprs))
             )
 
+        self.other_translations = {
+            id: replacement
+            for id, replacement in self.translations.items()
+            if not id.isidentifier()
+        }
+
         # metadata: list of column names
         _names = self.input_col_names if self.input_col_names else default_col_names
         self.vars["_names"] = _names
@@ -163,17 +292,12 @@ class Processor:
         # code for instantiating the `row` variable, a dict of {col1: value1, ...} }
         # if the result is a single column of type dict, then returns that dict instead
         # TODO extend collapsing to Pandas, NumPy arrays, etc
-        row_expr = (
+        self.row_expr = (
             self.col_values_exprs[0]
             if is_row_collapsable(row, _names)
             else f"qdict(zip(_names, {cols_expr}))"
         )
 
-        self.row_expr = compile(row_expr, "row_expr", "eval")
-
-    def make_row_meta(self):
-        return eval(self.row_expr, self.vars, self.vars)
-
     def make_out_cols_names(self, out_cols_names):
         """
         Creates list of output column names
@@ -220,8 +344,12 @@ class Processor:
             # special case: expression is out col number (1-based)
             return [f"_res[{expr-1}]"]  # reuses existing result
 
-        for id, replacement in self.translations.items():
-            pattern = rf"(?<![\w\.])({id})\b"
+        # identifiers are replaced in a single pass over the expression
+        expr = IDENTIFIER_RE.sub(
+            lambda m: self.translations.get(m.group(), m.group()), expr
+        )
+        for id, replacement in self.other_translations.items():
+            pattern = rf"(?<![\w\.'])({id})\b"
             expr = re.compile(pattern).sub(replacement, expr)
 
         return [self.strings.put_strings_back(expr)]
@@ -236,9 +364,9 @@ class Processor:
             "order by",
         }
 
-    def compile_clause(self, clause, clause_modifier=None, mode="eval"):
+    def translate_clause(self, clause, clause_modifier=None):
         """
-        Compiles a clause of the query
+        Translates a clause of the query into a python expression (or statement)
         """
         prs_clause = self.prs[clause]
         if not prs_clause:
@@ -247,9 +375,7 @@ class Processor:
         if clause_modifier:
             prs_clause = clause_modifier.format(prs_clause)
 
-        single = self.is_clause_single(clause)
-        clause_exprs = None
-        if single:  # a clause with a single expression like WHERE
+        if self.is_clause_single(clause):  # a clause with a single expression
             clause_exprs = self.prepare_expression(prs_clause)
             if len(clause_exprs) > 1:
                 log.user_error(
@@ -259,37 +385,54 @@ class Processor:
                         " expression"
                     ),
                 )
-            clause_exprs = clause_exprs[0]
-        else:  # a clause with multiple expressions like SELECT
-            clause_exprs = [self.prepare_expression(c["expr"]) for c in prs_clause]
-            clause_exprs = [
-                item for sublist in clause_exprs for item in sublist
-            ]  # flatten (because of '*')
-            clause_exprs = ",".join(clause_exprs) + ","  # tuple constructor
+            return clause_exprs[0]
+
+        # a clause with multiple expressions like SELECT
+        clause_exprs = [self.prepare_expression(c["expr"]) for c in prs_clause]
+        clause_exprs = [
+            item for sublist in clause_exprs for item in sublist
+        ]  # flatten (because of '*')
+        return ",".join(clause_exprs) + ","  # tuple constructor
+
+    def compile_clause(self, clause, clause_modifier=None, mode="eval"):
+        """
+        Compiles a clause of the query
+        """
+        clause_exprs = self.translate_clause(clause, clause_modifier)
+        if clause_exprs is None:
+            return None  # empty clause
 
         try:
             return compile(clause_exprs, f"<{clause}>", mode)
         except Exception as main_exception:
-            if not single:
-                # breaks down clause into expressions and tries
-                # compiling one by one to detect in which expression
-                # the error happened
-                for idx, c in enumerate(prs_clause):
-                    try:
-                        expr = c["expr"]
-                        translation = self.prepare_expression(expr)
-                        for trans in translation:
-                            if not trans.strip():
-                                raise SyntaxError("empty expression")
-                            compile(trans, f"<{clause}>", mode)
-                    except Exception as expr_exception:
-                        log.user_error(
-                            f"could not compile {clause.upper()} expression #{idx+1}",
-                            expr_exception,
-                            self.strings.put_strings_back(expr),
-                        )
+            self.diagnose_compile_error(clause, mode, main_exception)
 
-            log.user_error(f"could not compile {clause.upper()} clause", main_exception)
+    def diagnose_compile_error(self, clause, mode, main_exception):
+        """
+        Reports an error when compiling a clause, trying to pinpoint the expression
+        that caused it
+        """
+        prs_clause = self.prs[clause]
+        if not self.is_clause_single(clause):
+            # breaks down clause into expressions and tries
+            # compiling one by one to detect in which expression
+            # the error happened
+            for idx, c in enumerate(prs_clause):
+                try:
+                    expr = c["expr"]
+                    translation = self.prepare_expression(expr)
+                    for trans in translation:
+                        if not trans.strip():
+                            raise SyntaxError("empty expression")
+                        compile(trans, f"<{clause}>", mode)
+                except Exception as expr_exception:
+                    log.user_error(
+                        f"could not compile {clause.upper()} expression #{idx+1}",
+                        expr_exception,
+                        self.strings.put_strings_back(c.get("text", expr)),
+                    )
+
+        log.user_error(f"could not compile {clause.upper()} clause", main_exception)
 
     def eval_clause(self, clause, clause_exprs, mode="eval"):
         """
@@ -320,7 +463,7 @@ class Processor:
                         log.user_error(
                             f"could not evaluate {clause.upper()} expression #{idx+1}",
                             expr_exception,
-                            self.strings.put_strings_back(expr),
+                            self.strings.put_strings_back(c.get("text", expr)),
                             self.vars,
                         )
 
@@ -334,34 +477,280 @@ class Processor:
     def go(
         self, output_options, user_query_vars={}
     ) -> Tuple[QueryResult, Dict[str, int]]:
-        output_handler = OutputHandler.make_handler(self.prs)
+        in_parallel = self.workers and self.workers > 1 and self.can_run_in_parallel()
+        # groups of sorted input are not kept in memory (except in parallel queries)
+        sorted_groups = self.sorted_groups and not in_parallel
+        spill_groups = (
+            not in_parallel
+            and not sorted_groups
+            and self.max_memory
+            and self.can_spill_groups()
+        )
+        if spill_groups:
+            from spyql import spill
+
+            output_handler = spill.make_handler(self.prs, self.max_memory)
+        else:
+            output_handler = OutputHandler.make_handler(
+                self.prs,
+                self.max_memory,
+                self.ordered,
+                self.distinct_error,
+                sorted_groups,
+            )
         self.writer = Writer.make_writer(self.prs["to"], output_options)
-        output_handler.set_writer(self.writer)
-        nrows_in = self._go(output_handler, user_query_vars)
+        if self.calls_string_agg():
+            output_handler.set_writer(JoinedStringsWriter(self.writer))
+        else:
+            output_handler.set_writer(self.writer)
+        busy_times = None
+        if in_parallel:
+            from spyql import parallel
+
+            nrows_in = parallel.run(self, output_handler, user_query_vars)
+        elif spill_groups:
+            nrows_in, busy_times = spill.run(self, output_handler, user_query_vars)
+        elif self.pipeline:
+            from spyql import pipeline
+
+            nrows_in, busy_times = pipeline.run(self, output_handler, user_query_vars)
+        else:
+            nrows_in = self._go(output_handler, user_query_vars)
         output_handler.finish()
         log.user_info("#rows  in", nrows_in)
         log.user_info("#rows out", output_handler.rows_written)
 
         stats = {"rows_in": nrows_in, "rows_out": output_handler.rows_written}
+        if busy_times:
+            stats["busy_time"] = busy_times
+        stats.update(output_handler.stats())
         return self.writer.result(), stats
 
+    def can_run_in_parallel(self):
+        """
+        True if the query can run in parallel over chunks of the input file: each
+        input row is processed independently (e.g. no sorting or references to row
+        numbers) besides aggregations, and the output does not depend on the rows
+        before it (e.g. no DISTINCT, or LIMIT without aggregations).
+        """
+        prs = self.prs
+        if not (self.line_based and self.path and os.path.isfile(self.path)):
+            log.user_debug("Query cannot run in parallel: input cannot be split")
+            return False
+        if (
+            prs["distinct"]
+            or prs["partials"]
+            or not prs["group by"]
+            and (prs["order by"] or prs["offset"] or prs["limit"] is not None)
+            # results of groups are calculated again over input rows, which are
+            # modified by EXPLODE
+            or prs["group by"]
+            and prs["explode"]
+        ):
+            log.user_debug("Query cannot run in parallel: rows are not independent")
+            return False
+        if self.references_row_numbers():
+            log.user_debug("Query cannot run in parallel: references row numbers")
+            return False
+        return True
+
+    def can_spill_groups(self):
+        """
+        True if the groups of the query can be written to temporary files when they
+        exceed the memory budget (see `spyql.spill`): results of groups are calculated
+        again over their last input row, which must not depend on the rows before it.
+        """
+        prs = self.prs
+        if not prs["group by"] or prs["partials"]:
+            return False
+        if prs["explode"] or self.input_options.get("vectorize"):
+            log.user_debug("Groups cannot be spilled: rows are not kept as they are")
+            return False
+        if self.references_row_numbers():
+            log.user_debug("Groups cannot be spilled: query references row numbers")
+            return False
+        return True
+
+    def can_skip_offset(self):
+        """
+        True if the rows discarded by OFFSET can be skipped without evaluating the
+        SELECT clause: each eligible row results in an output row, which is written as
+        it comes (no sorting, grouping or deduplication)
+        """
+        prs = self.prs
+        return bool(prs["offset"]) and not (
+            prs["group by"] or prs["order by"] or prs["distinct"]
+        )
+
+    def calls_string_agg(self):
+        """
+        True if the output rows might hold results of `string_agg`, which are only
+        joined when written (see `agg._JoinedStrings`)
+        """
+        prs = self.prs
+        return any(
+            codegen.references(str(c["expr"]), "string_agg") for c in prs["select"]
+        )
+
+    def references_row_numbers(self):
+        """True if any clause evaluated for each row references row numbers"""
+        prs = self.prs
+        exprs = [c["expr"] for c in prs["select"]] + [prs["where"], prs["explode"]]
+        for clause in ["group by", "order by"]:
+            exprs.extend(c["expr"] for c in prs[clause] or [])
+        return any(
+            codegen.references(str(expr), name)
+            for expr in exprs
+            if expr is not None
+            for name in ["row_number", "input_row_number"]
+        )
+
+    def translate_query(self):
+        """
+        Translates the clauses of the query that are evaluated for each input row
+        """
+        return dict(
+            select=self.translate_clause("select"),
+            where=self.translate_clause("where"),
+            explode=self.translate_clause("explode"),
+            groupby=self.translate_clause("group by"),
+            orderby=self.translate_clause("order by"),
+        )
+
+    def input_schema(self):
+        """
+        Properties of the input that the compiled query depends on (besides the query
+        itself)
+        """
+        return (
+            tuple(self.input_col_names),
+            self.n_input_cols,
+            tuple(sorted(self.casts.items())),
+            self.row_expr,
+        )
+
+    def compile_query(self):
+        """
+        Generates the function that runs the query over the input rows, reusing the
+        compiled query of previous runs over inputs with the same schema (if any)
+        """
+        plans = self.prepared.plans if self.prepared else {}
+        schema = self.input_schema()
+        if schema in plans:
+            log.user_debug("Reusing compiled query")
+        else:
+            plans[schema] = self.make_query_code()
+        self.query_code, consts = plans[schema]
+        self.vars.update(consts)
+        return self.query_code.make_function(self.vars)
+
+    def make_query_code(self):
+        """
+        Generates the code of the query function, returning it along with the values
+        evaluated in advance that it uses
+        """
+        # compiles each clause on its own first, to report errors in the clause
+        # (and expression) where they happen
+        for clause in ["select", "where", "explode", "group by", "order by"]:
+            self.compile_clause(clause)
+        self.compile_clause("explode", "{} = explode_it", mode="exec")
+
+        clauses = self.translate_query()
+        # parts of the clauses that do not depend on the row are evaluated once
+        # (except for parameters, whose values might change between runs)
+        consts = {}
+        for name in ["select", "where", "groupby", "orderby"]:
+            clauses[name] = codegen.hoist_invariants(
+                clauses[name], self.vars, consts, self.params
+            )
+        row = self.row_expr if self.query_has_reference2row else None
+        # casts of input columns are evaluated once per row, even when the columns
+        # are referenced several times
+        cached = [
+            self.col_values_exprs[i]
+            for i, cast in sorted(self.casts.items())
+            if cast in {"int_", "float_", "complex_"}
+        ]
+        skip_offset = self.can_skip_offset()
+        # with a limit, rows after the last output row should not be evaluated (e.g.
+        # they could raise errors), and so the query does not run in batches
+        if (
+            self.batch_size
+            and self.prs["limit"] is None
+            and codegen.can_run_in_batches(**clauses)
+        ):
+            log.user_debug(f"Running query in batches of {self.batch_size} rows")
+            query_code = codegen.make_batch_query_code(
+                clauses["select"], clauses["where"], row, cached, skip_offset
+            )
+        else:
+            query_code = codegen.make_query_code(
+                **clauses, row=row, cached=cached, skip_offset=skip_offset
+            )
+        log.user_debug("Generated code", query_code.source)
+        return query_code, {name: self.vars[name] for name in consts.values()}
+
+    def invalid_explode(self, explode_its, _values, input_row_number):
+        log.user_error(
+            "Invalid EXPLODE clause",
+            TypeError(
+                f"{self.prs['explode']} has type {type(explode_its)}, which"
+                " is not iterable"
+            ),
+            vars={"_values": _values, "input_row_number": input_row_number},
+        )
+
+    def handle_query_error(self, exception):
+        """
+        Reports an error raised while running the query function, pinpointing the
+        clause (and expression) where it happened
+        """
+        # finds the innermost call to the query function in the traceback
+        # (list comprehensions have their own frames), and makes the values of the
+        # row where the error happened available
+        tb = exception.__traceback__
+        query_tb = None
+        while tb:
+            if tb.tb_frame.f_code.co_filename == codegen.QUERY_FILENAME:
+                query_tb = tb
+                self.vars.update(tb.tb_frame.f_locals)
+            tb = tb.tb_next
+        if not query_tb:
+            raise exception
+        clause = self.query_code.clause_at(query_tb.tb_lineno)
+        if not clause:
+            raise exception  # not an error in the query (e.g. writer error)
+
+        if "_batch" in self.vars:
+            # in batch mode, `input_row_number` refers to the last row of the batch
+            batch = self.vars["_batch"]
+            pos = next(
+                (i for i, v in enumerate(batch) if v is self.vars.get("_values")),
+                len(batch) - 1,
+            )
+            self.vars["input_row_number"] -= len(batch) - pos - 1
+        if clause != "row":
+            self.eval_clause(clause, self.compile_clause(clause))
+        log.user_error(
+            f"could not evaluate {clause.upper()} clause", exception, vars=self.vars
+        )
+
     def _go(self, output_handler, user_query_vars):
-        select_expr = None
-        where_expr = None
-        explode_expr = None
-        explode_cmd = None
-        explode_its = [None]  # 1 element by default (no explosion)
-        groupby_expr = None
-        orderby_expr = None
-        _values = []
-        _res = tuple()
-        _group_res = tuple()
-        _sort_res = tuple()
-        row_number = 0
-        input_row_number = 0
+        self.init_query_vars(user_query_vars)
+        # should not accept more than 1 source, joins, etc (at least for now)
+        return self.run_query(self.get_input_iterator(), output_handler)
 
-        self.vars = init_vars(user_query_vars)
-        agg._init_aggs()
+    def init_query_vars(self, user_query_vars):
+        """
+        Initializes the variables that the query can access (and the aggregates)
+        """
+        if self.prepared:
+            if self.prepared.base_vars is None:
+                self.prepared.base_vars = init_vars()
+            self.vars = init_vars(user_query_vars, self.prepared.base_vars)
+        else:
+            self.vars = init_vars(user_query_vars)
+        agg._init_aggs(self.prs["agg_slots"], self.prs["partials"])
 
         # import user modules
         self.eval_clause(
@@ -370,90 +759,51 @@ class Processor:
             mode="exec",
         )
 
+    def query_helpers(self, output_handler):
+        """Functions that the query function calls (besides variables of the query)"""
+        return dict(
+            _handle_result=output_handler.handle_result,
+            _handle_results=output_handler.handle_results,
+            _batches=lambda rows: batches(rows, self.batch_size),
+            _start_new_agg_row=agg._start_new_agg_row,
+            _isiterable=isiterable,
+            _invalid_explode=self.invalid_explode,
+            _take_offset=output_handler.take_offset,
+        )
+
+    def run_query(self, rows, output_handler):
+        """
+        Runs the query over the input rows, returning the number of input rows
+        """
+        input_row_number = 0
+
         # gets user-defined output cols names (with AS alias)
         out_cols_names = [c["name"] for c in self.prs["select"]]
 
-        # should not accept more than 1 source, joins, etc (at least for now)
-        for _values in self.get_input_iterator():
+        rows = iter(rows)
+        for _values in rows:
             input_row_number = input_row_number + 1
 
-            self.vars["_values"] = _values
-            self.vars["input_row_number"] = input_row_number
-
             if not self.reading_data():
                 self.handle_header_row(_values)
                 continue
 
             # print header
-            if select_expr is None:  # 1st input data row
-                self.handle_1st_data_row(_values)
-                output_handler.writer.writeheader(
-                    self.make_out_cols_names(out_cols_names)
+            self.handle_1st_data_row(_values)
+            output_handler.writer.writeheader(self.make_out_cols_names(out_cols_names))
+            if output_handler.is_done():
+                return 0  # in case of `limit 0`
+
+            query_func = self.compile_query()
+            try:
+                input_row_number = query_func(
+                    chain([_values], rows),  # goes through the 1st data row again
+                    input_row_number - 1,
+                    **self.query_helpers(output_handler),
                 )
-                if output_handler.is_done():
-                    return 0  # in case of `limit 0`
-
-                select_expr = self.compile_clause("select")
-                where_expr = self.compile_clause("where")
-                explode_expr = self.compile_clause("explode")
-                groupby_expr = self.compile_clause("group by")
-                orderby_expr = self.compile_clause("order by")
-
-            if self.query_has_reference2row:
-                # only builds the row variable if there is a reference to it
-                self.vars["row"] = self.make_row_meta()
-
-            if explode_expr:
-                explode_its = self.eval_clause("explode", explode_expr)
-                if not isiterable(explode_its):
-                    log.user_error(
-                        "Invalid EXPLODE clause",
-                        TypeError(
-                            f"{self.prs['explode']} has type {type(explode_its)}, which"
-                            " is not iterable"
-                        ),
-                        vars=self.vars,
-                    )
-            for explode_it in explode_its:
-                if explode_expr:
-                    self.vars["explode_it"] = explode_it
-                    if not explode_cmd:
-                        explode_cmd = self.compile_clause(
-                            "explode", "{} = explode_it", mode="exec"
-                        )
-                    self.eval_clause("explode", explode_cmd, mode="exec")
-                    self.vars["_values"] = _values
-
-                # filter (opt: eventually could be done before exploding)
-                if not where_expr or self.eval_clause("where", where_expr):
-                    # input line is eligible
-                    row_number = row_number + 1
-                    self.vars["row_number"] = row_number
-
-                    if groupby_expr:
-                        # group by can ref output columns, but does not depend on the
-                        # execution of the select clause: refs to output columns are
-                        # replaced by the correspondent expression
-                        _group_res = self.eval_clause("group by", groupby_expr)
-                        # we need to set the group key before running the select because
-                        # aggregate functions need to know the group key beforehand
-                        agg._start_new_agg_row(_group_res)
-
-                    # calculate outputs
-                    _res = self.eval_clause("select", select_expr)
-
-                    if orderby_expr:
-                        # in the order by clause, references to output columns use the
-                        # outputs of the evaluation of the select expression
-                        self.vars["_res"] = _res
-                        _sort_res = self.eval_clause("order by", orderby_expr)
-
-                    is_done = output_handler.handle_result(
-                        _res, _sort_res, _group_res
-                    )  # deal with output
-                    if is_done:
-                        # e.g. when reached limit
-                        return input_row_number - (1 if self.has_header else 0)
+            except Exception as e:
+                self.handle_query_error(e)
+            break
 
         return input_row_number - (1 if self.has_header else 0)
 
@@ -479,6 +829,8 @@ class PythonExprProcessor(Processor):
 
 
 class TextProcessor(Processor):
+    line_based = True
+
     def __init__(self, prs, strings, path=None):
         super().__init__(prs, strings, path)
 
@@ -508,6 +860,8 @@ class SpyProcessor(Processor):
 
 
 class JSONProcessor(Processor):
+    line_based = True
+
     def __init__(self, prs, strings, path=None, **options):
         import json
 
@@ -529,6 +883,8 @@ class JSONProcessor(Processor):
 
 
 class ORJSONProcessor(Processor):
+    line_based = True
+
     def __init__(self, prs, strings, path=None, **options):
         super().__init__(prs, strings, path)
         try:
@@ -562,14 +918,26 @@ class CSVProcessor(Processor):
         sample_size=10,
         header=None,
         infer_dtypes=True,
+        vectorize=False,
         **options,
     ):
         super().__init__(prs, strings, path)
         self.sample_size = sample_size
         self.has_header = header
         self.infer_dtypes = infer_dtypes
+        self.vectorize = vectorize
         self.options = options
         csv.reader(StringIO("test"), **self.options)  # test options
+        if vectorize:
+            try:
+                import numpy  # noqa: F401
+            except ModuleNotFoundError as e:
+                # numpy must be installed separately
+                log.user_error(
+                    "`numpy` module not found. You might need to install it",
+                    e,
+                    "pip3 install numpy",
+                )
 
     def _test_dtype(self, v):
         v = v.strip()
@@ -641,6 +1009,34 @@ class CSVProcessor(Processor):
             csv.reader(self.input_file, **self.options),
         )  # continues to the rest of the file
 
+    def compile_query(self):
+        query_func = super().compile_query()
+        if not self.vectorize:
+            return query_func
+
+        from spyql import vectorized
+
+        # the vectorized engine does not keep track of row numbers
+        clauses = self.translate_query()
+        if (
+            self.prs["explode"]
+            or self.prs["partials"]
+            or any(
+                codegen.references(expr, name)
+                for expr in clauses.values()
+                for name in ["row_number", "input_row_number"]
+            )
+        ):
+            log.user_debug("Query cannot be vectorized")
+            return query_func
+        try:
+            return vectorized.VectorizedQuery(
+                query_func, clauses, self.casts, self.vars, self.batch_size
+            )
+        except vectorized.NotVectorizable as e:
+            log.user_debug("Query cannot be vectorized", e)
+            return query_func
+
     def reading_data(self):
         return (not self.has_header) or (self.input_col_names)
 
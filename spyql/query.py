@@ -1,7 +1,7 @@
 import logging
 from typing import Optional
 from spyql.parser import parse
-from spyql.processor import Processor
+from spyql.processor import Processor, PreparedQuery
 from spyql import log
 
 
@@ -41,6 +41,7 @@ class Query:
         warning_flag="default",
         verbose=0,
         default_to_clause="MEMORY",
+        prepared=False,
     ) -> None:
         """
         Creates a ``Query`` object (does not execute the query).
@@ -68,6 +69,10 @@ class Query:
             1 to show additional info messages;
             2 to show additional debug messages.
         :type verbose: int, optional
+        :param prepared: set to True to compile the query only once for each input
+            schema (column names and types), reusing it across calls. Variables
+            passed when calling the query (e.g. parameters) are bound on each call.
+        :type prepared: bool, optional
         """
 
         logging.basicConfig(level=(3 - verbose) * 10, format="%(message)s")
@@ -80,6 +85,7 @@ class Query:
         self.json_obj_files = json_obj_files if json_obj_files else {}
         self.unbuffered = unbuffered
         self.__stats = None
+        self.__prepared = PreparedQuery() if prepared else None
 
         log.user_debug_dict("Parsed query", self.parsed)
         log.user_debug_dict("Strings", self.strings.strings)
@@ -125,6 +131,8 @@ class Query:
                 self.strings,
                 self.input_options,
             )
+            if self.__prepared:
+                processor.set_prepared(self.__prepared, user_query_vars.keys())
             result, self.__stats = processor.go(
                 output_options=self.output_options,
                 user_query_vars=user_query_vars,
@@ -0,0 +1,232 @@
+"""
+Aggregation of GROUP BY queries under a memory budget (`max_memory`, in MB).
+Groups are kept in memory (their last input row and their aggregates) until their
+estimated size exceeds the budget. Then, all groups are written to temporary files,
+partitioned by the hash of their group key, and aggregation starts again from scratch
+(groups that show up again start new partial aggregates).
+At the end, each partition is re-aggregated in turn: the partial aggregates of each
+group are merged in the order of the input (see `agg._merge_aggs`), and the results
+of the groups are calculated by running the query over their last row, without
+updating the aggregates. Results are sorted by the ORDER BY clause and then by order
+of arrival of the groups, being written to temporary files when they exceed the
+budget as well (see `DelayedOutSortAtEnd`).
+"""
+
+import pickle
+import sys
+import tempfile
+from collections import deque
+from itertools import islice
+
+from spyql import agg
+from spyql.output_handler import (
+    ROW_OVERHEAD,
+    DelayedOutSortAtEnd,
+    OutputHandler,
+    TopNSortAtEnd,
+    _sizeof,
+)
+from spyql.utils import RowTracker
+
+# number of partitions of groups written to temporary files
+PARTITIONS = 64
+# the size of 1 in every `SIZE_SAMPLING` new groups is estimated, and the size of
+# the group of 1 in every `SIZE_SAMPLING` rows is estimated again
+SIZE_SAMPLING = 1000
+# number of items from which the size of the items of a collection is estimated
+SIZE_SAMPLE_ITEMS = 32
+# sort criteria of the position of the groups (order of arrival)
+POSITION = {"expr": None, "rev": False, "rev_nulls": False}
+
+
+def _deep_sizeof(value):
+    """
+    Approximate memory used by a value, including the items of collections (e.g. of
+    aggregates like `list_agg`), estimated from a sample of items
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        sample = islice(value.items(), SIZE_SAMPLE_ITEMS)
+        items = [sys.getsizeof(k) + sys.getsizeof(v) for k, v in sample]
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        items = list(map(sys.getsizeof, islice(value, SIZE_SAMPLE_ITEMS)))
+    else:
+        return size
+    return size + len(value) * sum(items) // max(len(items), 1)
+
+
+def make_handler(prs, max_memory):
+    """
+    Makes the handler of the results of groups, which are handed with the position of
+    each group as the last sort key
+    """
+    orderby = (prs["order by"] or []) + [POSITION]
+    if prs["limit"] is not None:
+        return TopNSortAtEnd(orderby, prs["limit"], prs["offset"])
+    return DelayedOutSortAtEnd(orderby, prs["limit"], prs["offset"], max_memory)
+
+
+class GroupsSpiller(OutputHandler):
+    """
+    Keeps the position (order of arrival) and the last row of each group, instead of
+    their results, writing groups (and their aggregates) to partitions in temporary
+    files whenever their estimated size exceeds the budget
+    """
+
+    def __init__(self, tracker, output_handler, max_memory):
+        super().__init__(None, None)
+        self.tracker = tracker
+        self.output_handler = output_handler
+        self.max_memory = max_memory * 2**20 if max_memory else None
+        self.group_size = 0  # approximate memory used by a new group and its aggregates
+        self.groups = dict()
+        self.partitions = []
+        self.nrows = 0
+        # approximate memory used by groups whose size was estimated again (as their
+        # aggregates grow, e.g. lists), and the total of their sizes beyond
+        # `group_size`
+        self.sampled_sizes = dict()
+        self.sampled_size = 0
+
+    def is_done(self):
+        return self.output_handler.is_done()  # e.g. `LIMIT 0`
+
+    def handle_result(self, result, sort_keys, group_key):
+        group = self.groups.get(group_key)
+        if group is None:
+            self.groups[group_key] = [self.tracker.position, self.tracker.row]
+        else:
+            group[1] = self.tracker.row
+        if self.max_memory is None:
+            return False
+        ngroups = len(self.groups)
+        if group is None and ngroups % SIZE_SAMPLING == 1:
+            # the size of new groups is estimated from a sample of groups
+            size = ROW_OVERHEAD + _sizeof(group_key) + _sizeof(self.tracker.row)
+            size = size + _sizeof(agg._get_aggs()[group_key])
+            self.group_size = max(self.group_size, size)
+        self.nrows = self.nrows + 1
+        if self.nrows % SIZE_SAMPLING == 0:
+            # groups with more rows (whose aggregates might grow more) are more likely
+            # to be sampled
+            size = ROW_OVERHEAD + _sizeof(group_key) + _sizeof(self.tracker.row)
+            size = size + sum(map(_deep_sizeof, agg._get_aggs()[group_key]))
+            prev_size = self.sampled_sizes.get(group_key, self.group_size)
+            self.sampled_sizes[group_key] = size
+            self.sampled_size = self.sampled_size + size - prev_size
+        if ngroups * self.group_size + self.sampled_size > self.max_memory:
+            self.spill()
+        return False
+
+    def spill(self):
+        """Writes groups (and their aggregates) to partitions, emptying memory"""
+        if not self.partitions:
+            self.partitions = [tempfile.TemporaryFile() for _ in range(PARTITIONS)]
+        groups = [[] for _ in range(PARTITIONS)]
+        for key, (position, row) in self.groups.items():
+            groups[hash(key) % PARTITIONS].append((key, position, row))
+        aggs = [dict() for _ in range(PARTITIONS)]
+        for key, value in agg._get_aggs().items():
+            aggs[hash(key) % PARTITIONS][key] = value
+        for partition, block in zip(self.partitions, zip(groups, aggs)):
+            if block[0]:
+                pickle.dump(block, partition, pickle.HIGHEST_PROTOCOL)
+        self.groups.clear()
+        agg._get_aggs().clear()
+        self.sampled_sizes.clear()
+        self.sampled_size = 0
+
+    def read_partitions(self):
+        """
+        Reads each partition in turn, returning the position and the last row of each
+        group, after merging their partial aggregates into the (empty) aggregates
+        """
+        ops = agg._get_agg_ops()
+        for partition in self.partitions:
+            partition.seek(0)
+            groups = dict()
+            agg._get_aggs().clear()
+            while True:
+                try:
+                    block_groups, block_aggs = pickle.load(partition)
+                except EOFError:
+                    break
+                for key, position, row in block_groups:
+                    group = groups.get(key)
+                    if group is None:
+                        groups[key] = [position, row]
+                    else:
+                        group[1] = row
+                # partial aggregates are read in the order of the input
+                agg._merge_aggs(block_aggs, ops)
+            partition.close()  # temporary files are deleted on close
+            yield groups
+
+    def close(self):
+        for partition in self.partitions:
+            partition.close()
+
+
+class GroupResults(OutputHandler):
+    """Hands the results of groups to an output handler, with their position"""
+
+    def __init__(self, output_handler, groups):
+        super().__init__(None, None)
+        self.output_handler = output_handler
+        self.groups = groups
+
+    def handle_result(self, result, sort_keys, group_key):
+        position = self.groups[group_key][0]
+        return self.output_handler.handle_result(result, (*sort_keys, position))
+
+
+def run(processor, output_handler, user_query_vars):
+    """
+    Runs the GROUP BY query of `processor` spilling groups to temporary files when
+    they exceed the memory budget, writing the results to `output_handler` (see
+    `make_handler`).
+    When the processor runs in `pipeline` mode, the input is read in its own thread
+    (results are only written at the end, by the calling thread).
+    Returns the number of input rows and the time each stage was busy (None if not in
+    pipeline mode).
+    """
+    rows = RowTracker(None)
+    spiller = GroupsSpiller(rows, output_handler, processor.max_memory)
+    spiller.set_writer(output_handler.writer)
+    busy_times = None
+    try:
+        if processor.pipeline:
+            from spyql import pipeline
+
+            nrows_in, busy_times = pipeline.run(
+                processor, spiller, user_query_vars, rows
+            )
+        else:
+            processor.init_query_vars(user_query_vars)
+            rows.rows = processor.get_input_iterator()
+            nrows_in = processor.run_query(rows, spiller)
+        if spiller.partitions:
+            spiller.spill()
+            partitions = spiller.read_partitions()
+        elif spiller.groups:
+            partitions = [spiller.groups]  # aggregates are still in memory
+        else:
+            return nrows_in, busy_times  # no groups (e.g. empty input)
+
+        # the results of each group are calculated over its last row
+        query_func = processor.compile_query()
+        agg._set_replay(True)
+        for groups in partitions:
+            results = GroupResults(output_handler, groups)
+            try:
+                query_func(
+                    [row for _, row in groups.values()],
+                    0,
+                    **processor.query_helpers(results),
+                )
+            except Exception as e:
+                processor.handle_query_error(e)
+        return nrows_in, busy_times
+    finally:
+        agg._set_replay(False)
+        spiller.close()
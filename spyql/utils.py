@@ -1,5 +1,6 @@
 import re
 import os
+from itertools import islice
 
 from spyql.nulltype import Null
 from collections.abc import Iterable
@@ -55,3 +56,30 @@ def is_row_collapsable(row, colnames):
 def join_paths(x, *args):
     """convienience function for os.path.join"""
     return os.path.join(x, *args)
+
+
+def batches(iterable, size):
+    """Splits `iterable` into lists of (at most) `size` elements"""
+    it = iter(iterable)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
+
+class RowTracker:
+    """Iterates over rows, keeping track of the current row and its position"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.first = None
+        self.row = None
+        self.position = -1
+
+    def __iter__(self):
+        for row in self.rows:
+            self.position = self.position + 1
+            self.row = row
+            if self.position == 0:
+                self.first = row
+            yield row
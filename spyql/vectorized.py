@@ -0,0 +1,762 @@
+"""
+Vectorized evaluation of queries over CSV data, using NumPy.
+Input rows are processed in blocks: numeric columns are parsed into arrays and the
+WHERE, SELECT and ORDER BY expressions are evaluated as array operations, instead of
+evaluating every expression row by row.
+Only a subset of python expressions is supported (arithmetic, comparisons, boolean
+operators and some aggregate functions over `int_`/`float_` columns). Queries that
+are not supported run on the (row-by-row) query function, and so does any block of
+rows that cannot be evaluated with the exact same results (e.g. division by zero,
+integer overflow), so that the outputs (and errors) are the same of the row engine.
+"""
+
+import ast
+import builtins
+import functools
+import operator
+from itertools import compress
+
+import numpy as np
+
+from spyql import agg, log, sqlfuncs
+from spyql.nulltype import Null
+from spyql.utils import batches
+
+# default number of rows in each block
+BLOCK_SIZE = 10000
+
+# integers beyond these limits are handled by the row engine (avoids overflows of
+# 64-bit integers and loss of precision when converting integers to floats)
+INT_LIMIT = 2**62
+FLOAT_INT_LIMIT = 2**53
+
+CASTS = {"int_": np.int64, "float_": np.float64}
+ARITH_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.FloorDiv: np.floor_divide,
+    ast.Mod: np.remainder,
+}
+CMP_OPS = {
+    ast.Eq: np.equal,
+    ast.NotEq: np.not_equal,
+    ast.Lt: np.less,
+    ast.LtE: np.less_equal,
+    ast.Gt: np.greater,
+    ast.GtE: np.greater_equal,
+}
+NULL_NAMES = {"NULL", "Null", "null"}
+NUMBERS = {bool, int, float}
+# aggregate functions and the aggregations they perform (averages keep a pair with
+# the sum and the count)
+AGGS = {
+    "sum_agg": ["sum"],
+    "count_agg": ["count"],
+    "avg_agg": ["sum", "count"],
+    "min_agg": ["min"],
+    "max_agg": ["max"],
+}
+# operations that aggregate partial aggregations (by aggregation)
+OPS = {"sum": operator.add, "count": operator.add, "min": min, "max": max}
+# type of the result of aggregate functions (when different from the argument)
+AGG_KINDS = {"count_agg": "i", "avg_agg": "f"}
+
+
+class NotVectorizable(Exception):
+    """The query (or a block of rows) cannot be evaluated with array operations"""
+
+
+class Vector:
+    """
+    Values of an expression for all rows of a block (or a scalar, for constants).
+    `mask` flags NULL values (None if there are no NULLs, False for scalars), and
+    `kind` is the python type of the values: bool (b), int (i), float (f) or str (s).
+    """
+
+    __slots__ = ("data", "mask", "kind")
+
+    def __init__(self, data, mask, kind):
+        self.data = data
+        self.mask = mask
+        self.kind = kind
+
+    def is_scalar(self):
+        return not isinstance(self.data, np.ndarray)
+
+    def truth(self):
+        """Truth value of each element (NULLs are False)"""
+        if self.is_scalar():
+            return bool(self.data) and not self.mask
+        data = self.data.astype(bool) if self.kind != "b" else self.data
+        return data if self.mask is None else data & ~self.mask
+
+    def numeric(self):
+        """Data for arithmetic, where booleans behave as integers (as in python)"""
+        if self.kind == "s":
+            raise NotVectorizable("arithmetic over strings")
+        if self.kind != "b":
+            return self.data
+        return int(self.data) if self.is_scalar() else self.data.astype(np.int64)
+
+    def tolist(self, n):
+        """Converts to a list of `n` python values, with NULLs in masked elements"""
+        if self.is_scalar():
+            return [Null if self.mask else self.data] * n
+        values = self.data.tolist()
+        if self.mask is not None and self.mask.any():
+            values = [Null if m else v for v, m in zip(values, self.mask.tolist())]
+        return values
+
+    def broadcast(self, n):
+        """Converts a scalar into an array with `n` elements"""
+        if not self.is_scalar():
+            return self
+        data = np.full(n, self.data, dtype=object if self.kind == "s" else None)
+        return Vector(data, None, self.kind)
+
+
+def or_masks(*masks):
+    """Combines the masks of the operands of an operation"""
+    masks = [m for m in masks if m is not None and m is not False]
+    return functools.reduce(np.logical_or, masks) if masks else None
+
+
+def max_abs(vec):
+    """Maximum absolute value of a numeric Vector (as a python number)"""
+    data = vec.numeric()
+    if vec.is_scalar():
+        return abs(data)
+    if vec.mask is not None:
+        data = data[~vec.mask]
+    result = abs(data).max() if len(data) else 0
+    return result.item() if isinstance(result, np.generic) else result
+
+
+def check_int_limits(*vecs, limit=INT_LIMIT):
+    """Raises NotVectorizable if integers are too large to be safely handled"""
+    for vec in vecs:
+        if vec.kind == "i" and max_abs(vec) >= limit:
+            raise NotVectorizable("integers out of bounds")
+
+
+def parse_column(strs, cast):
+    """
+    Parses a column of strings into a Vector.
+    Values that cannot be parsed by NumPy (e.g. empty strings) are parsed by the
+    spyql cast function, which returns NULL (and a warning) on invalid values.
+    """
+    if cast is None:
+        return Vector(np.array(strs, dtype=object), None, "s")
+    kind = "i" if cast == "int_" else "f"
+    try:
+        return Vector(np.array(strs, dtype=CASTS[cast]), None, kind)
+    except (ValueError, OverflowError):
+        pass
+    if log.error_on_warning:
+        raise NotVectorizable("invalid values")  # the row engine reports the error
+    values = [getattr(sqlfuncs, cast)(s) for s in strs]
+    mask = np.array([v is Null for v in values])
+    values = [0 if v is Null else v for v in values]
+    try:
+        data = np.array(values, dtype=CASTS[cast])
+    except OverflowError:
+        data = np.array(values, dtype=object)  # large integers
+    return Vector(data, mask if mask.any() else None, kind)
+
+
+class Block:
+    """Block of input rows, with the columns that were already parsed"""
+
+    def __init__(self, rows, casts, columns=None):
+        self.rows = rows
+        self.casts = casts
+        self.columns = columns if columns else {}
+        self.outputs = []  # results of the SELECT expressions
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, idx, cast):
+        key = (idx, cast)
+        if key not in self.columns:
+            strs = list(map(operator.itemgetter(idx), self.rows))
+            self.columns[key] = parse_column(strs, cast)
+        return self.columns[key]
+
+    def filter(self, selected):
+        """New block with the rows where `selected` is True"""
+        columns = {
+            key: Vector(
+                vec.data[selected],
+                None if vec.mask is None else vec.mask[selected],
+                vec.kind,
+            )
+            for key, vec in self.columns.items()
+        }
+        return Block(list(compress(self.rows, selected)), self.casts, columns)
+
+
+def scalar_kind(value):
+    kinds = {bool: "b", int: "i", float: "f", str: "s"}
+    if type(value) not in kinds:
+        raise NotVectorizable(f"unsupported constant {value!r}")
+    return kinds[type(value)]
+
+
+def constant(value):
+    vec = Vector(value, False, scalar_kind(value))
+    return vec.kind, lambda block: vec
+
+
+class ExprCompiler:
+    """
+    Compiles (translated) python expressions into functions that evaluate them over
+    blocks of rows. Raises NotVectorizable on unsupported expressions.
+    Each compiled expression is a pair (kind, function).
+    """
+
+    def __init__(self, casts, vars):
+        self.casts = casts
+        self.vars = vars
+        # when True, expressions are evaluated for groups of rows, where `leaves` are
+        # expressions whose value is known (e.g. group keys and aggregations)
+        self.group_mode = False
+        self.leaves = {}
+
+    def compile(self, node, truth=False):
+        """
+        `truth` is True when only the truth value of the expression is needed
+        (e.g. WHERE clause)
+        """
+        if self.leaves and ast.dump(node) in self.leaves:
+            return self.leaves[ast.dump(node)], None
+        if not isinstance(node, ast.Constant) and self.is_constant(node):
+            # constant expressions are evaluated by python (e.g. `1/3`, `-pi`)
+            return constant(self.eval_constant(node))
+        method = getattr(self, "compile_" + type(node).__name__, None)
+        if not method:
+            raise NotVectorizable(f"unsupported expression {ast.dump(node)}")
+        return method(node, truth)
+
+    def is_constant(self, node):
+        """True if the expression only has numbers and (numeric) constants"""
+        return all(
+            isinstance(n, (ast.Constant, ast.BinOp, ast.UnaryOp))
+            or isinstance(n, (ast.operator, ast.unaryop, ast.expr_context))
+            or (isinstance(n, ast.Name) and type(self.vars.get(n.id)) in NUMBERS)
+            for n in ast.walk(node)
+        )
+
+    def eval_constant(self, node):
+        names = {
+            n.id: self.vars[n.id] for n in ast.walk(node) if isinstance(n, ast.Name)
+        }
+        try:
+            return eval(compile(ast.Expression(node), "", "eval"), names)
+        except Exception as e:
+            raise NotVectorizable("could not evaluate constant expression", e)
+
+    def is_nonzero(self, node):
+        """True if the value of the expression cannot be zero"""
+        if self.is_constant(node):
+            return self.eval_constant(node) != 0
+        # `count_agg(*)` is at least 1 on all rows
+        return (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and self.vars.get(node.func.id) is agg.count_agg
+            and isinstance(node.args[0], ast.Constant)
+        )
+
+    def compile_Constant(self, node, truth):
+        return constant(node.value)
+
+    def compile_Name(self, node, truth):
+        raise NotVectorizable(f"unsupported name {node.id}")
+
+    @staticmethod
+    def subscript_idx(node, name):
+        """Index `idx` when `node` is `name[idx]`, otherwise None"""
+        if not (
+            isinstance(node, ast.Subscript)
+            and isinstance(node.value, ast.Name)
+            and node.value.id == name
+        ):
+            return None
+        idx = node.slice
+        idx = idx.value if isinstance(idx, getattr(ast, "Index", ())) else idx
+        if isinstance(idx, ast.Constant) and type(idx.value) is int:
+            return idx.value
+        return None
+
+    def compile_Subscript(self, node, truth):
+        idx = self.subscript_idx(node, "_values")
+        if idx is not None:
+            # raw (string) value of a column
+            return "s", lambda block: block.column(idx, None)
+        idx = self.subscript_idx(node, "_res")
+        if idx is not None:
+            # reference to an output column (e.g. in ORDER BY)
+            return self.output_kinds[idx], lambda block: block.outputs[idx]
+        raise NotVectorizable("unsupported subscript")
+
+    def compile_Call(self, node, truth):
+        if not isinstance(node.func, ast.Name) or node.keywords or len(node.args) != 1:
+            raise NotVectorizable("unsupported call")
+        name = node.func.id
+        idx = self.subscript_idx(node.args[0], "_values")
+        if name in CASTS and idx is not None and self.casts.get(idx) == name:
+            # typed column
+            kind = "i" if name == "int_" else "f"
+            return kind, lambda block: block.column(idx, name)
+        if name == "abs" and self.vars.get(name, builtins.abs) is builtins.abs:
+            kind, arg = self.compile(node.args[0])
+            if kind == "s":
+                raise NotVectorizable("abs of strings")
+            kind = "i" if kind == "b" else kind
+
+            def abs_(block):
+                vec = arg(block)
+                return Vector(abs(vec.numeric()), vec.mask, kind)
+
+            return kind, abs_
+        raise NotVectorizable(f"unsupported function {name}")
+
+    def compile_UnaryOp(self, node, truth):
+        if isinstance(node.op, ast.Not):
+            _, operand = self.compile(node.operand, truth=True)
+
+            def not_(block):
+                truth = operand(block).truth()
+                return Vector(~truth, None, "b")
+
+            return "b", not_
+        kind, operand = self.compile(node.operand)
+        if kind == "s" or not isinstance(node.op, (ast.USub, ast.UAdd)):
+            raise NotVectorizable("unsupported unary operator")
+        kind = "i" if kind == "b" else kind
+        op = operator.neg if isinstance(node.op, ast.USub) else operator.pos
+
+        def unary(block):
+            vec = operand(block)
+            return Vector(op(vec.numeric()), vec.mask, kind)
+
+        return kind, unary
+
+    def compile_BinOp(self, node, truth):
+        ufunc = ARITH_OPS.get(type(node.op))
+        lkind, left = self.compile(node.left)
+        rkind, right = self.compile(node.right)
+        if not ufunc or "s" in (lkind, rkind):
+            raise NotVectorizable("unsupported arithmetic")
+        is_div = isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod))
+        ints = {lkind, rkind} <= {"b", "i"}
+        kind = "i" if ints and not isinstance(node.op, ast.Div) else "f"
+        is_mult = isinstance(node.op, ast.Mult)
+        if is_div and self.group_mode and not self.is_nonzero(node.right):
+            # divisions by zero could happen while aggregating the group
+            raise NotVectorizable("division by a value that might be zero")
+
+        def binop(block):
+            lvec, rvec = left(block), right(block)
+            ldata, rdata = lvec.numeric(), rvec.numeric()
+            if is_div:
+                # python raises an error when dividing by zero
+                zeros = rdata == 0
+                if rvec.mask is not None:
+                    zeros = zeros & ~rvec.mask
+                    rdata = np.where(rvec.mask, 1, rdata)
+                if np.any(zeros):
+                    raise NotVectorizable("division by zero")
+            if kind == "i":
+                # python integers do not overflow
+                lmax, rmax = max_abs(lvec), max_abs(rvec)
+                if (lmax * rmax if is_mult else lmax + rmax) >= INT_LIMIT:
+                    raise NotVectorizable("integers out of bounds")
+            else:
+                # integers are converted to floats
+                check_int_limits(lvec, rvec, limit=FLOAT_INT_LIMIT)
+            return Vector(ufunc(ldata, rdata), or_masks(lvec.mask, rvec.mask), kind)
+
+        return kind, binop
+
+    def compile_Compare(self, node, truth):
+        if any(isinstance(op, (ast.Is, ast.IsNot)) for op in node.ops):
+            return self.compile_null_test(node)
+        operands = [self.compile(n) for n in [node.left] + node.comparators]
+        comparisons = []
+        for (lkind, left), op, (rkind, right) in zip(operands, node.ops, operands[1:]):
+            ufunc = CMP_OPS.get(type(op))
+            if not ufunc or (lkind == "s") != (rkind == "s"):
+                raise NotVectorizable("unsupported comparison")
+            comparisons.append((ufunc, lkind != rkind))
+
+        def compare(block):
+            vecs = [operand(block) for _, operand in operands]
+            result = None
+            for (ufunc, mixed), lvec, rvec in zip(comparisons, vecs, vecs[1:]):
+                if mixed:
+                    check_int_limits(lvec, rvec, limit=FLOAT_INT_LIMIT)
+                vec = Vector(
+                    ufunc(lvec.data, rvec.data), or_masks(lvec.mask, rvec.mask), "b"
+                )
+                # a chained comparison is equivalent to a sequence of ANDs
+                result = vec if result is None else and_(result, vec)
+            return result
+
+        return "b", compare
+
+    def compile_null_test(self, node):
+        """`expr is NULL` and `expr is not NULL`"""
+        if (
+            len(node.ops) != 1
+            or not isinstance(node.comparators[0], ast.Name)
+            or node.comparators[0].id not in NULL_NAMES
+        ):
+            raise NotVectorizable("unsupported comparison")
+        _, operand = self.compile(node.left)
+        is_not = isinstance(node.ops[0], ast.IsNot)
+
+        def null_test(block):
+            vec = operand(block)
+            mask = vec.mask
+            if mask is None or vec.is_scalar():
+                mask = np.zeros(len(block), dtype=bool)
+            return Vector(~mask if is_not else mask, None, "b")
+
+        return "b", null_test
+
+    def compile_BoolOp(self, node, truth):
+        values = [self.compile(n, truth) for n in node.values]
+        if not truth and any(kind != "b" for kind, _ in values):
+            # the result could be of different types
+            raise NotVectorizable("boolean operation over non boolean values")
+        op = and_ if isinstance(node.op, ast.And) else or_
+        if truth:
+            op = truth_and if isinstance(node.op, ast.And) else truth_or
+
+        def boolop(block):
+            return functools.reduce(op, [value(block) for _, value in values])
+
+        return "b", boolop
+
+
+def choose(truth, x, y):
+    """Element-wise `x if truth else y` of two Vectors"""
+    xmask = False if x.mask is None else x.mask
+    ymask = False if y.mask is None else y.mask
+    mask = np.where(truth, xmask, ymask)
+    return Vector(np.where(truth, x.data, y.data), mask if mask.any() else None, "b")
+
+
+def and_(x, y):
+    """`x and y` (python semantics) of two boolean Vectors"""
+    return choose(x.truth(), y, x)
+
+
+def or_(x, y):
+    """`x or y` (python semantics) of two boolean Vectors"""
+    return choose(x.truth(), x, y)
+
+
+def truth_and(x, y):
+    return Vector(np.logical_and(x.truth(), y.truth()), None, "b")
+
+
+def truth_or(x, y):
+    return Vector(np.logical_or(x.truth(), y.truth()), None, "b")
+
+
+def agg_calls(node, vars, conditional=False):
+    """
+    Returns the calls to aggregate functions in `node`.
+    Aggregate functions that might not be called in every row are not supported,
+    since their arguments are evaluated over all rows of a block.
+    """
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        func = vars.get(node.func.id)
+        if func is not None and getattr(func, "__module__", None) == agg.__name__:
+            if node.func.id not in AGGS or conditional:
+                raise NotVectorizable(f"unsupported aggregation {node.func.id}")
+            if len(node.args) != 1 or [k.arg for k in node.keywords] != ["_slot"]:
+                raise NotVectorizable("unsupported aggregation arguments")
+            if agg_calls(node.args[0], vars):
+                raise NotVectorizable("nested aggregations")
+            return [node]
+    calls = []
+    for field, value in ast.iter_fields(node):
+        children = value if isinstance(value, list) else [value]
+        for i, child in enumerate(children):
+            if not isinstance(child, ast.AST):
+                continue
+            # short-circuits and conditional expressions
+            cond = (
+                conditional
+                or (isinstance(node, ast.BoolOp) and i > 0)
+                or (isinstance(node, ast.IfExp) and field != "test")
+                or (isinstance(node, ast.Compare) and field == "comparators" and i > 0)
+            )
+            calls.extend(agg_calls(child, vars, cond))
+    return calls
+
+
+def parse_tuple(source):
+    """Parses a (translated) clause with multiple expressions (e.g. SELECT)"""
+    return ast.parse(source, mode="eval").body.elts
+
+
+class VectorizedQuery:
+    """
+    Runs a query over blocks of rows, with the same interface of the (generated)
+    query function. Falls back to the query function on blocks that cannot be
+    vectorized.
+    """
+
+    def __init__(self, query_func, clauses, casts, vars, block_size=None):
+        self.query_func = query_func
+        self.block_size = block_size if block_size else BLOCK_SIZE
+        self.casts = casts
+        compiler = ExprCompiler(casts, vars)
+        self.where = None
+        if clauses["where"]:
+            _, self.where = compiler.compile(
+                ast.parse(clauses["where"], mode="eval").body, truth=True
+            )
+
+        self.groupby = None
+        if clauses["groupby"]:
+            # only the group keys and the arguments of aggregate functions are
+            # evaluated over blocks, since the results of each group are calculated
+            # by the query function, over the last row of the group (the remaining of
+            # the SELECT and ORDER BY clauses are compiled to check that they would
+            # not raise errors on any row)
+            keys = parse_tuple(clauses["groupby"])
+            keys = [(key, *compiler.compile(key)) for key in keys]
+            self.groupby = [func for _, _, func in keys]
+            calls = []
+            for clause in ["select", "orderby"]:
+                if clauses[clause]:
+                    calls.extend(
+                        agg_calls(ast.parse(clauses[clause], mode="eval"), vars)
+                    )
+            self.aggs = []
+            leaves = {ast.dump(key): kind for key, kind, _ in keys}
+            for call in calls:
+                kind, arg = compiler.compile(call.args[0])
+                ops = AGGS[call.func.id]
+                if kind not in {"i", "f"} and ops != ["count"]:
+                    raise NotVectorizable(f"{call.func.id} of type {kind}")
+                # the slot of the aggregates of the call (assigned by the parser)
+                slot = call.keywords[0].value.value
+                self.aggs.append((slot, ops, arg))
+                leaves[ast.dump(call)] = AGG_KINDS.get(call.func.id, kind)
+            compiler.leaves = leaves
+            compiler.group_mode = True
+            self.last_rows = dict()  # last row of each group (in order of arrival)
+
+        select = [compiler.compile(n) for n in parse_tuple(clauses["select"])]
+        self.select = [func for _, func in select]
+        self.orderby = None
+        if clauses["orderby"]:
+            compiler.output_kinds = [kind for kind, _ in select]
+            self.orderby = [
+                compiler.compile(n)[1] for n in parse_tuple(clauses["orderby"])
+            ]
+
+    def __call__(self, rows, input_row_number, **helpers):
+        handle_results = helpers["_handle_results"]
+        for block in batches(rows, self.block_size):
+            try:
+                with np.errstate(all="ignore"):
+                    results = self.eval_block(Block(block, self.casts))
+            except (NotVectorizable, ArithmeticError, TypeError, ValueError) as e:
+                # e.g. division by zero, overflows, values that cannot be compared
+                log.user_debug("Running block on row engine", e)
+                results = None
+            if results is None:
+                if self.groupby:
+                    self.flush_groups(helpers)
+                input_row_number = self.query_func(block, input_row_number, **helpers)
+                done = handle_results(())
+            elif self.groupby:
+                input_row_number = input_row_number + len(block)
+                self.handle_block_groups(results)
+                done = False
+            else:
+                input_row_number = input_row_number + len(block)
+                done = self.handle_block_results(results, helpers)
+            if done:
+                return input_row_number
+        if self.groupby:
+            self.flush_groups(helpers)
+        return input_row_number
+
+    def eval_block(self, block):
+        if self.where:
+            selected = self.where(block).truth()
+            if np.isscalar(selected):
+                selected = np.full(len(block), selected)
+            block = block.filter(selected)
+        if self.groupby:
+            return self.eval_groups(block)
+        n = len(block)
+        block.outputs = [func(block) for func in self.select]
+        results = list(zip(*[vec.tolist(n) for vec in block.outputs]))
+        sort_keys = None
+        if self.orderby:
+            sort_keys = list(zip(*[func(block).tolist(n) for func in self.orderby]))
+        return results, sort_keys
+
+    def handle_block_results(self, results, helpers):
+        results, sort_keys = results
+        if sort_keys is None:
+            return helpers["_handle_results"](results)
+        handle_result = helpers["_handle_result"]
+        for result, sort_key in zip(results, sort_keys):
+            if handle_result(result, sort_key, ()):
+                return True
+        return False
+
+    def eval_groups(self, block):
+        """
+        Calculates the group keys and the aggregations of each group in the block.
+        Groups are numbered in order of arrival.
+        """
+        n = len(block)
+        if n == 0:
+            return [], [], []
+        # each combination of key values is identified by a code
+        codes = np.zeros(n, dtype=np.int64)
+        ncodes = 1
+        key_values = []  # distinct values of each key, and the index of each row's
+        for func in self.groupby:
+            vec = func(block)
+            if vec.is_scalar():
+                key_values.append((vec.tolist(1), None))
+                continue
+            if vec.kind == "f" and np.isnan(vec.data).any():
+                raise NotVectorizable("NaN keys")  # NaNs are different from each other
+            values, inverse = np.unique(vec.data, return_inverse=True)
+            values = values.tolist()
+            inverse = inverse.reshape(-1)
+            if vec.mask is not None:
+                inverse = np.where(vec.mask, len(values), inverse)
+                values.append(Null)
+            ncodes = ncodes * len(values)
+            if ncodes >= INT_LIMIT:
+                raise NotVectorizable("too many groups")
+            codes = codes * len(values) + inverse
+            key_values.append((values, inverse.tolist()))
+
+        _, first, groups = np.unique(codes, return_index=True, return_inverse=True)
+        order = np.argsort(first)  # by order of arrival
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        groups = ranks[groups.reshape(-1)]
+        keys = [
+            tuple(
+                values[0] if inverse is None else values[inverse[i]]
+                for values, inverse in key_values
+            )
+            for i in first[order].tolist()
+        ]
+        _, last = np.unique(groups[::-1], return_index=True)
+        last_rows = [block.rows[n - 1 - i] for i in last.tolist()]
+
+        # rows sorted by group, and the start of each group
+        perm = np.argsort(groups, kind="stable")
+        starts = np.searchsorted(groups[perm], np.arange(len(keys)))
+        partials = []
+        for _, ops, arg in self.aggs:
+            vec = arg(block).broadcast(n)
+            partials.append([self.eval_agg(op, vec, perm, starts) for op in ops])
+        return keys, last_rows, partials
+
+    @staticmethod
+    def eval_agg(op, vec, perm, starts):
+        """
+        Aggregation of each group.
+        Returns a list with a value for each group (None if there are no values), or
+        the list of values of each group when values are summed sequentially.
+        """
+        valid = np.ones(len(perm), dtype=bool) if vec.mask is None else ~vec.mask
+        valid = valid[perm]
+        counts = np.add.reduceat(valid.astype(np.int64), starts).tolist()
+        if op == "count":
+            return counts
+        data = vec.numeric()[perm]
+        if op == "sum" and data.dtype == np.int64:
+            check_int_limits(Vector(data, None, "i"), limit=INT_LIMIT // len(data))
+            sums = np.add.reduceat(np.where(valid, data, 0), starts).tolist()
+            return [s if c else None for s, c in zip(sums, counts)]
+        if op == "sum":
+            # floats are summed one by one, to have the same rounding errors
+            ends = starts.tolist()[1:] + [len(data)]
+            return [
+                data[s:e][valid[s:e]].tolist() if c else None
+                for s, e, c in zip(starts.tolist(), ends, counts)
+            ]
+        if data.dtype == object or (
+            data.dtype == np.float64
+            # python's min/max return the first of equal values (e.g. 0.0 and -0.0)
+            and (np.isnan(data).any() or np.signbit(data[data == 0]).any())
+        ):
+            raise NotVectorizable(f"{op} of non comparable values")
+        ufunc = np.minimum if op == "min" else np.maximum
+        # NULLs are replaced by a value that does not change the result
+        fill = data.max() if op == "min" else data.min()
+        values = ufunc.reduceat(np.where(valid, data, fill), starts).tolist()
+        return [v if c else None for v, c in zip(values, counts)]
+
+    def handle_block_groups(self, results):
+        """Updates the aggregations of each group with the results of a block"""
+        keys, last_rows, partials = results
+        ops = agg._get_agg_ops()
+        for g, key in enumerate(keys):
+            accs = agg._get_group_aggs(key)
+            for (slot, agg_ops, _), values in zip(self.aggs, partials):
+                value = values[0][g]
+                if value is None:
+                    continue  # no values (besides NULLs)
+                prev = accs[slot]
+                if len(agg_ops) == 1:
+                    accs[slot] = self.merge_agg(agg_ops[0], prev, value)
+                    ops[slot] = OPS[agg_ops[0]]
+                    continue
+                # (sum, count) pair of an average
+                prev_sum, prev_count = (Null, Null) if prev is Null else prev
+                accs[slot] = (
+                    self.merge_agg("sum", prev_sum, value),
+                    self.merge_agg("count", prev_count, values[1][g]),
+                )
+                ops[slot] = agg._add_pairs
+            self.last_rows[key] = last_rows[g]
+
+    @staticmethod
+    def merge_agg(op, prev, value):
+        """
+        Aggregates the aggregation of a group in a block (see `eval_agg`) with the
+        previous aggregation of the group (NULL if none)
+        """
+        if isinstance(value, list):  # sequential sum
+            if prev is Null:
+                prev, value = value[0], value[1:]
+            return functools.reduce(operator.add, value, prev)
+        return value if prev is Null else OPS[op](prev, value)
+
+    def flush_groups(self, helpers):
+        """
+        Hands the results of the groups updated by vectorized blocks to the output
+        handler, by running the query function over the last row of each group
+        without updating the aggregations
+        """
+        if not self.last_rows:
+            return
+        agg._set_replay(True)
+        try:
+            self.query_func(list(self.last_rows.values()), 0, **helpers)
+        finally:
+            agg._set_replay(False)
+        self.last_rows.clear()
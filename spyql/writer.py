@@ -118,13 +118,19 @@ class JSONWriter(Writer):
         self.encoder = json.JSONEncoder(default=default, **options)
         self.encoder.encode({"a": 1})  # test options
 
-    def writerow(self, row):
+    def encoderow(self, row):
         obj = (
             row[0]
             if is_row_collapsable(row, self.header)
             else dict(zip(self.header, row))
         )
-        self.outputfile.write(self.encoder.encode(obj) + "\n")
+        return self.encoder.encode(obj) + "\n"
+
+    def writerow(self, row):
+        self.outputfile.write(self.encoderow(row))
+
+    def writerows(self, rows):
+        self.outputfile.write("".join([self.encoderow(row) for row in rows]))
 
 
 class ORJSONWriter(Writer):
@@ -145,16 +151,20 @@ class ORJSONWriter(Writer):
         self.default = default
         self.option = option | orjson.OPT_APPEND_NEWLINE
 
-    def writerow(self, row):
+    def encoderow(self, row):
         # TODO optimization: only call `is_row_collapsable` in the 1st row?
         obj = (
             row[0]
             if is_row_collapsable(row, self.header)
             else dict(zip(self.header, row))
         )
-        self.outputfile.buffer.write(
-            self.orjson.dumps(obj, default=self.default, option=self.option)
-        )
+        return self.orjson.dumps(obj, default=self.default, option=self.option)
+
+    def writerow(self, row):
+        self.outputfile.buffer.write(self.encoderow(row))
+
+    def writerows(self, rows):
+        self.outputfile.buffer.write(b"".join([self.encoderow(row) for row in rows]))
 
 
 class CollectWriter(Writer):
@@ -271,6 +281,9 @@ class SpyWriter(Writer):
     def writerow(self, row):
         self.outputfile.write(SpyWriter.pack(row))
 
+    def writerows(self, rows):
+        self.outputfile.write("".join([SpyWriter.pack(row) for row in rows]))
+
 
 class SQLWriter(Writer):
     def __init__(
@@ -217,6 +217,18 @@ def test_equi_join():
     )()
     assert out == ({"n": "One"}, {"n": "Three"})
 
+    # expressions that do not depend on the row
+    out = Query(
+        "SELECT nums[col1] as n, len(nums) AS l, sorted(nums.keys())[-1] AS k,"
+        " nums['3'] AS t FROM [1,2,3] WHERE str(col1) in set(nums.keys()) or col1 == 2",
+        json_obj_files={"nums": kv_fpath2},
+    )()
+    assert out == (
+        {"n": "One", "l": 2, "k": "3", "t": "Three"},
+        {"n": NULL, "l": 2, "k": "3", "t": "Three"},
+        {"n": "Three", "l": 2, "k": "3", "t": "Three"},
+    )
+
     # test NULL key
     out = Query(
         "SELECT NULL in nums AS n",
@@ -264,6 +276,91 @@ def test_globals():
     )
 
 
+def test_prepared():
+    query = Query(
+        "SELECT row.name, row.age * factor AS x, re.compile(pat).match(row.name)"
+        " is not None AS m FROM data WHERE row.age > min_age ORDER BY 2 DESC",
+        prepared=True,
+    )
+    # parameters are bound on each call
+    out = query(data=raw_data, factor=2, min_age=30, pat="C")
+    assert out == (
+        {"name": "D", "x": 100, "m": False},
+        {"name": "C", "x": 80, "m": True},
+    )
+    out = query(data=raw_data, factor=-1, min_age=10, pat="[AB]")
+    assert out == (
+        {"name": "A", "x": -20, "m": True},
+        {"name": "B", "x": -30, "m": True},
+        {"name": "C", "x": -40, "m": False},
+        {"name": "D", "x": -50, "m": False},
+    )
+    assert query.stats() == {"rows_in": 4, "rows_out": 4}
+
+    # the query is compiled again for inputs with other schemas
+    query = Query("SELECT col1 * k AS a, col2 FROM data", prepared=True)
+    assert query(data=[(1, "x"), (2, "y")], k=2) == (
+        {"a": 2, "col2": "x"},
+        {"a": 4, "col2": "y"},
+    )
+    assert query(data=[(1.5, {"b": 1})], k=3) == ({"a": 4.5, "col2": {"b": 1}},)
+    assert query(data=[(1, "x")], k=4) == ({"a": 4, "col2": "x"},)
+
+
+def test_parallel():
+    data = [{"a": i, "b": {"c": i % 3}} for i in range(50)]
+    json_fpath = make_json(data)
+    expectation = tuple({"a": i, "b_c": 0} for i in range(0, 50, 3))
+    for ordered in [True, False]:
+        opts = {"workers": 3, "ordered": ordered}
+        query = Query(
+            f"SELECT .a, .b.c FROM json('{json_fpath}') WHERE .b.c == 0",
+            input_options=opts,
+        )
+        out = query()
+        if not ordered:
+            out = tuple(sorted(out, key=lambda r: r["a"]))
+        assert out == expectation
+        assert query.stats() == {"rows_in": 50, "rows_out": 17}
+
+        query = f"SELECT col1 FROM text('{json_fpath}') WHERE '4' in col1"
+        out = Query(query, input_options=opts)()
+        assert sorted(out.col1) == sorted(Query(query)().col1)
+        assert len(out) == 14
+
+    # queries where rows are not independent run in a single process
+    out = Query(
+        f"SELECT .a, row_number AS n FROM json('{json_fpath}') WHERE .a > 46",
+        input_options={"workers": 3},
+    )()
+    assert out == ({"a": 47, "n": 1}, {"a": 48, "n": 2}, {"a": 49, "n": 3})
+
+    # partial aggregates of each chunk are merged
+    for query in [
+        "SELECT sum_agg(.a) AS s, count_agg(*) AS n, set_agg(.b.c) AS c,"
+        " dict_agg(.b.c, .a) AS d, lag_agg(.a, 2) AS lag FROM json('{}')",
+        "SELECT .b.c AS c, list_agg(.a) AS l, min_agg(.a) AS mi, first_agg(.a) AS f,"
+        " last_agg(.a) AS la, .a FROM json('{}') WHERE .a % 4 > 0 GROUP BY 1",
+        "SELECT .a % 4 AS k, avg_agg(.a) AS avg FROM json('{}') GROUP BY 1"
+        " ORDER BY 2 DESC LIMIT 2 OFFSET 1",
+    ]:
+        query = query.format(json_fpath)
+        query_parallel = Query(query, input_options={"workers": 3})
+        assert query_parallel() == Query(query)()
+        assert query_parallel.stats()["rows_in"] == 50
+
+    # errors in workers
+    try:
+        Query(
+            f"SELECT 1 / (.a - 40) FROM json('{json_fpath}')",
+            input_options={"workers": 3},
+        )()
+        assert False
+    except ZeroDivisionError:
+        assert True
+    os.remove(json_fpath)
+
+
 def test_readme():
     # TODO test all recipes in the README
 
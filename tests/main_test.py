@@ -2,8 +2,13 @@ import logging
 from click.testing import CliRunner
 import spyql.cli
 import spyql.log
+import spyql.agg
+import spyql.codegen
+import spyql.output_handler
+import spyql.parser
+import spyql.spill
 from spyql.writer import SpyWriter
-from spyql.processor import SpyProcessor
+from spyql.processor import Processor, SpyProcessor
 from spyql.nulltype import NULL
 from spyql.qdict import qdict
 from tabulate import tabulate
@@ -134,8 +139,8 @@ def eq_test_1row(query, expectation, **kwargs):
     eq_test_nrows(query, [expectation], **kwargs)
 
 
-def exception_test(query, anexception, **kw_options):
-    res = run_cli(query, make_cli_options(kw_options))
+def exception_test(query, anexception, data=None, **kw_options):
+    res = run_cli(query, make_cli_options(kw_options), data)
     assert res.exit_code != 0
     assert isinstance(res.exception, anexception)
 
@@ -218,6 +223,16 @@ def test_basic():
     # limit 0
     eq_test_nrows("SELECT * FROM [1,2,3] LIMIT 0", [])
 
+    # row counters
+    eq_test_nrows(
+        "SELECT col1, row_number, input_row_number AS irn FROM [10,20,30,40]"
+        " WHERE col1 % 20 == 0",
+        [
+            {"col1": 20, "row_number": 1, "irn": 2},
+            {"col1": 40, "row_number": 2, "irn": 4},
+        ],
+    )
+
     # negative limit
     eq_test_nrows("SELECT * FROM [1,2,3] LIMIT -10", [])
 
@@ -238,6 +253,34 @@ def test_basic():
         {"a": [2, 3, 4]},
     )
 
+    # expressions that do not depend on the row
+    eq_test_nrows(
+        "SELECT col1, re.compile('^a').match(col1) is not None AS m,"
+        " col1 in set(['a', 'c']) AS s, datetime(2024, 1, 1).year + len(col1) AS y"
+        " FROM ['a', 'b', 'ca'] WHERE sqrt(4) == 2",
+        [
+            {"col1": "a", "m": True, "s": True, "y": 2025},
+            {"col1": "b", "m": False, "s": False, "y": 2025},
+            {"col1": "ca", "m": False, "s": False, "y": 2026},
+        ],
+    )
+    eq_test_nrows("SELECT col1 FROM [1, 2] WHERE col1 > 2 and sqrt(-1) > 0", [])
+    # branches and operands that are not always evaluated are not hoisted
+    for expr, hoisted in [
+        ("v if len('ab') > 1 else len('abc') + 1", "v if _const0 else len('abc') + 1"),
+        ("len('ab') + 1 if v else 0", "len('ab') + 1 if v else 0"),
+        ("v > 1 and len('ab') > 1", "v > 1 and len('ab') > 1"),
+        ("len('a') > 0 and len('b') > 0 and v", "_const0 and _const1 and v"),
+        ("len('') > 0 and sum(range(10**12)) > 0 or v", "_const0 or v"),
+    ]:
+        assert spyql.codegen.hoist_invariants(expr, {}, {}, ["v"]) == hoisted
+    # mutable values are not shared by all rows
+    eq_test_nrows(
+        "SELECT sorted([3, 1, 2]).pop() AS a, 'a b'.split().pop() AS b,"
+        " list(range(2)).__iadd__([col1]) AS c FROM [5, 6]",
+        [{"a": 3, "b": "b", "c": [0, 1, 5]}, {"a": 3, "b": "b", "c": [0, 1, 6]}],
+    )
+
 
 def test_comment():
     eq_test_1row("SELECT * FROM [1] # This is a in-line-comment", {"col1": 1})
@@ -418,6 +461,35 @@ def test_orderby():
         ),
     )
 
+    # order by (multi-cols, with strings and numbers in both directions)
+    data = (
+        "list(zip(['x','y','x','y',NULL,'x'], ['b','a','a',NULL,'c','a'], range(1,7)))"
+    )
+    eq_test_nrows(
+        f"SELECT col1 as a, col2 as b, col3 as c FROM {data} ORDER BY 1 DESC, 2,"
+        " 3 DESC",
+        [
+            {"a": NULL, "b": "c", "c": 5},
+            {"a": "y", "b": "a", "c": 2},
+            {"a": "y", "b": NULL, "c": 4},
+            {"a": "x", "b": "a", "c": 6},
+            {"a": "x", "b": "a", "c": 3},
+            {"a": "x", "b": "b", "c": 1},
+        ],
+    )
+    eq_test_nrows(
+        f"SELECT col1 as a, col2 as b, col3 as c FROM {data} ORDER BY 2 DESC NULLS"
+        " LAST, col3 % 2, 1 NULLS FIRST",
+        [
+            {"a": NULL, "b": "c", "c": 5},
+            {"a": "x", "b": "b", "c": 1},
+            {"a": "x", "b": "a", "c": 6},
+            {"a": "y", "b": "a", "c": 2},
+            {"a": "x", "b": "a", "c": 3},
+            {"a": "y", "b": NULL, "c": 4},
+        ],
+    )
+
     # order by (with limit / offset / where)
     eq_test_nrows(
         "SELECT * FROM [1,-2,NULL,3] WHERE col1 > 0 ORDER BY 1 DESC NULLS LAST",
@@ -436,6 +508,48 @@ def test_orderby():
         [],
     )
 
+    # order by with limit only keeps the top rows, sorted like all rows
+    data = "[(i % 3, NULL if i % 4 == 0 else i % 5, i % 7) for i in range(60)]"
+    for select in ["SELECT", "SELECT DISTINCT"]:
+        for orderby in [
+            "1, 2",
+            "1 DESC, 2 NULLS FIRST",
+            "2 DESC NULLS LAST, 1",
+            "2 DESC, 1 DESC NULLS FIRST",
+        ]:
+            query = f"{select} col1, col2 FROM {data} ORDER BY {orderby}"
+            res = run_query(query + " TO memory", None)
+            for limit, offset in [(1, 0), (5, 0), (5, 7), (100, 2)]:
+                top = f"{query} LIMIT {limit} OFFSET {offset} TO memory"
+                assert run_query(top, None) == res[offset : offset + limit]
+    query = (
+        "SELECT col1, col2, count_agg(*) as n, list_agg(col3) as l FROM"
+        f" {data} GROUP BY 1, 2 ORDER BY 3 DESC, 2 NULLS FIRST"
+    )
+    res = run_query(query + " TO memory", None)
+    top = run_query(query + " LIMIT 4 OFFSET 1 TO memory", None)
+    assert top == res[1:5]
+    # distinct rows with a limit only keep the results of the top rows
+    orderby = [{"expr": None, "rev": True, "rev_nulls": False}]
+    handler = spyql.output_handler.DistinctTopNSortAtEnd(orderby, 3, 1)
+    for i in range(1000):
+        handler.handle_result((i % 50,), (i % 50,))
+        assert len(handler.results) <= 4
+    assert handler.sorted_rows() == [(49,), (48,), (47,), (46,)]
+
+
+def test_orderby_spill(monkeypatch):
+    # rows that exceed the memory budget are sorted in temporary files and merged
+    query = (
+        "SELECT col1, NULL if col1 % 5 == 0 else col1 % 7 as a, str(col1) as b"
+        " FROM range(30000) ORDER BY 2 DESC NULLS LAST, 3 DESC TO memory"
+    )
+    res = run_query(query, None)
+    assert run_query(query, None, input_options={"max_memory": 1}) == res
+    # merges runs when there are too many
+    monkeypatch.setattr(spyql.output_handler, "MAX_RUNS", 2)
+    assert run_query(query, None, input_options={"max_memory": 1}) == res
+
 
 def test_agg():
     # aggregate functions (overall)
@@ -534,6 +648,94 @@ def test_agg():
             ],
         )
 
+    # collections are updated in place, but each partial result has its own copy
+    res = run_query(
+        "SELECT PARTIALS set_agg(col1) AS s, dict_agg(col1, 1) AS d,"
+        " count_distinct_agg(col1) AS c FROM [1, 2, NULL, 2] TO memory",
+        None,
+    )
+    assert res == (
+        {"s": {1}, "d": {1: 1}, "c": 1},
+        {"s": {1, 2}, "d": {1: 1, 2: 1}, "c": 2},
+        {"s": {1, 2, NULL}, "d": {1: 1, 2: 1}, "c": 2},
+        {"s": {1, 2, NULL}, "d": {1: 1, 2: 1}, "c": 2},
+    )
+
+    # sliding windows over the last rows, or over the last units of time
+    tst_list = [4, NULL, 2, 7, NULL, NULL, 1, 5]
+    windows = [
+        [x for x in tst_list[max(0, n - 3) : n] if x is not NULL] for n in range(1, 9)
+    ]
+    eq_test_nrows(
+        "SELECT PARTIALS rolling_sum_agg(col1, 3) AS s, rolling_avg_agg(col1, 3) AS a,"
+        " rolling_min_agg(col1, 3) AS mn, rolling_max_agg(col1, 3) AS mx,"
+        f" rolling_count_agg(col1, 3) AS c, lag_agg(col1, 2, 0) AS l FROM {tst_list}",
+        [
+            {
+                "s": sum(w) if w else NULL,
+                "a": sum(w) / len(w) if w else NULL,
+                "mn": min(w) if w else NULL,
+                "mx": max(w) if w else NULL,
+                "c": len(w),
+                "l": tst_list[n - 2] if n > 1 else 0,
+            }
+            for n, w in enumerate(windows)
+        ],
+    )
+    eq_test_nrows(
+        "SELECT PARTIALS rolling_sum_agg(col2, 10, col1) AS s,"
+        " rolling_max_agg(col2, 10, col1) AS m"
+        " FROM [[0, 5], [4, 1], [10, 2], [NULL, 9], [15, NULL], [30, 3]]",
+        [
+            {"s": 5, "m": 5},
+            {"s": 6, "m": 5},
+            {"s": 3, "m": 2},
+            {"s": 3, "m": 2},
+            {"s": 2, "m": 2},
+            {"s": 3, "m": 3},
+        ],
+    )
+
+    # aggregate functions that are not called on every row
+    eq_test_nrows(
+        "SELECT PARTIALS max_agg(col1) if col1 > 2 else 0 AS m, count_agg(*) AS n"
+        " FROM [1,2,3,4]",
+        [{"m": 0, "n": 1}, {"m": 0, "n": 2}, {"m": 3, "n": 3}, {"m": 4, "n": 4}],
+    )
+    eq_test_1row(
+        "SELECT sum_agg(col1) if col1 % 2 else sum_agg(-col1) AS s, avg_agg(col1) AS a"
+        " FROM range(1, 5)",
+        {"s": -6, "a": 2.5},
+    )
+
+
+def test_repeated_agg_calls(caplog):
+    # calls in comprehensions and lambdas (or without a slot) are tracked by the order
+    # they are called on each row
+    eq_test_1row(
+        "SELECT [sum_agg(x) for x in col1] AS s, list(map(lambda x: max_agg(x), col1))"
+        " AS m, list(map(min_agg, col1)) AS mn, count_agg(*) AS n"
+        " FROM [[[1, 10]], [[2, 20]]]",
+        {"s": [3, 30], "m": [2, 20], "mn": [1, 10], "n": 2},
+    )
+    eq_test_nrows(
+        "SELECT col2 AS g, [sum_agg(x) for x in list_agg(col1)] AS s FROM"
+        " [[1, 'a'], [2, 'b'], [3, 'a']] GROUP BY 1",
+        [{"g": "a", "s": [2, 3]}, {"g": "b", "s": [2]}],
+    )
+
+    # a generator argument is parenthesized when the slot argument is added
+    eq_test_1row(
+        "SELECT count_agg(x for x in [col1, 1]) AS c, any_agg((x for x in [col1]))"
+        " AS a, max_agg(sum(x for x in [col1, 1])) AS m FROM [1, 2]",
+        {"c": 2, "a": True, "m": 3},
+    )
+
+    # error messages show the expressions of the query
+    exception_test("SELECT sum_agg(col1) + 'a' AS x FROM [1]", TypeError)
+    assert "sum_agg(col1) + " in caplog.text
+    assert "_slot" not in caplog.text
+
 
 def test_groupby():
     eq_test_1row("SELECT 1 as a FROM range(1) GROUP BY col1", {"a": 1})
@@ -575,6 +777,109 @@ def test_groupby():
     )
 
 
+def test_groupby_strings(monkeypatch):
+    # results of `string_agg` are only joined when written, once per group
+    nums = [str(i) for i in range(1000)]
+    for row_number in ["", ", row_number * 0 AS z"]:
+        z = {"z": 0} if row_number else {}
+        eq_test_nrows(
+            f"SELECT col1 % 3 AS g, string_agg(col1, '-').upper() AS s{row_number}"
+            " FROM range(1000) GROUP BY 1 ORDER BY len(string_agg(col1, '')) DESC"
+            " LIMIT 2",
+            [
+                {"g": 0, "s": "-".join(nums[0::3]), **z},
+                {"g": 1, "s": "-".join(nums[1::3]), **z},
+            ],
+        )
+        eq_test_1row(
+            f"SELECT len(list_agg(col1)) AS n, string_agg(col1, '') AS s{row_number}"
+            " FROM range(1000)",
+            {"n": 1000, "s": "".join(nums), **z},
+        )
+    eq_test_nrows(
+        "SELECT PARTIALS string_agg(col1, ',') AS s, list_agg(col1) AS l FROM range(4)",
+        [{"s": ",".join(nums[:n]), "l": list(range(n))} for n in range(1, 5)],
+    )
+    eq_test_nrows(
+        "SELECT json->a AS a, string_agg(json->b, '-') AS s FROM json EXPLODE json->b"
+        " GROUP BY 1",
+        [{"a": 1, "s": "1-2-4"}, {"a": 2, "s": "3"}],
+        data='{"a": 1, "b": [1, 2]}\n{"a": 2, "b": [3]}\n{"a": 1, "b": [4]}\n',
+    )
+    joins = []
+    join = spyql.agg._Strings.join
+    monkeypatch.setattr(
+        spyql.agg._Strings, "join", lambda s, sep: joins.append(sep) or join(s, sep)
+    )
+    query = "SELECT string_agg(col1, ',') AS s FROM {} GROUP BY col1 % 3"
+    expected = sorted(",".join(map(str, range(i, 3000, 3))) for i in range(3))
+    for source, opts in [
+        ("range(3000)", {}),
+        ("range(3000)", {"pipeline": True}),
+        ("range(3000)", {"max_memory": 1}),
+        ("sorted(range(3000), key=lambda x: x % 3)", {"sorted_groups": True}),
+    ]:
+        joins.clear()
+        res = spyql.query.Query(query.format(source), input_options=opts)()
+        assert (sorted(r["s"] for r in res), len(joins)) == (expected, 3)
+
+
+def test_groupby_spill(monkeypatch):
+    # groups that exceed the memory budget are partitioned into temporary files and
+    # aggregated again, one partition at a time
+    monkeypatch.setattr(spyql.spill, "PARTITIONS", 3)
+    for query in [
+        "SELECT col1 % 20000 as g, count_agg(*) as n, list_agg(col1) as l,"
+        " first_agg(col1) as f, last_agg(col1) as la, avg_agg(col1) as a FROM"
+        " range(60000) GROUP BY 1",
+        "SELECT col1 % 7000 as g, str(col1 % 3) as h, set_agg(col1 % 5) as s FROM"
+        " range(60000) WHERE col1 % 11 > 0 GROUP BY 1, 2 ORDER BY 2 DESC, 1",
+        "SELECT col1 % 20000 as g, sum_agg(col1) as s FROM range(60000) GROUP BY 1"
+        " ORDER BY 2 DESC LIMIT 10 OFFSET 5",
+        "SELECT col1 % 5000 as g, rolling_sum_agg(col1, 4) as s, lag_agg(col1, 2)"
+        " as l, rolling_min_agg(-col1, 3) as m, rolling_max_agg(col1, 7, col1)"
+        " as t FROM range(60000) GROUP BY 1",
+    ]:
+        res = run_query(query + " TO memory", None)
+        options = {"max_memory": 1}
+        assert run_query(query + " TO memory", None, input_options=options) == res
+    # groups are also spilled when their aggregates grow (e.g. a few large lists)
+    spills = []
+    spill = spyql.spill.GroupsSpiller.spill
+    monkeypatch.setattr(
+        spyql.spill.GroupsSpiller, "spill", lambda s: spills.append(1) or spill(s)
+    )
+    query = "SELECT col1 % 3 as g, list_agg(col1) as l FROM range(300000) GROUP BY 1"
+    res = run_query(query + " TO memory", None)
+    assert run_query(query + " TO memory", None, input_options=options) == res
+    assert len(spills) > 1
+
+
+def test_sorted_groups():
+    # results of groups are handed out as soon as the group key changes
+    options = {"sorted_groups": True}
+    for query in [
+        "SELECT col1 // 7 as g, count_agg(*) as n, list_agg(col1) as l FROM"
+        " range(1000) GROUP BY 1",
+        "SELECT col1 // 7 as g, sum_agg(col1) as s FROM range(1000) WHERE"
+        " col1 % 3 > 0 GROUP BY 1 ORDER BY 2 DESC",
+        "SELECT col1 // 7 as g, sum_agg(col1) as s FROM range(1000) GROUP BY 1"
+        " LIMIT 5 OFFSET 3",
+    ]:
+        res = run_query(query + " TO memory", None)
+        assert run_query(query + " TO memory", None, input_options=options) == res
+        # only the aggregates of the last group are kept
+        assert len(spyql.agg._get_aggs()) <= 2
+
+    # groups whose rows are not together are handed out more than once
+    query = "SELECT col1 as a, count_agg(*) as n FROM [1,1,2,1] GROUP BY 1 TO memory"
+    assert run_query(query, None, input_options=options) == (
+        {"a": 1, "n": 2},
+        {"a": 2, "n": 1},
+        {"a": 1, "n": 1},
+    )
+
+
 def test_distinct():
     eq_test_1row("SELECT DISTINCT 1 as a FROM range(1)", {"a": 1})
     eq_test_1row("SELECT DISTINCT 1 as a FROM range(10)", {"a": 1})
@@ -599,6 +904,30 @@ def test_distinct():
         ],
     )
 
+    # distinct rows that exceed the memory budget are deduplicated in partitions
+    query = "SELECT DISTINCT (col1 * 7919) % 40000 as a FROM range(100000)"
+    res = run_query(query + " TO memory", None)
+    options = {"max_memory": 1}
+    assert run_query(query + " TO memory", None, input_options=options) == res
+    top = query + " LIMIT 30000 OFFSET 10 TO memory"
+    assert run_query(top, None, input_options=options) == res[10:30010]
+    options = {"max_memory": 1, "ordered": False}
+    res_unordered = run_query(query + " TO memory", None, input_options=options)
+    assert sorted(res_unordered, key=str) == sorted(res, key=str)
+
+    # approximate distinct rows (never writes duplicates, might drop a few rows)
+    query = spyql.query.Query(
+        "SELECT DISTINCT col1 % 20000 as a FROM range(50000)",
+        input_options={"distinct_error": 0.01, "max_memory": 1},
+    )
+    res = query()
+    assert 19990 <= len(res) <= 20000
+    assert len(set(row["a"] for row in res)) == len(res)
+    stats = query.stats()
+    assert stats["distinct_error"] == 0.01
+    assert stats["distinct_capacity"] > 20000
+    assert stats["distinct_estimated_error"] < 0.01
+
     # Distinct jsons
     res = run_cli(
         "SELECT DISTINCT json FROM json EXPLODE json.a TO json",
@@ -615,6 +944,206 @@ def test_distinct():
     assert res.exit_code == 0
 
 
+def test_batches():
+    for batch_size in [1, 2, 3, 100]:
+        opts = {"input_options": {"batch_size": batch_size}}
+        eq_test_nrows(
+            "SELECT col1 * 10 AS a FROM range(1, 8) WHERE col1 % 2 == 1",
+            [{"a": 10}, {"a": 30}, {"a": 50}, {"a": 70}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT col1, row_number FROM range(1, 8) WHERE col1 > 4",
+            [
+                {"col1": 5, "row_number": 1},
+                {"col1": 6, "row_number": 2},
+                {"col1": 7, "row_number": 3},
+            ],
+            **opts,
+        )
+        # variables assigned by the WHERE clause are the ones of each row
+        eq_test_nrows(
+            "SELECT j, row_number FROM [1, 2, 3, 4, 5] WHERE (j := col1) > 1 OFFSET 1",
+            [
+                {"j": 3, "row_number": 2},
+                {"j": 4, "row_number": 3},
+                {"j": 5, "row_number": 4},
+            ],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT row.a AS a FROM json WHERE .a > 1 LIMIT 2 OFFSET 1",
+            [{"a": 3}, {"a": 4}],
+            data="".join(['{"a": %d}\n' % i for i in range(6)]),
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT DISTINCT col1 % 3 AS a FROM range(10) LIMIT 2",
+            [{"a": 0}, {"a": 1}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT a AS a FROM csv",
+            [{"a": NULL}, {"a": 4}, {"a": NULL}],
+            data="a,b,c\n,2,3\n4,5,6\n,8,9",
+            **opts,
+        )
+    exception_test("SELECT 1/col1 FROM [1,0]", ZeroDivisionError, **opts)
+    exception_test("SELECT 1", TypeError, input_options={"batch_size": 0})
+    # rows after the last output row are not evaluated
+    eq_test_nrows(
+        "SELECT 1 / col1 AS a FROM [1, 2, 0] LIMIT 2", [{"a": 1.0}, {"a": 0.5}], **opts
+    )
+
+
+def test_offset_skip():
+    # rows discarded by OFFSET are filtered, but the SELECT clause is not evaluated
+    for opts in [{}, {"batch_size": 2}, {"batch_size": 100}]:
+        opts = {"input_options": opts}
+        eq_test_nrows(
+            "SELECT 10 / col1 AS a FROM [0, 5, 2] OFFSET 1",
+            [{"a": 2.0}, {"a": 5.0}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT 1 / (col1 - 2) AS a FROM range(5) LIMIT 1 OFFSET 3",
+            [{"a": 1.0}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT col1, row_number FROM range(10) WHERE col1 % 2 == 0 OFFSET 3",
+            [{"col1": 6, "row_number": 4}, {"col1": 8, "row_number": 5}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT json->b AS b FROM json EXPLODE json->b OFFSET 3",
+            [{"b": 4}, {"b": 5}],
+            data='{"b": [1, 2]}\n{"b": [3, 4, 5]}\n',
+            **opts,
+        )
+        exception_test(
+            "SELECT 1/col1 FROM [0, 1, 0] OFFSET 1", ZeroDivisionError, **opts
+        )
+
+
+def test_vectorized():
+    data = "a,b,c,d\n1,2.5,x,10\n2,,y,0\n3,4.0,x,\n4,-1.5,z,40\n5,3.0,x,50\n"
+    for batch_size in [None, 1, 2, 100]:
+        opts = {"input_options": {"vectorize": True, "header": True}}
+        if batch_size:
+            opts["input_options"]["batch_size"] = batch_size
+        eq_test_nrows(
+            "SELECT a * 2 AS a, b + 1 AS b, c FROM csv WHERE a > 1 and b is not NULL",
+            [
+                {"a": 6, "b": 5.0, "c": "x"},
+                {"a": 8, "b": -0.5, "c": "z"},
+                {"a": 10, "b": 4.0, "c": "x"},
+            ],
+            data=data,
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT a // 2 AS a, -b AS b, not b AS nb FROM csv"
+            " WHERE c == 'x' or d > 30 ORDER BY 1 DESC, 2 LIMIT 3",
+            [
+                {"a": 2, "b": -3.0, "nb": False},
+                {"a": 2, "b": 1.5, "nb": False},
+                {"a": 1, "b": -4.0, "nb": False},
+            ],
+            data=data,
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT a / d AS r FROM csv WHERE d != 0",
+            [{"r": 0.1}, {"r": 0.1}, {"r": 0.1}],
+            data=data,
+            **opts,
+        )
+        # integer overflows are handled by the row engine
+        eq_test_nrows(
+            "SELECT a * 10**18 AS x FROM csv WHERE a > 3",
+            [{"x": 4 * 10**18}, {"x": 5 * 10**18}],
+            data=data,
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT c, sum_agg(a) AS s, avg_agg(b) AS avg, count_agg(*) AS n,"
+            " min_agg(d) AS mi, max_agg(b) - 1 AS ma, d FROM csv GROUP BY 1",
+            [
+                {"c": "x", "s": 9, "avg": 19 / 6, "n": 3, "mi": 10, "ma": 3.0, "d": 50},
+                {"c": "y", "s": 2, "avg": NULL, "n": 1, "mi": 0, "ma": NULL, "d": 0},
+                {"c": "z", "s": 4, "avg": -1.5, "n": 1, "mi": 40, "ma": -2.5, "d": 40},
+            ],
+            data=data,
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT a % 2 AS k, sum_agg(a / d) AS s, count_agg(d) AS n FROM csv"
+            " WHERE d != 0 GROUP BY 1 ORDER BY 1",
+            [{"k": 0, "s": 0.1, "n": 1}, {"k": 1, "s": 0.2, "n": 2}],
+            data=data,
+            **opts,
+        )
+        # division by zero is reported by the row engine
+        exception_test(
+            "SELECT sum_agg(a / d) FROM csv", ZeroDivisionError, data=data, **opts
+        )
+
+    # large integers
+    opts = {"input_options": {"vectorize": True, "header": True}}
+    eq_test_nrows(
+        "SELECT a * a AS a2 FROM csv",
+        [{"a2": 9 * 10**18}, {"a2": 4 * 10**18}],
+        data="a,b\n3000000000,1\n-2000000000,2\n",
+        **opts,
+    )
+    eq_test_nrows(
+        "SELECT a // 8 AS a FROM csv",
+        [{"a": 2**61}, {"a": 1}],
+        data=f"a,b\n{2**64},1\n8,2\n",
+        **opts,
+    )
+
+
+def test_pipeline():
+    for opts in [{"pipeline": True}, {"pipeline": True, "batch_size": 2}]:
+        opts = {"input_options": opts}
+        eq_test_nrows(
+            "SELECT col1 * 10 AS a FROM range(1, 8) WHERE col1 % 2 == 1",
+            [{"a": 10}, {"a": 30}, {"a": 50}, {"a": 70}],
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT row.a AS a FROM json WHERE .a > 1 LIMIT 2 OFFSET 1",
+            [{"a": 3}, {"a": 4}],
+            data="".join(['{"a": %d}\n' % i for i in range(6)]),
+            **opts,
+        )
+        eq_test_nrows(
+            "SELECT a, sum_agg(b) AS b FROM csv GROUP BY 1 ORDER BY 2 DESC",
+            [{"a": NULL, "b": 10}, {"a": 4, "b": 5}],
+            data="a,b,c\n,2,3\n4,5,6\n,8,9",
+            **opts,
+        )
+        exception_test("SELECT 1/col1 FROM [1,0]", ZeroDivisionError, **opts)
+        exception_test(
+            "SELECT * FROM json", json.JSONDecodeError, data='{"a": 1}\n{', **opts
+        )
+    res = spyql.query.Query(
+        "SELECT col1 FROM range(10) WHERE col1 > 6", input_options={"pipeline": True}
+    )
+    assert res() == ({"col1": 7}, {"col1": 8}, {"col1": 9})
+    assert set(res.stats()["busy_time"]) == {"read", "evaluate", "write"}
+    # GROUP BY queries are pipelined, also when groups exceed `max_memory`
+    for opts in [{"pipeline": True}, {"pipeline": True, "max_memory": 1}]:
+        res = spyql.query.Query(
+            "SELECT col1 % 2 AS a, string_agg(col1, ',') AS s FROM range(5) GROUP BY 1",
+            input_options=opts,
+        )
+        assert res() == ({"a": 0, "s": "0,2,4"}, {"a": 1, "s": "1,3"})
+        assert set(res.stats()["busy_time"]) == {"read", "evaluate", "write"}
+
+
 def test_null():
     eq_test_1row("SELECT NULL", {"NULL": NULL})
     eq_test_1row("SELECT NULL+1", {"NULL_1": NULL})
@@ -658,6 +1187,30 @@ def test_processors():
                 '{"a": [4], "b": "four"}\n'
             ),
         )
+        for where in [
+            "json.b != 'four' and json.a > 1",
+            "json->b != 'four' and row.a > 1",
+            "json.a > 1 and json.b != 'four'",
+            "json.b != 'four' and json.get('a') > 1",
+        ]:
+            eq_test_nrows(
+                f"SELECT json.a, json.b FROM {jsonproc} EXPLODE json.a WHERE {where}",
+                [{"a": 2, "b": "three"}, {"a": 3, "b": "three"}],
+                data=(
+                    '{"a": [1, 2, 3], "b": "three"}\n{"a": [], "b": "none"}\n'
+                    '{"a": [4], "b": "four"}\n'
+                ),
+            )
+        # conditions that assign variables are evaluated after exploding
+        eq_test_nrows(
+            f"SELECT j->a AS a, j->b AS b FROM {jsonproc} EXPLODE json->a"
+            " WHERE (j := json) and j->a > 1 and j->b != 'four'",
+            [{"a": 2, "b": "three"}, {"a": 3, "b": "three"}],
+            data=(
+                '{"a": [1, 2, 3], "b": "three"}\n{"a": [], "b": "none"}\n'
+                '{"a": [4], "b": "four"}\n'
+            ),
+        )
         eq_test_nrows(f"SELECT * FROM {jsonproc}", [], data="")
 
     # CSV input and NULLs
@@ -666,6 +1219,23 @@ def test_processors():
         [{"a": 1}, {"a": 4}, {"a": 7}],
         data="a,b,c\n1,2,3\n4,5,6\n7,8,9",
     )
+    # columns referenced several times (casts are evaluated once per row)
+    for opts in [{"sample_size": 3}, {"sample_size": 3, "batch_size": 2}]:
+        eq_test_nrows(
+            "SELECT a * 2 AS a2, b, b + a AS c FROM csv"
+            " WHERE a > 1 and b > a ORDER BY b DESC, a",
+            [{"a2": 8, "b": 9, "c": 13}, {"a2": 4, "b": 3, "c": 5}],
+            data="a,b\n1,2\n2,3\n0,x\n4,9\n",
+            input_options=opts,
+            warning_flag="error",
+        )
+        eq_test_nrows(
+            "SELECT a, b + 1 AS b FROM csv WHERE a > 1 and b > a",
+            [{"a": 2, "b": 4}, {"a": 4, "b": 10}],
+            data="a,b\n1,2\n2,3\n0,x\n4,9\n",
+            input_options=opts,
+            warning_flag="error",
+        )
     eq_test_nrows(
         "SELECT a as a FROM csv",
         [{"a": NULL}, {"a": 4}, {"a": NULL}],
@@ -779,6 +1349,38 @@ def test_row_access():
             ' "four"}\n'
         ),
     )
+    eq_test_nrows(
+        "SELECT .a, .b FROM json EXPLODE .a WHERE .b == 'three' and .a > 1",
+        [{"a": 2, "b": "three"}, {"a": 3, "b": "three"}],
+        data=(
+            '{"a": [1, 2, 3], "b": "three"}\n{"a": [], "b": "none"}\n{"a": [4], "b":'
+            ' "four"}\n'
+        ),
+    )
+    eq_test_nrows(
+        "SELECT col1, col2 FROM [[[1, 2], 1], [[3], 0]] EXPLODE col1"
+        " WHERE col2 > 0 and col1 != 2 and len(row) == 2",
+        [{"col1": 1, "col2": 1}],
+    )
+
+    # expressions repeated across clauses
+    data = (
+        '{"a": {"b": {"c": "x", "d": 1}}, "e": [1, 2]}\n'
+        '{"a": {"b": {"c": null, "d": 2}}, "e": [3]}\n'
+        '{"a": {"b": {"c": "x", "d": 3}}, "e": []}\n'
+    )
+    eq_test_nrows(
+        "SELECT json->a->b->c AS c, count_agg(*) AS n, sum_agg(.a.b.d) AS d"
+        " FROM json WHERE json->a->b->c is not NULL and .a.b.d > 0 GROUP BY 1",
+        [{"c": "x", "n": 2, "d": 4}],
+        data=data,
+    )
+    eq_test_nrows(
+        "SELECT json->e AS e, json->a->b->d * json->e AS f FROM json EXPLODE json->e"
+        " WHERE json->a->b->d < 3 and json->e > 1 ORDER BY json->e DESC",
+        [{"e": 3, "f": 6}, {"e": 2, "f": 2}],
+        data=data,
+    )
 
     # CSV input
     eq_test_nrows(
@@ -1019,6 +1621,40 @@ def test_custom_syntax():
         data='{"one": 1, "two": 2}\n',
     )
 
+    # translation of clauses mixing `->`, `.` and strings holding these tokens
+    def translate(query, cols):
+        processor = Processor.make_processor(*spyql.parser.parse(query))
+        processor.init_query_vars({})
+        processor.input_col_names = cols
+        processor.handle_1st_data_row([None] * len(cols))
+        clauses = processor.translate_query()
+        return {clause: expr for clause, expr in clauses.items() if expr}
+
+    cols = ["a", "b", "json"]
+    for query, translation in [
+        ("SELECT json->a.b FROM [1]", {"select": "_values[2]['a'].b,"}),
+        (
+            "SELECT a->b, a.b, b FROM [1]",
+            {"select": "_values[0]['b'],_values[0].b,_values[1],"},
+        ),
+        (
+            "SELECT .a->'b.c' + '->.', \"json->a.b\" FROM [1]",
+            {"select": 'row.a["b.c"] + "->.","json->a.b",'},
+        ),
+        (
+            "SELECT 1 FROM [1] WHERE .a->'->' == 'a.b->c' and b->a.b > 0",
+            {
+                "select": "1,",
+                "where": 'row.a["->"] == "a.b->c" and _values[1][\'a\'].b > 0',
+            },
+        ),
+        (
+            "SELECT 1 FROM [1] ORDER BY json->'a.b'->b.a, '.a->b'",
+            {"select": "1,", "orderby": '_values[2]["a.b"][\'b\'].a,".a->b",'},
+        ),
+    ]:
+        assert translate(query, cols) == translation
+
 
 def test_errors():
     # TODO find way to test custom error output
@@ -1056,6 +1692,14 @@ def test_errors():
     exception_test(
         "SELECT row.a FROM [{'a':1},{'a':2},{'a':3}] EXPLODE row.a", TypeError
     )
+    exception_test(
+        "SELECT col1 FROM [[[1, 0], 1]] EXPLODE col1 WHERE col2 > 0 and 1 / col1",
+        ZeroDivisionError,
+    )
+    exception_test(
+        "SELECT col1 FROM [[[1], 0]] EXPLODE col1 WHERE 1 / col2 and col1 > 0",
+        ZeroDivisionError,
+    )
     exception_test("1,2,3 SELECT 1", SyntaxError)
     exception_test("SELECT col1 FROM range(3,0,-1) ORDER 1", SyntaxError)
     exception_test("SELECT col1 FROM range(3,0,-1) ORDER BYZZZ 1", SyntaxError)
@@ -1068,8 +1712,7 @@ def test_sql_output():
     Writes to an in memory sqlite DB and reads back to test
     """
     conn = sqlite3.connect(":memory:")
-    conn.cursor().execute(
-        """CREATE TABLE test1(
+    conn.cursor().execute("""CREATE TABLE test1(
         aint int,
         afloat numeric(2,1),
         aintnull int,
@@ -1077,8 +1720,7 @@ def test_sql_output():
         astr text,
         alist text,
         adict text)
-    """
-    )
+    """)
 
     query = """
         SELECT